@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+"""
+BenchmarkDetector.py - Compare frames per second for the fused and original blob detector paths
+
+Renders a synthetic night (see amt_benchmark/synthetic.py) and times AMTBlobDetector.findblobs over them twice - once with "fused" set to false (the original separate threshold steps and per-frame allocation) and once with the fused single-threshold path that reuses buffers between frames. The blob counts from the two runs are also compared.
+
+Usage: python BenchmarkDetector.py configfile [width height frames repeats]
+
+Width and height default to 3840 and 2160, frames to 30 and repeats to 3. The two paths are run alternately and the best rate for each is reported, since the MOG2 subtractors account for most of the time and are sensitive to other load on the machine.
+"""
+__author__ = "Donald Hobern"
+__copyright__ = "Copyright 2021, Donald Hobern"
+__credits__ = ["Donald Hobern"]
+__license__ = "CC-BY-4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Donald Hobern"
+__email__ = "dhobern@gmail.com"
+__status__ = "Production"
+
+import sys
+import cv2
+import copy
+import json
+import time
+
+from amt_blobdetector import AMTBlobDetector
+from amt_benchmark.synthetic import AMTSyntheticNight
+
+def benchmark(config, frames, fused):
+    config = copy.deepcopy(config)
+    config["blobdetector"]["fused"] = fused
+    detector = AMTBlobDetector(config)
+    counts = []
+    start = time.perf_counter()
+    for i in range(len(frames)):
+        count, _, _ = detector.findblobs(frames[i], i + 1)
+        counts.append(count)
+    return len(frames) / (time.perf_counter() - start), counts
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python BenchmarkDetector.py configfile [width height frames repeats]")
+        sys.exit(1)
+
+    with open(sys.argv[1]) as f:
+        config = json.load(f)
+
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else 3840
+    height = int(sys.argv[3]) if len(sys.argv) > 3 else 2160
+    count = int(sys.argv[4]) if len(sys.argv) > 4 else 30
+    repeats = int(sys.argv[5]) if len(sys.argv) > 5 else 3
+
+    cv2.setNumThreads(1)
+    settings = config["benchmark"] if "benchmark" in config else {}
+    frames = [image for _, image, _ in AMTSyntheticNight(settings | { "width": width, "height": height, "frames": count })]
+
+    before, after = 0, 0
+    for i in range(repeats):
+        rate, countsbefore = benchmark(config, frames, False)
+        before = max(before, rate)
+        rate, countsafter = benchmark(config, frames, True)
+        after = max(after, rate)
+
+    print(f"{width}x{height}, {count} frames, best of {repeats}")
+    print(f"Original: {before:.2f} frames/s")
+    print(f"Fused: {after:.2f} frames/s ({after / before:.2f}x)")
+    print(f"Blob counts {'match' if countsbefore == countsafter else 'differ'} ({sum(countsafter)} blobs)")
@@ -1,104 +1,68 @@
 import os
 import cv2
-import csv
 import sys
+import json
+from amt_tables import tableexists, readtable
+from amt_movie import AMTMovieRenderer, readmovieconfig
+from amt_overlay import agecolors, AMTTrails, drawtrails
 
-agecolors = [(0, 128, 0), (255, 0, 0), (255, 50, 50), (255, 100, 100), (255, 150, 150), (255, 200, 200), (0, 0, 255)]
+def annotate(img, overlay, scale):
+    thickness = max(1, round(2 * scale))
+    trails = []
+    for label, xcrop, ycrop, wcrop, hcrop, trail in overlay:
+        x, y, w, h = [int(v * scale) for v in (xcrop, ycrop, wcrop, hcrop)]
+        cv2.rectangle(img, (x, y), (x + w, y + h), agecolors[0], thickness)
+        if ycrop < 30:
+            cv2.putText(img, label, (x, y + h + int(25 * scale)), cv2.FONT_HERSHEY_SIMPLEX, 0.6 * scale, agecolors[0], thickness, cv2.LINE_AA)
+        else:
+            cv2.putText(img, label, (x, y - int(5 * scale)), cv2.FONT_HERSHEY_SIMPLEX, 0.6 * scale, agecolors[0], thickness, cv2.LINE_AA)
+        trails.append(trail)
+    drawtrails(img, trails, thickness, scale)
 
 if len(sys.argv) < 2:
-    print("Usage: python CreateMovie.py directorypath")
+    print("Usage: python CreateMovie.py directorypath [configpath]")
     sys.exit()
 
+config = None
+if len(sys.argv) > 2:
+    with open(sys.argv[2]) as file:
+        config = json.load(file)
+
 foldername = sys.argv[1]
 datafolder = os.path.join(foldername, "data")
-blobfolder = os.path.join(datafolder, "blob")
-amtblobfile = os.path.join(datafolder, "amt_blob.csv")
-amttrackfile = os.path.join(datafolder, "amt_track.csv")
-amtimagefile = os.path.join(datafolder, "amt_image.csv")
-if os.path.isdir(blobfolder) and os.path.isfile(amtblobfile) and os.path.isfile(amtimagefile):
+if tableexists(datafolder, "blob") and tableexists(datafolder, "image"):
 
     identifications = None
-    if os.path.isfile(amttrackfile):
-        identifications = {}
-        with open(amttrackfile, newline='') as trackfile:
-            trackreader = csv.reader(trackfile, delimiter=',')
-            next(trackreader)
-            for track in trackreader:
-                identifications[track[0]] = track[1]
+    if tableexists(datafolder, "track"):
+        tracktable = readtable(datafolder, "track", ["id", "identification"])
+        identifications = dict(zip(tracktable["id"], tracktable["identification"]))
 
     imageblobs = {}
 
-    with open(amtblobfile, newline='') as bloblist:
-        blobreader = csv.reader(bloblist, delimiter=',')
-        headings = next(blobreader)
-        itrackid = headings.index("trackid")
-        iimageid = headings.index("imageid")
-        ixcrop = headings.index("xcrop")
-        iycrop = headings.index("ycrop")
-        iwcrop = headings.index("wcrop")
-        ihcrop = headings.index("hcrop")
-        ixcenter = headings.index("xcenter")
-        iycenter = headings.index("ycenter")
-
-        for blob in blobreader:
-            imageid = blob[iimageid]
-            if imageid in imageblobs:
-                blobs = imageblobs[imageid]
-            else:
-                blobs = []
-                imageblobs[imageid] = blobs
-            blobs.append(blob)
-
-    moviewriter = cv2.VideoWriter(os.path.join(datafolder, "amt.avi"), cv2.VideoWriter_fourcc(*'DIVX'), 5, (3840, 2160))
-    trails = {}
-
-    with open(amtimagefile, newline='') as imagelist:
-        imagereader = csv.reader(imagelist, delimiter=',')
-        headings = next(imagereader)
-        iid = headings.index("id")
-        ifilename = headings.index("filename")
-
-        for image in imagereader:
-            id = image[iid]
-            filepath = os.path.join(foldername, image[ifilename])
-            img = cv2.imread(filepath)
-
-            if id in imageblobs:
-                for blob in imageblobs[id]:
-                    trackid = blob[itrackid]
-                    if identifications is not None and trackid in identifications:
-                        label = identifications[trackid]
-                    else:
-                        label = str(trackid)
-                    xcrop = int(blob[ixcrop])
-                    ycrop = int(blob[iycrop])
-                    wcrop = int(blob[iwcrop])
-                    hcrop = int(blob[ihcrop])
-                    xcenter = int(blob[ixcenter])
-                    ycenter = int(blob[iycenter])
+    blobtable = readtable(datafolder, "blob", ["imageid", "trackid", "xcrop", "ycrop", "wcrop", "hcrop", "xcenter", "ycenter"])
+    for imageid, blobs in blobtable.groupby("imageid", sort=False):
+        imageblobs[imageid] = list(blobs.drop(columns="imageid").itertuples(index=False, name=None))
 
-                    cv2.rectangle(img, (xcrop, ycrop), (xcrop + wcrop, ycrop + hcrop), agecolors[0], 2)
-                    if ycrop < 30:
-                        cv2.putText(img, label, (xcrop, ycrop + hcrop + 25), cv2.FONT_HERSHEY_SIMPLEX, 0.6, agecolors[0], 2, cv2.LINE_AA)
-                    else:
-                        cv2.putText(img, label, (xcrop, ycrop - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.6, agecolors[0], 2, cv2.LINE_AA)
+    # Trails depend on the frames before, so the overlays are worked out in
+    # order here and the frames are then rendered in parallel
+    frames = []
+    # A track may be missing from up to five frames before the tracker
+    # gives it up
+    trails = AMTTrails(maxage = 5)
 
-                    if trackid in trails:
-                        trail = trails[trackid]
-                        x1, y1 = xcenter, ycenter
-                        age = 0
-                        while age < len(trail) and age < 5:
-                            x2, y2 = trail[age]
-                            cv2.line(img, (x1, y1), (x2, y2), agecolors[age + 1], 2, cv2.LINE_AA)
-                            x1, y1 = x2, y2
-                            age += 1
-                    else:
-                        trail = []
-                        trails[trackid] = trail
-                    trail.insert(0, (xcenter, ycenter))
-                    if len(trail) > 5:
-                        trail = trail[0:5]
+    imagetable = readtable(datafolder, "image", ["id", "filename"])
+    for id, filename in imagetable.itertuples(index=False, name=None):
+        overlay = []
+        if id in imageblobs:
+            for trackid, xcrop, ycrop, wcrop, hcrop, xcenter, ycenter in imageblobs[id]:
+                if identifications is not None and trackid in identifications:
+                    label = identifications[trackid]
+                else:
+                    label = str(trackid)
 
-            moviewriter.write(img)
+                overlay.append((label, xcrop, ycrop, wcrop, hcrop, trails.add(trackid, (xcenter, ycenter))))
+        trails.endframe()
+        frames.append((os.path.join(foldername, filename), overlay))
 
-        moviewriter.release()
+    renderer = AMTMovieRenderer(readmovieconfig(config))
+    renderer.render(os.path.join(datafolder, "amt.avi"), frames, annotate)
@@ -2,32 +2,43 @@ import os
 import sys
 import re
 import cv2
+import json
 import numpy as np
+from amt_movie import AMTMovieRenderer, readmovieconfig
+from amt_decode import readsize
+
+def annotate(image, label, scale):
+    cv2.putText(image, label, (10, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 191, 0))
 
 if len(sys.argv) < 2:
-    print("Usage: python " + sys.argv[0] + " directorypath [fps [start-end]]] ")
+    print("Usage: python " + sys.argv[0] + " directorypath [fps [start-end|- [configpath]]] ")
     sys.exit()
 
+config = None
+if len(sys.argv) > 4:
+    with open(sys.argv[4]) as file:
+        config = json.load(file)
+
+settings = readmovieconfig(config, { "fps": 15 })
 if len(sys.argv) > 2:
-    fps = int(sys.argv[2])
-else:
-    fps = 15
+    settings["fps"] = int(sys.argv[2])
+fps = settings["fps"]
 
 moviename = "AMT_" + str(fps) + ".avi"
 
 startstring = None
 endstring = None
 include = True
-if len(sys.argv) > 3:
+if len(sys.argv) > 3 and sys.argv[3] != "-":
     include = False
     moviename = "AMT_" + str(fps) + "_" + sys.argv[3] + ".avi"
     startstring, endstring = sys.argv[3].split("-")
 
 p = re.compile("^20[-0-9]*.*jpg$")
 foldername = sys.argv[1]
-moviewriter = None
+frames = []
 
-for filename in os.listdir(foldername):
+for filename in sorted(os.listdir(foldername)):
     if filename.lower().endswith("jpg"):
         if startstring is not None and filename[0:len(startstring)] >= startstring:
             startstring = None
@@ -36,20 +47,15 @@ for filename in os.listdir(foldername):
             endstring = None
             include = False
         if include:
-            filepath = os.path.join(foldername, filename)
-            print(filepath)
-            image = cv2.imread(filepath)
-            if moviewriter is None:
-                height, width, channels = image.shape
-                if width > 2000:
-                    height = int(height / 2)
-                    width = int(width / 2)
-                moviewriter = cv2.VideoWriter(os.path.join(foldername, moviename), cv2.VideoWriter_fourcc(*'DIVX'), fps, (width, height))
-            image = cv2.resize(image, (width, height))
             label = filename[0:4] + "-" + filename[4:6] + "-" + filename[6:8] + " " + filename[8:10] + ":" + filename[10:12] + ":" + filename[12:14]
-            cv2.putText(image, label, (10, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 191, 0))
-
-            moviewriter.write(image)
-
-if moviewriter is not None:
-    moviewriter.release()
\ No newline at end of file
+            frames.append((os.path.join(foldername, filename), label))
+
+if len(frames) > 0:
+    if "width" not in settings and "scale" not in settings:
+        # Large images are halved unless the configuration sets the size
+        width, height = readsize(frames[0][0])
+        if width > 2000:
+            settings["scale"] = 0.5
+    renderer = AMTMovieRenderer(settings)
+    renderer.render(os.path.join(foldername, moviename), frames, annotate)
+    print(str(len(frames)) + " frames written to " + os.path.join(foldername, moviename))
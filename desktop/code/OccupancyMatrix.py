@@ -1,245 +1,137 @@
-import math
-import csv
+#!/usr/bin/env python
+"""
+OccupancyMatrix.py - Tabulate the taxa recorded by an autonomous moth trap against time of night
+
+Reads the image, blob and track tables of one or more run folders and writes a matrix with a row for each taxon (and optionally each unit) and a column for each time bin, holding the number of tracks of the taxon with a blob in that bin or the number of nights on which the taxon was present in that bin.
+
+Usage: python OccupancyMatrix.py configfile [runfolder ...]
+
+Run folders are named relative to the datapath in the configuration file, or given as paths. If none are given, every run folder in the datapath is included. Settings are taken from an optional "occupancy" section of the configuration file:
+
+ - bin - width of each time bin in minutes (default 60)
+ - timeofday - if true (the default), bins are times of night from noon to noon, combining all the nights, otherwise they are dates and times across the season
+ - measure - "tracks" (the default) counts distinct tracks, "presence" counts distinct nights
+ - byunit - if true, rows are split by the unitname in each run's amt_metadata.yaml (default false)
+ - unidentified - if true, tracks without an identification are counted as "Unidentified" (default false)
+ - taxondictionary and rank - a taxon dictionary as maintained by TrackEditor and one of its rank columns (e.g. "family") to combine identifications at that rank - names without a value at that rank are left as they are
+ - format - "parquet" (the default), "feather" or "csv" - the first two need pyarrow
+ - output - file to write (default amt_occupancy.<format> in the datapath)
+"""
+
 import os
 import sys
-import shutil
-import time
-import yaml
+import csv
+import json
 import pandas
-from datetime import datetime
-
-foldername = None
-blobfolder = None
-images = {}
-
-def track_datetime(blobs, iimagename):
-    for b in blobs:
-        if len(b[iimagename]) > 0:
-            i = b[iimagename].index("_")
-            if i >= 0:
-                i += 1
-                j = b[iimagename].index("_", i)
-                if j >= 0:
-                    return datetime.strptime(b[iimagename][i:j],"%Y%m%d%H%M%S")
-    return None
-
-def readamtmetadata():
-    metadata = {}
-    metadata["latitude"] = ""
-    metadata["longitude"] = ""
-    metadata["positional_accuracy"] = ""
-    metadata["description"] = 'Image(s) from Automated Moth Trap - see <a href="https://amt.hobern.net/">AMT project overview</a>.'
-    metadata["tag_list"] = 'AutomatedMothTrap'
-    metadatafilename = os.path.join(foldername, "amt_metadata.yaml")
-    if os.path.isfile(metadatafilename):
-        yamlmetadata = yaml.load(open(metadatafilename), Loader=yaml.FullLoader)
-        if "event" in yamlmetadata:
-            event = yamlmetadata["event"]
-            if "decimalLatitude" in event:
-                metadata["latitude"] = event["decimalLatitude"]
-            if "decimalLongitude" in event:
-                metadata["longitude"] = event["decimalLongitude"]
-            if "coordinateUncertaintyInMeters" in event:
-                metadata["positional_accuracy"] = event["coordinateUncertaintyInMeters"]
-        if "provenance" in yamlmetadata and "capture" in yamlmetadata["provenance"]:
-            capture = yamlmetadata["provenance"]["capture"]
-            hardware = []
-            if "unitname" in capture:
-                hardware.append("Unit: " + capture["unitname"])
-                metadata["tag_list"] = metadata["tag_list"] + ", " + capture["unitname"]
-            if "processor" in capture:
-                hardware.append("Processor: " + capture["processor"])
-            if "camera" in capture:
-                hardware.append("Camera: " + capture["camera"])
-            if "illumination" in capture:
-                hardware.append("Illumination: " + capture["illumination"])
-            if "uvlight" in capture:
-                hardware.append("UV light: " + capture["uvlight"])
-            if "mode" in capture:
-                mode = capture["mode"]
-                if mode == "Motion":
-                    modetext = "motion detection by "
-                elif mode == "TimeLapse":
-                    modetext = "timelapse capture by "
-                else:
-                    modetext = ""
-
-            if (len(hardware) > 0):
-                metadata["description"] = 'Image(s) from ' + modetext + 'Automated Moth Trap (' + "; ".join(hardware) + ') - see <a href="https://amt.hobern.net/">AMT project overview</a>.'
-    return metadata
-
-taxondictionary = None
-taxonnames = {}
-
-if len(sys.argv) < 3:
-    print("Usage: python OccupancyMatrix.py directorypath [taxondictionary]")
-    sys.exit()
-
-taxondictionary = sys.argv[2]
-if os.path.isfile(taxondictionary):
-    with open(taxondictionary, newline='') as taxon_file:
+
+from amt_tables import readtables, writeframe
+from amt_index import readmetadata, runfolder_pattern
+
+
+def readconfig(path):
+    with open(path) as file:
+        data = json.load(file)
+    return data
+
+
+def readoccupancy(folders):
+    # Returns one row per blob with the run folder, night, unit, track,
+    # image time and identification, for all the folders. Runs are keyed by
+    # path, as units have their own folders for the same night.
+    datafolders = [ os.path.join(folder, "data") for folder in folders ]
+    blobs = readtables(datafolders, "blob", [ "imageid", "trackid" ])
+    images = readtables(datafolders, "image", [ "id", "datetime" ])
+    if blobs is None or images is None:
+        return None
+    frame = blobs.merge(images.rename(columns={ "id": "imageid" }), on=[ "folder", "imageid" ])
+    tracks = readtables(datafolders, "track", [ "id", "identification" ])
+    if tracks is not None:
+        frame = frame.merge(tracks.rename(columns={ "id": "trackid" }), on=[ "folder", "trackid" ], how="left")
+        frame["identification"] = frame["identification"].fillna("")
+    else:
+        frame["identification"] = ""
+    units = {}
+    for folder in folders:
+        units[os.path.normpath(folder)] = readmetadata(folder).get("unit", "")
+    frame["unit"] = frame["folder"].map(units).fillna("")
+    frame["night"] = frame["folder"].map(os.path.basename)
+    return frame
+
+
+def readtaxonranks(path, rank):
+    # Maps each name in the taxon dictionary to its value at rank
+    ranks = {}
+    with open(path, newline='', encoding="utf8") as taxon_file:
         taxon_reader = csv.reader(taxon_file, delimiter=',')
         taxonheadings = next(taxon_reader)
+        irank = taxonheadings.index(rank)
         for line in taxon_reader:
-            taxonnames[line[0].strip()] = line
-
-foldername = sys.argv[1]
-datafolder = os.path.join(foldername, "data")
-if os.path.isdir(datafolder):
-    imgfile = os.path.join(datafolder, "amt_image.csv")
-    blobfile = os.path.join(datafolder, "amt_blob.csv")
-    trackfile = os.path.join(datafolder, "amt_track.csv")
-    matrixfile = os.path.join(datafolder, "amt_matrix.csv")
-    if os.path.isfile(imgfile) and os.path.isfile(blobfile) and os.path.isfile(trackfile):
-        with open(imgfile, newline='', encoding="utf8") as imglist, open(blobfile, newline='', encoding="utf8") as bloblist, open(trackfile, newline='', encoding="utf8") as tracklist, open(matrixfile, 'w', newline='', encoding="utf8") as matrixlist:
-            imgreader = csv.reader(imglist, delimiter=',')
-            imgheadings = next(imgreader)
-            iid = imgheadings.index("id")
-            idatetime = imgheadings.index("datetime")
-            blobreader = csv.reader(bloblist, delimiter=',')
-            blobheadings = next(blobreader)
-            bid = blobheadings.index("id")
-            bimageid = blobheadings.index("imageid")
-            bx = blobheadings.index("x")
-            by = blobheadings.index("y")
-            bw = blobheadings.index("w")
-            bh = blobheadings.index("h")
-            trackreader = csv.reader(tracklist, delimiter=',')
-            trackheadings = next(trackreader)
-            tid = trackheadings.index("id")
-            matrixwriter = csv.writer(matrixlist, delimiter=',')
-
-            matrix = pandas.DataFrame()
-
-            tracks = {}
-
-            for track in trackreader:
-                tracks[track[tid]]= track
-
-            blobs = {}
-
-            for blob in blobreader:
-                if blob[bimageid] not in blobs:
-                    blobs[blob[bimageid]] = []
-                blobs[blob[bimageid]].append(blob)
-
-            for img in imgreader:
-
-
-        trackfile = os.path.join(datafolder, "amt_track.csv")
-        if os.path.isfile(trackfile):
-            shutil.copyfile(trackfile, os.path.join(datafolder, "amt_track_backup_" + datetime.now().strftime("%Y%m%d%H%M%S") + ".csv"))
-            with open(trackfile, newline='') as tracklist:
-                trackreader = csv.reader(tracklist, delimiter=',')
-                headings = next(trackreader)
-                iid = headings.index("id")
-                iidentification = headings.index("identification")
-                if "inaturalistID" in headings:
-                    iinatid = headings.index("inaturalistID")
-                    iinatrg = headings.index("inaturalistRG")
-                    iinattaxon = headings.index("inaturalistTaxon")
-                else:
-                    iinatid = -1
-                    iinatrg = -1
-                    iinattaxon = -1
-                for track in trackreader:
-                    identifications[track[iid]] = track[iidentification]
-                    if iinatid >= 0 and len(track[iinatid]) > 0:
-                        inaturalistrecords[track[iid]] = [track[iinatid], track[iinatrg] if iinatrg >= 0 else False, track[iinattaxon] if iinattaxon >=0 else ""]
-
-        with open(blobfile, newline='') as bloblist:
-            blobreader = csv.reader(bloblist, delimiter=',')
-            headings = next(blobreader)
-            itrackid = headings.index("trackid")
-            iblobsize = headings.index("size")
-
-            for blob in blobreader:
-                trackid = blob[itrackid]
-                if trackid in blobsbyid:
-                    blobs = blobsbyid[trackid]
-                else:
-                    blobs = []
-                    blobsbyid[trackid] = blobs
-                    inat = ["", False, ""]
-                    if trackid in identifications:
-                        identification = identifications[trackid]
-                        if trackid in inaturalistrecords:
-                            inat = inaturalistrecords[trackid]
-                    else:
-                        identification = ""
-                    tracks.append(Track(trackid, blobs, identification, inat[0], inat[1], inat[2]))
-                blobs.append(blob)
-
-            blobfolder = os.path.join(datafolder, "blob")
-
-            if len(tracks) == 0:
-                print("No tracks to edit")
-                exit()
-
-            for track in tracks:
-                track.setaveragesize()
+            if len(line) > irank and len(line[irank]) > 0:
+                ranks[line[0].strip()] = line[irank]
+    return ranks
+
+
+def getmatrix(frame, settings):
+    width = pandas.Timedelta(minutes=settings["bin"])
+    times = pandas.to_datetime(frame["datetime"], format="%Y%m%d%H%M%S", errors="coerce")
+    frame = frame.assign(time=times).dropna(subset=["time"])
+
+    taxa = frame["identification"]
+    if "ranks" in settings:
+        taxa = taxa.map(settings["ranks"]).fillna(taxa)
+    if settings["unidentified"]:
+        taxa = taxa.where(taxa != "", "Unidentified")
+    frame = frame.assign(taxon=taxa)
+    frame = frame[frame["taxon"] != ""]
+
+    # Bins are numbered from noon for times of night so that they sort in
+    # order through midnight
+    noon = pandas.Timedelta(hours=12)
+    if settings["timeofday"]:
+        shifted = frame["time"] - noon
+        bins = (shifted - shifted.dt.normalize()).dt.floor(width)
+    else:
+        bins = frame["time"].dt.floor(width)
+    if settings["measure"] == "presence":
+        values = frame["night"]
+    else:
+        values = frame["folder"] + ":" + frame["trackid"].astype(str)
+    frame = frame.assign(bin=bins, value=values)
+
+    index = [ "unit", "taxon" ] if settings["byunit"] else [ "taxon" ]
+    matrix = frame.pivot_table(index=index, columns="bin", values="value", aggfunc="nunique", fill_value=0)
+    if settings["timeofday"]:
+        labels = [ str((b + noon) % pandas.Timedelta(days=1))[-8:-3] for b in matrix.columns ]
     else:
-        print("Missing blob list: " + blobfile)
-        exit()
-else:
-    print("Data folder not found: " + datafolder)
-    exit()
-
-root = Tk()
-root.title("TrackEditor: " + foldername)
-
-s = ttk.Style()
-s.configure("Odd.TFrame", background=grey)
-s.configure("Even.TFrame", background=blue)
-s.configure("Deleted.TFrame", background=red)
-s.configure("Linking.TFrame", background=green)
-s.configure("Odd.TLabel", background=grey)
-s.configure("Even.TLabel", background=blue)
-s.configure("Deleted.TLabel", background=red)
-s.configure("Linking.TLabel", background=green)
-
-menu = ttk.Frame(root, padding="5 5 5 5")
-menu.grid(column=0, row=0, sticky=(N, W, E))
-container = ttk.Frame(root)
-container.grid(column=0, row=1, sticky=(N, W, E, S))
-canvas = Canvas(container)
-canvas.grid(column=0, row=1, sticky=(N, W, E, S))
-canvas["bg"] = grey
-scrollbar = ttk.Scrollbar(container, orient="vertical", command=canvas.yview)
-scrollbar.grid(column=1, row=1, sticky=(N, E, S))
-trackviewer = TrackCanvas(canvas, tracks, headings, taxonnames, blobsize = 100, rows = 12)
-canvas.create_window((0, 0), window=trackviewer, anchor="nw")
-container.bind("<Configure>", resizecontainer)
-canvas.configure(yscrollcommand=scrollbar.set, yscrollincrement="10")
-canvas.bind_all("<MouseWheel>", on_mousewheel)
-
-filterlabel = ttk.Label(menu, text="Filter by identification", width=20)
-filterlabel.grid(column=0, row=0, sticky=(N, E))
-filtervar = StringVar()
-filtervar.set("")
-filtertext = AutocompleteEntry(menu, text="", width=30, textvariable=filtervar, completevalues=taxonnames)
-filtertext.grid(column=1, row=0, sticky=(N, E))
-filterapply = ttk.Button(menu, text = "Apply", command=partial(trackviewer.filtertracks, filtervar, False))
-filterapply.grid(column=2, row=0, sticky=(N, E))
-filterclear = ttk.Button(menu, text = "Clear", command=partial(trackviewer.filtertracks, filtervar, True))
-filterclear.grid(column=3, row=0, sticky=(N, E))
-sortoptions = ["start time", "blob size", "identification"]
-sorttype = StringVar()
-sorttype.set(sortoptions[0])
-sorttype.trace("w", partial(trackviewer.sorttracks, sorttype))
-sortdropdown = OptionMenu(menu, sorttype, *sortoptions)
-sortdropdown.grid(column=4, row=0, sticky=(N, E))
-prevpage = ttk.Button(menu, text="Prev", command=trackviewer.prevpage, padding="5 5 5 5")
-prevpage.grid(column=5, row=0, sticky=(N, E))
-nextpage = ttk.Button(menu, text="Next", command=trackviewer.nextpage, padding="5 5 5 5")
-nextpage.grid(column=6, row=0, sticky=(N, E))
-save = ttk.Button(menu, text="Save", command=partial(savetracks, datafolder, tracks, trackheadings, headings, taxondictionary, taxonnames, taxonmaster), padding="5 5 5 5")
-save.grid(column=7, row=0, sticky=(N, E))
-
-root.columnconfigure(0, weight=1)
-root.rowconfigure(1, weight=1)
-container.columnconfigure(0, weight=1)
-container.rowconfigure(1, weight=1)
-container.rowconfigure(1, weight=1)
-
-root.mainloop()
\ No newline at end of file
+        labels = [ b.strftime("%Y-%m-%d %H:%M") for b in matrix.columns ]
+    matrix.columns = labels
+    return matrix.reset_index()
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python OccupancyMatrix.py configfile [runfolder ...]")
+        sys.exit(1)
+
+    conf = readconfig(sys.argv[1])
+    datapath = conf["datapath"]
+    settings = { "bin": 60, "timeofday": True, "measure": "tracks", "byunit": False, "unidentified": False, "format": "parquet" }
+    if "occupancy" in conf:
+        settings.update(conf["occupancy"])
+    if "taxondictionary" in settings and "rank" in settings:
+        settings["ranks"] = readtaxonranks(settings["taxondictionary"], settings["rank"])
+
+    if len(sys.argv) > 2:
+        folders = [ folder if os.path.isdir(folder) else os.path.join(datapath, folder) for folder in sys.argv[2:] ]
+    else:
+        folders = [ os.path.join(datapath, f) for f in sorted(os.listdir(datapath)) if runfolder_pattern.match(f) and os.path.isdir(os.path.join(datapath, f)) ]
+
+    frame = readoccupancy(folders)
+    if frame is None:
+        print("No image and blob tables found")
+        sys.exit(1)
+
+    matrix = getmatrix(frame, settings)
+    output = settings["output"] if "output" in settings else os.path.join(datapath, "amt_occupancy." + settings["format"])
+    writeframe(output, matrix, settings["format"])
+    print(str(len(matrix)) + " rows, " + str(len(matrix.columns) - (2 if settings["byunit"] else 1)) + " bins written to " + output)
@@ -1,160 +1,224 @@
-from tkinter import *
-from tkinter import ttk
-from ttkwidgets.autocomplete import AutocompleteEntry
-from PIL import ImageTk,Image  
-from functools import partial
-import math
-import csv
+#!/usr/bin/env python
+"""
+OrganiseByTaxon.py - Gather the blob crops of identified tracks from every run into a folder for each taxon
+
+Scans all run folders below the root folder (at any depth, e.g. one folder per unit) and places each crop belonging to a track identified in TrackEditor in <outputfolder>/<identification>/, named <run>_<crop filename>. Crops are reflinked where the filesystem supports it (Btrfs, XFS and similar on Linux), otherwise hard linked, and only copied when neither is possible (e.g. across drives), so the output takes almost no extra space. Crops held in a blob pack (see amt_blobstore.py) are written out as files.
+
+The work is done by a pool of threads. A manifest (amt_organise.json in the output folder) records the crops placed for each run and the state of the run's tables, so a later run skips unchanged runs and only adds, moves or removes crops whose identification has changed.
+
+Usage: python OrganiseByTaxon.py rootfolder [outputfolder [workers]]
+
+The output folder defaults to "taxa" in the root folder and the number of workers to 8.
+"""
+
 import os
+import re
+import sys
+import json
 import shutil
-import time
-import yaml
-from datetime import datetime
-import pyinaturalist
-
-blobsbyid = {}
-tracks = []
-identifications = {}
-inaturalistrecords = {}
-taxondictionary = None
-taxonnames = []
-
-if len(sys.argv) < 2:
-    rootfolder = "D:\AMT"
-else:
-    rootfolder = sys.argv[1]
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from amt_blobstore import AMTBlobStore
+from amt_tables import findtable, readtable
+from amt_index import runfolder_pattern
+
+manifestname = "amt_organise.json"
+# ioctl to clone a file's extents on Linux
+FICLONE = 0x40049409
+unsafe_pattern = re.compile('[<>:"/\\\\|?*\x00-\x1f]')
+
+
+def findruns(rootfolder, outputfolder):
+    # Returns the paths of run folders with a blob table, relative to the
+    # root folder
+    runs = []
+    for folder, subfolders, filenames in os.walk(rootfolder):
+        if os.path.normpath(folder) == os.path.normpath(outputfolder):
+            subfolders.clear()
+            continue
+        if runfolder_pattern.match(os.path.basename(folder)):
+            if findtable(os.path.join(folder, "data"), "blob") is not None:
+                runs.append(os.path.relpath(folder, rootfolder))
+            subfolders.clear()
+        subfolders.sort()
+    return runs
+
+
+def getsignature(datafolder):
+    # Changes whenever the blob or track table is rewritten
+    signature = []
+    for name in [ "blob", "track" ]:
+        found = findtable(datafolder, name)
+        signature.append([ found[0], os.path.getmtime(found[0]) ] if found is not None else None)
+    return signature
+
+
+def getcrops(datafolder):
+    # Returns the taxon folder name for each crop of an identified track
+    if findtable(datafolder, "track") is None:
+        return {}
+    blobs = readtable(datafolder, "blob", [ "trackid", "filename" ])
+    tracks = readtable(datafolder, "track", [ "id", "identification" ])
+    tracks = tracks[tracks["identification"].str.strip() != ""]
+    crops = blobs[blobs["filename"] != ""].merge(tracks, left_on="trackid", right_on="id")
+    return dict(zip(crops["filename"], gettaxonfolders(crops["identification"])))
+
+
+def gettaxonfolders(identifications):
+    # Folder names for identifications - characters not allowed in file names
+    # are replaced and trailing dots and spaces (dropped by Windows) removed,
+    # so that names such as "." and ".." become "_" rather than pointing
+    # outside the taxon's folder
+    taxa = identifications.str.strip().str.replace(unsafe_pattern, "_", regex=True).str.rstrip(". ")
+    return taxa.where(taxa != "", "_")
+
+
+class AMTCropLinker:
+    def __init__(self):
+        # Methods that have failed once are not tried again
+        self.reflink = fcntl is not None
+        self.hardlink = True
+        self.counts = { "reflink": 0, "hardlink": 0, "copy": 0, "write": 0, "remove": 0 }
+        self.lock = threading.Lock()
+
+    def count(self, method):
+        with self.lock:
+            self.counts[method] += 1
+
+    def place(self, blobstore, name, target):
+        # Writes beside the target and renames, so a crop left by an
+        # interrupted run is replaced cleanly
+        temppath = target + ".tmp"
+        if os.path.isfile(temppath):
+            os.remove(temppath)
+        source = os.path.join(blobstore.folder, name)
+        if not os.path.isfile(source):
+            with open(temppath, "wb") as f:
+                f.write(blobstore.read(name))
+            method = "write"
+        else:
+            method = self.link(source, temppath)
+        os.replace(temppath, target)
+        self.count(method)
+
+    def link(self, source, target):
+        if self.reflink:
+            try:
+                with open(source, "rb") as src, open(target, "wb") as dst:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return "reflink"
+            except OSError:
+                os.remove(target)
+                self.reflink = False
+        if self.hardlink:
+            try:
+                os.link(source, target)
+                return "hardlink"
+            except OSError:
+                self.hardlink = False
+        shutil.copyfile(source, target)
+        return "copy"
+
+    def remove(self, target):
+        if os.path.isfile(target):
+            os.remove(target)
+        self.count("remove")
+
+
+def readmanifest(path):
+    if os.path.isfile(path):
+        with open(path, encoding="utf8") as f:
+            return json.load(f)
+    return { "runs": {} }
+
+
+def writemanifest(path, manifest):
+    temppath = path + ".tmp"
+    with open(temppath, "w", encoding="utf8") as f:
+        json.dump(manifest, f)
+    os.replace(temppath, path)
+
+
+def organiserun(executor, linker, rootfolder, outputfolder, run, previous):
+    # Places the crops of one run, given the crops placed for it before,
+    # and returns the crops now placed
+    datafolder = os.path.join(rootfolder, run, "data")
+    crops = getcrops(datafolder)
+    prefix = run.replace(os.sep, "_").replace("/", "_") + "_"
+    blobstore = AMTBlobStore(datafolder)
+    for taxon in set(crops.values()) - set(previous.values()):
+        os.makedirs(os.path.join(outputfolder, taxon), exist_ok=True)
+    futures = []
+    for name, taxon in previous.items():
+        if crops.get(name) != taxon:
+            futures.append(executor.submit(linker.remove, os.path.join(outputfolder, taxon, prefix + name)))
+    for future in futures:
+        future.result()
+    futures = {}
+    for name, taxon in crops.items():
+        if previous.get(name) != taxon:
+            futures[name] = executor.submit(linker.place, blobstore, name, os.path.join(outputfolder, taxon, prefix + name))
+    failed = []
+    for name, future in futures.items():
+        try:
+            future.result()
+        except OSError as e:
+            print("Failed to place " + name + " from " + run + ": " + str(e))
+            failed.append(name)
+    blobstore.close()
+    # Crops that could not be placed are left out of the manifest
+    for name in failed:
+        del crops[name]
+    return crops, len(failed)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python OrganiseByTaxon.py rootfolder [outputfolder [workers]]")
+        sys.exit(1)
 
-if !os.path.exists(rootfolder):
-    print("Usage: python ")
-if len(sys.argv) > 2:
-    taxondictionary = sys.argv[2]
-    if os.path.isfile(taxondictionary):
-        taxonnames = []
-        with open(taxondictionary, newline='') as taxonlist:
-            lines = taxonlist.readlines()
-            for line in lines:
-                taxonnames.append(line.strip())
-
-taxonmaster = taxonnames.copy()
-
-foldername = sys.argv[1]
-datafolder = os.path.join(foldername, "data")
-if os.path.isdir(datafolder):
-    blobfile = os.path.join(datafolder, "amt_blob.csv")
-    if os.path.isfile(blobfile):
-        shutil.copyfile(blobfile, os.path.join(datafolder, "amt_blob_backup_" + datetime.now().strftime("%Y%m%d%H%M%S") + ".csv"))
-
-        trackfile = os.path.join(datafolder, "amt_track.csv")
-        if os.path.isfile(trackfile):
-            shutil.copyfile(trackfile, os.path.join(datafolder, "amt_track_backup_" + datetime.now().strftime("%Y%m%d%H%M%S") + ".csv"))
-            with open(trackfile, newline='') as tracklist:
-                trackreader = csv.reader(tracklist, delimiter=',')
-                headings = next(trackreader)
-                iid = headings.index("id")
-                iidentification = headings.index("identification")
-                if "inaturalistID" in headings:
-                    iinatid = headings.index("inaturalistID")
-                    iinatrg = headings.index("inaturalistRG")
-                    iinattaxon = headings.index("inaturalistTaxon")
-                else:
-                    iinatid = -1
-                    iinatrg = -1
-                    iinattaxon = -1
-                for track in trackreader:
-                    identifications[track[iid]] = track[iidentification]
-                    if iinatid >= 0 and len(track[iinatid]) > 0:
-                        inaturalistrecords[track[iid]] = [track[iinatid], track[iinatrg] if iinatrg >= 0 else False, track[iinattaxon] if iinattaxon >=0 else ""]
-
-
-        with open(blobfile, newline='') as bloblist:
-            blobreader = csv.reader(bloblist, delimiter=',')
-            headings = next(blobreader)
-            itrackid = headings.index("trackid")
-            iblobsize = headings.index("size")
-
-            for blob in blobreader:
-                trackid = blob[itrackid]
-                if trackid in blobsbyid:
-                    blobs = blobsbyid[trackid]
-                else:
-                    blobs = []
-                    blobsbyid[trackid] = blobs
-                    inat = ["", False, ""]
-                    if trackid in identifications:
-                        identification = identifications[trackid]
-                        if trackid in inaturalistrecords:
-                            inat = inaturalistrecords[trackid]
-                    else:
-                        identification = ""
-                    tracks.append(Track(trackid, blobs, identification, inat[0], inat[1], inat[2]))
-                blobs.append(blob)
-
-            blobfolder = os.path.join(datafolder, "blob")
-
-            for track in tracks:
-                track.setaveragesize()
-    else:
-        print("Missing blob list: " + blobfile)
-        exit()
-else:
-    print("Data folder not found: " + datafolder)
-    exit()
-
-root = Tk()
-root.title("TrackEditor: " + foldername)
-
-s = ttk.Style()
-s.configure("Odd.TFrame", background=grey)
-s.configure("Even.TFrame", background=blue)
-s.configure("Deleted.TFrame", background=red)
-s.configure("Linking.TFrame", background=green)
-s.configure("Odd.TLabel", background=grey)
-s.configure("Even.TLabel", background=blue)
-s.configure("Deleted.TLabel", background=red)
-s.configure("Linking.TLabel", background=green)
-
-menu = ttk.Frame(root, padding="5 5 5 5")
-menu.grid(column=0, row=0, sticky=(N, W, E))
-container = ttk.Frame(root)
-container.grid(column=0, row=1, sticky=(N, W, E, S))
-canvas = Canvas(container)
-canvas.grid(column=0, row=1, sticky=(N, W, E, S))
-canvas["bg"] = grey
-scrollbar = ttk.Scrollbar(container, orient="vertical", command=canvas.yview)
-scrollbar.grid(column=1, row=1, sticky=(N, E, S))
-trackviewer = TrackCanvas(canvas, tracks, headings, taxonnames, blobsize = 100, rows = 12)
-canvas.create_window((0, 0), window=trackviewer, anchor="nw")
-container.bind("<Configure>", resizecontainer)
-canvas.configure(yscrollcommand=scrollbar.set, yscrollincrement="10")
-canvas.bind_all("<MouseWheel>", on_mousewheel)
-
-filterlabel = ttk.Label(menu, text="Filter by identification", width=20)
-filterlabel.grid(column=0, row=0, sticky=(N, E))
-filtervar = StringVar()
-filtervar.set("")
-filtertext = AutocompleteEntry(menu, text="", width=30, textvariable=filtervar, completevalues=taxonnames)
-filtertext.grid(column=1, row=0, sticky=(N, E))
-filterapply = ttk.Button(menu, text = "Apply", command=partial(trackviewer.filtertracks, filtervar, False))
-filterapply.grid(column=2, row=0, sticky=(N, E))
-filterclear = ttk.Button(menu, text = "Clear", command=partial(trackviewer.filtertracks, filtervar, True))
-filterclear.grid(column=3, row=0, sticky=(N, E))
-sortoptions = ["start time", "blob size", "identification"]
-sorttype = StringVar()
-sorttype.set(sortoptions[0])
-sorttype.trace("w", partial(trackviewer.sorttracks, sorttype))
-sortdropdown = OptionMenu(menu, sorttype, *sortoptions)
-sortdropdown.grid(column=4, row=0, sticky=(N, E))
-prevpage = ttk.Button(menu, text="Prev", command=trackviewer.prevpage, padding="5 5 5 5")
-prevpage.grid(column=5, row=0, sticky=(N, E))
-nextpage = ttk.Button(menu, text="Next", command=trackviewer.nextpage, padding="5 5 5 5")
-nextpage.grid(column=6, row=0, sticky=(N, E))
-save = ttk.Button(menu, text="Save", command=partial(savetracks, datafolder, tracks, trackheadings, headings, taxondictionary, taxonnames, taxonmaster), padding="5 5 5 5")
-save.grid(column=7, row=0, sticky=(N, E))
-
-root.columnconfigure(0, weight=1)
-root.rowconfigure(1, weight=1)
-container.columnconfigure(0, weight=1)
-container.rowconfigure(1, weight=1)
-container.rowconfigure(1, weight=1)
-
-root.mainloop()
\ No newline at end of file
+    rootfolder = sys.argv[1]
+    if not os.path.isdir(rootfolder):
+        print("Root folder not found: " + rootfolder)
+        sys.exit(1)
+    outputfolder = sys.argv[2] if len(sys.argv) > 2 else os.path.join(rootfolder, "taxa")
+    workers = int(sys.argv[3]) if len(sys.argv) > 3 else 8
+    os.makedirs(outputfolder, exist_ok=True)
+
+    manifestpath = os.path.join(outputfolder, manifestname)
+    manifest = readmanifest(manifestpath)
+    runs = findruns(rootfolder, outputfolder)
+    linker = AMTCropLinker()
+    skipped = 0
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for run in runs:
+            datafolder = os.path.join(rootfolder, run, "data")
+            signature = getsignature(datafolder)
+            key = run.replace(os.sep, "/")
+            previous = manifest["runs"][key] if key in manifest["runs"] else { "signature": None, "crops": {} }
+            if previous["signature"] == signature:
+                skipped += 1
+                continue
+            crops, failed = organiserun(executor, linker, rootfolder, outputfolder, run, previous["crops"])
+            # A run with failures is tried again next time
+            manifest["runs"][key] = { "signature": signature if failed == 0 else None, "crops": crops }
+            writemanifest(manifestpath, manifest)
+            print(run + ": " + str(len(crops)) + " crops")
+
+        # Runs that have gone from the root folder lose their crops
+        found = set(run.replace(os.sep, "/") for run in runs)
+        for key in [ key for key in manifest["runs"] if key not in found ]:
+            prefix = key.replace("/", "_") + "_"
+            for name, taxon in manifest["runs"][key]["crops"].items():
+                executor.submit(linker.remove, os.path.join(outputfolder, taxon, prefix + name))
+            del manifest["runs"][key]
+    writemanifest(manifestpath, manifest)
+
+    print(str(len(runs)) + " runs, " + str(skipped) + " unchanged - " + ", ".join(str(count) + " " + method for method, count in linker.counts.items() if count > 0))
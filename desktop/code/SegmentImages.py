@@ -6,7 +6,15 @@ Processes a batch of images, identifies and extracts blobs of interest, and gene
 
 Configuration is provided via a JSON file, with the following elements:
 
- - 
+ - workers - number of run folders to process in parallel, each in its own process (default 1, 0 for one per CPU core)
+ - blobdetector - settings for AMTBlobDetector, optionally including "pyramid" (number of halvings of the image before background subtraction, with candidate rectangles refined at full resolution), "roi" ([x, y, w, h] region to search) and "roithreshold" (minimum background illumination to search) - use ValidateDetector.py to check these against full-resolution detection - and "recentmodel" and "referencemodel" (the background models that keep learning and that stay fixed after the first image, each with a "class" of AMTMOG2Model, AMTAverageModel or AMTMedianModel - see amt_background.py and python -m amt_benchmark.models)
+ - checkpoint - "interval" is the number of images between checkpoints saved in data/amt_checkpoint.pkl (default 500, 0 for none) and "replay" the number of images replayed to rebuild the background model when resuming (default 500, the MOG2 history length) - if force is false, a folder with a checkpoint is resumed from it rather than skipped
+ - blobpack - if true, blob crops are appended to data/amt_blob.pack with an index in data/amt_blob_index.csv rather than written as separate files in data/blob (default false) - the filename column in amt_blob.csv names the crop in either case and amt_blobstore.AMTBlobStore reads both
+ - tables - "format" may be "parquet" or "feather" to add a typed columnar copy of amt_image and amt_blob once a folder is complete (default "csv" for none, both need pyarrow) and "keepcsv" false removes the CSV files (default true) - amt_tables.readtable reads either form
+ - seasonindex - if true, each completed folder is added to the SQLite index in <datapath>/amt_index.sqlite (see amt_index.py)
+ - incremental - if "enabled" is true, keeps watching each folder for new images until none have arrived for "idle" seconds (default 600), checking every "poll" seconds (default 10) and ignoring images changed in the last "settle" seconds (default 5), and keeps the checkpoint afterwards so that a later run can continue
+ - timing - "enabled" (default true) records wall and CPU time for each stage of each image in data/amt_timing.csv and prints a summary for each run folder, and "profileframe" (default 0 for none) saves a cProfile dump of that image's processing (counting from 1) as data/amt_profile.prof
+ - pipeline - within each run folder, "prefetch" is the number of images decoded ahead of detection, "writers" the number of threads writing output and "queuesize" the maximum number of pending writes (0 for prefetch or writers disables that stage)
 
 The default configuration file is AMT_config.json in the current folder. An alternative may be identified as the first command line parameter. Whichever configuration file is used, a copy is saved with the captured images.
 """
@@ -27,10 +35,21 @@ import csv
 import math
 import shutil
 import json
-from skimage.exposure import is_low_contrast
+import time
+import cProfile
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 from amt_blobdetector import AMTBlobDetector
 from amt_tracker import AMTTracker
+from amt_pipeline import readframes, AMTAsyncWriter
+from amt_checkpoint import AMTCheckpoint, AMTFolderWatcher
+from amt_blobstore import AMTBlobPackWriter
+from amt_tables import converttables
+from amt_index import AMTSeasonIndex
+from amt_timing import AMTStageTimer, timed
+from amt_overlay import agecolors, AMTTrails, drawtrails
+from colors import colorstring
 
 def readconfig(path):
     with open(path) as file:
@@ -78,252 +97,404 @@ def gethumidity(filename):
         return result.group(1)
     return "<UNKNOWN>"
 
-def ishighcontrast(image, blob, threshold):
-    image = cv2.resize(blob["blobimage"], (450, 450))
-    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-    return not is_low_contrast(gray, threshold)
-
-def getcount(hist, size, color, mindiff, maxdiff):
-    count = 0
-    for r in range(size):
-        for g in range(size):
-            for b in range(size):
-                if (color == "R" and r >= g + b + mindiff and abs(g - b) <= maxdiff) or \
-                    (color == "G" and g >= r + b + mindiff and abs(r - b) <= maxdiff) or \
-                    (color == "B" and b >= r + g + mindiff and abs(r - g) <= maxdiff) or \
-                    (color == "C" and r <= g + b - size - mindiff + 1 and abs(g - b) <= maxdiff) or \
-                    (color == "M" and g <= r + b - size - mindiff + 1 and abs(r - b) <= maxdiff) or \
-                    (color == "Y" and b <= r + g - size - mindiff + 1 and abs(r - g) <= maxdiff):
-                        count += hist[b][g][r]
-    return count    
-
-def reportcolors(image):
-    h, w, channels = image.shape
-    pixels = h * w
-    size = 3
-    mindiff = 1 
-    maxdiff = 1
-    threshold = 0.02
-    hist = cv2.calcHist([image], [0, 1, 2], None, [size, size, size], [0, 256, 0, 256, 0, 256])
-    colors = ""
-    for c in [ "R", "G", "B", "C", "M", "Y" ]:
-        if getcount(hist, size, c, mindiff, maxdiff) / pixels > threshold:
-            colors += c
-    return colors
-
-def isinteresting(image, blob, width, height, threshold):
-    if not ishighcontrast(image, blob, threshold):
-        return False
-    if (blob["xcrop"] > 0 and blob["xcrop"] + blob["wcrop"] < width):
-        return True
-    elif (blob["ycrop"] > 0 and blob["ycrop"] + blob["hcrop"] < height):
-        return True
-    elif blob["h"] / blob["w"] < 2:
-        return True
-    return False
-
-if len(sys.argv) >= 2:
-    config_filename = sys.argv[1]
-else:
-    config_filename = "../config/AMT_config.json"
-
-if len(sys.argv) >= 3:
-    selectedfolder = sys.argv[2]
-else:
-    selectedfolder = None
+def getpercentiles(cdf, q):
+    # Linearly interpolated percentiles as numpy.percentile would give, read
+    # from each row of a batch of cumulative histograms
+    n = cdf[:, -1]
+    position = q * (n - 1)
+    lower = np.floor(position)
+    upper = np.minimum(lower + 1, n - 1)
+    vlower = np.sum(cdf <= lower[:, None], axis=1)
+    vupper = np.sum(cdf <= upper[:, None], axis=1)
+    return vlower + (position - lower) * (vupper - vlower)
+
+def getinteresting(gray, blobs, threshold):
+    # Returns a boolean array marking the blobs worth keeping - those whose
+    # crop has a 1-99 percentile range of at least threshold (as a fraction of
+    # 255) in the grayscale frame and which either lie clear of the left and
+    # right or top and bottom edges or are not tall and narrow
+    if len(blobs) == 0:
+        return np.zeros(0, bool)
+    height, width = gray.shape[0:2]
+    hists = np.empty((len(blobs), 256), np.float64)
+    for i in range(len(blobs)):
+        hists[i] = cv2.calcHist([blobs[i].getcrop(gray)], [0], None, [256], [0, 256]).ravel()
+    cdf = np.cumsum(hists, axis=1)
+    contrast = (getpercentiles(cdf, 0.99) - getpercentiles(cdf, 0.01)) / 255
+    xcrop, ycrop, wcrop, hcrop, w, h = np.array([(b.xcrop, b.ycrop, b.wcrop, b.hcrop, b.w, b.h) for b in blobs]).T
+    insidex = (xcrop > 0) & (xcrop + wcrop < width)
+    insidey = (ycrop > 0) & (ycrop + hcrop < height)
+    return (contrast >= threshold) & (insidex | insidey | (h / w < 2))
 
 amtimgheadings = [ "id", "datetime", "filename", "temperature", "humidity" ]
 amtblobheadings = [ "id", "imageid", "filename", "x", "y", "w", "h", "xcrop", "ycrop", "wcrop", "hcrop", "xcenter", "ycenter", "size", "illumination", "changed", "colors", "trackid", "cost", "weights", "direction", "delay" ]
 
-conf = readconfig(config_filename)
-basefolder = conf['datapath']
 
-threshold = conf['threshold']
-savingmarked = conf['savemarked']
-savingmovie = conf['savemovie']
-markchanged = conf['markchanged']
-moviewriter = None
-
-if 'subsetinterval' in conf:
-    interval = int(conf['subsetinterval'])
-    if interval == 0 or interval > 3600:
-        print(f"WARNING: Subset interval {interval} out of range (1-3600)")
+def getinterval(conf):
+    if 'subsetinterval' in conf:
+        interval = int(conf['subsetinterval'])
+        if interval == 0 or interval > 3600:
+            print(f"WARNING: Subset interval {interval} out of range (1-3600)")
+            interval = None
+        else:
+            print(f"Subset interval {interval}")
+    else:
         interval = None
+    return interval
+
+def getworkers(conf):
+    workers = int(conf['workers']) if 'workers' in conf else 1
+    if workers < 1:
+        workers = os.cpu_count()
+    return workers
+
+def initworker():
+    # Each worker process handles a whole run folder, so keep OpenCV from
+    # starting its own thread pool in every one of them
+    cv2.setNumThreads(1)
+
+def gettimer(conf):
+    timing = conf['timing'] if 'timing' in conf else {}
+    if 'enabled' in timing and not timing['enabled']:
+        return None, 0
+    profileframe = int(timing['profileframe']) if 'profileframe' in timing else 0
+    # Decoding and output run on other threads, so only count CPU time used
+    # by the thread doing each stage
+    return AMTStageTimer(cpuclock = time.thread_time), profileframe
+
+def selectfolders(conf, selectedfolder):
+    basefolder = conf['datapath']
+    folders = []
+    p = re.compile("^20[-0-9]*$")
+    for f in os.listdir(basefolder):
+        if os.path.isdir(os.path.join(basefolder, f)) and (selectedfolder is None or selectedfolder == f) and p.match(f):
+            datafolder = os.path.join(basefolder, f, "data")
+            if not conf['force'] and os.path.isdir(datafolder) and not AMTCheckpoint(conf, datafolder).exists():
+                print(f + " - already processed")
+            else:
+                folders.append(f)
+    return folders
+
+def processfolder(conf, f, interval, verbose = True):
+    starttime = time.time()
+    print(f + " - processing")
+    threshold = conf['threshold']
+    savingmarked = conf['savemarked']
+    savingmovie = conf['savemovie']
+    markchanged = conf['markchanged']
+    blobpack = conf['blobpack'] if 'blobpack' in conf else False
+    moviewriter = None
+    timer, profileframe = gettimer(conf)
+
+    folder = os.path.join(conf['datapath'], f)
+    datafolder = os.path.join(folder, "data")
+    markedfolder = os.path.join(datafolder, "marked")
+    blobfolder = os.path.join(datafolder, "blob")
+
+    # Subsets are chosen from the whole folder, so they are always processed
+    # from scratch
+    resumable = interval is None
+    checkpoint = AMTCheckpoint(conf, datafolder)
+    state = None
+    if os.path.isdir(datafolder):
+        if conf['force']:
+            shutil.rmtree(datafolder)
+        elif resumable and checkpoint.exists():
+            state = checkpoint.load()
+        if state is None and os.path.isdir(datafolder):
+            shutil.rmtree(datafolder)
+    if state is None:
+        os.mkdir(datafolder)
+        os.mkdir(blobfolder)
+        state = { "processed": [], "imageid": 0, "blobid": 0, "tracks": [], "trails": AMTTrails(), "background": None, "frameid": 1, "sessions": 0 }
     else:
-        print(f"Subset interval {interval}")
-else:
-    interval = None
-
-
-agecolors = [(0, 128, 0), (255, 0, 0), (255, 50, 50), (255, 100, 100), (255, 150, 150), (255, 200, 200), (0, 0, 255)]
-
-p = re.compile("^20[-0-9]*$")
-for f in os.listdir(basefolder):
-    if os.path.isdir(os.path.join(basefolder, f)) and (selectedfolder is None or selectedfolder == f) and p.match(f):
-        if not conf['force'] and os.path.isdir(os.path.join(basefolder, f, "data")):
-            print(f + " - already processed")
+        print(f"{f} - resuming after {len(state['processed'])} images")
+    state["sessions"] += 1
+    if savingmarked and not os.path.isdir(markedfolder):
+        os.mkdir(markedfolder)
+    if savingmovie:
+        # Movies cannot be appended to, so each resumed session starts a new one
+        moviename = "amt.avi" if state["sessions"] == 1 else f"amt_{state['sessions']}.avi"
+        moviewriter = cv2.VideoWriter(os.path.join(datafolder, moviename), cv2.VideoWriter_fourcc(*'DIVX'), 5, (3840, 2160))
+
+    identifications = None
+    trackfilename = os.path.join(folder, "amt_track.csv")
+    if os.path.isfile(trackfilename):
+        identifications = {}
+        with open(trackfilename, newline='') as trackfile:
+            trackreader = csv.reader(trackfile, delimiter=',')
+            next(trackreader)
+            for track in trackreader:
+                identifications[int(track[0])] = track[1]
+
+    imagepath = os.path.join(datafolder, "amt_image.csv")
+    blobpath = os.path.join(datafolder, "amt_blob.csv")
+    resuming = len(state["processed"]) > 0
+    if resuming:
+        checkpoint.truncate(state, imagepath, blobpath, blobfolder)
+    filemode = 'a' if resuming else 'w'
+
+    with open(imagepath, filemode, newline='', encoding="utf8") as amtimgfile, open(blobpath, filemode, newline='', encoding="utf8") as amtblobfile:
+        output = AMTAsyncWriter(conf)
+        packwriter = AMTBlobPackWriter(datafolder, resuming) if blobpack else None
+        amtimgwriter = output.rowwriter(csv.writer(amtimgfile, delimiter=','))
+        amtblobwriter = output.rowwriter(csv.writer(amtblobfile, delimiter=','))
+        if not resuming:
+            amtimgwriter.writerow(amtimgheadings)
+            amtblobwriter.writerow(amtblobheadings)
+
+        processed = state["processed"]
+        imageid = state["imageid"]
+        blobid = state["blobid"]
+        tracks = state["tracks"]
+        trails = state["trails"]
+        bl = None
+        tr = None
+        if state["background"] is not None:
+            bl = AMTBlobDetector(conf)
+            bl.timer = timer
+            bl.setbackground(state["background"])
+            for index, filename in checkpoint.getreplay(state):
+                image = cv2.imread(os.path.join(folder, filename))
+                if image is not None:
+                    bl.replay(image, index)
+            bl.frame_id = state["frameid"]
+
+        def savecheckpoint():
+            if not resumable or len(processed) == checkpoint.saved:
+                return
+            output.flush()
+            amtimgfile.flush()
+            amtblobfile.flush()
+            offsets = {}
+            if packwriter is not None:
+                packwriter.flush()
+                offsets["packoffset"], offsets["indexoffset"] = packwriter.getoffsets()
+            checkpoint.save({
+                "processed": processed, "imageid": imageid, "blobid": blobid,
+                "tracks": tracks, "trails": trails, "sessions": state["sessions"],
+                "background": bl.background if bl is not None else None,
+                "frameid": bl.frame_id if bl is not None else 1,
+                "imageoffset": amtimgfile.tell(), "bloboffset": amtblobfile.tell(),
+                **offsets
+            })
+
+        if resumable:
+            watcher = AMTFolderWatcher(conf, folder, processed)
+            batches = watcher.batches(savecheckpoint)
         else:
-            print(f + " - processing")
-            folder = os.path.join(basefolder, f)
-            datafolder = os.path.join(folder, "data")
-            markedfolder = os.path.join(datafolder, "marked")
-            blobfolder = os.path.join(datafolder, "blob")
-
-            if os.path.isdir(datafolder) and conf['force']:
-                shutil.rmtree(datafolder)
-            os.mkdir(datafolder)
-            os.mkdir(blobfolder)
-            if savingmarked:
-                os.mkdir(markedfolder)
-            if savingmovie:
-                moviewriter = cv2.VideoWriter(os.path.join(datafolder, "amt.avi"), cv2.VideoWriter_fourcc(*'DIVX'), 5, (3840, 2160))
-                trails = {}
-
-            identifications = None
-            trackfilename = os.path.join(folder, "amt_track.csv")
-            if os.path.isfile(trackfilename):
-                identifications = {}
-                with open(trackfilename, newline='') as trackfile:
-                    trackreader = csv.reader(trackfile, delimiter=',')
-                    next(trackreader)
-                    for track in trackreader:
-                        identifications[int(track[0])] = track[1]
-
-            with open(os.path.join(datafolder, "amt_image.csv"), 'w', newline='', encoding="utf8") as amtimgfile, open(os.path.join(datafolder, "amt_blob.csv"), 'w', newline='', encoding="utf8") as amtblobfile:
-                amtimgwriter = csv.writer(amtimgfile, delimiter=',')
-                amtblobwriter = csv.writer(amtblobfile, delimiter=',')
-                amtimgwriter.writerow(amtimgheadings)
-                amtblobwriter.writerow(amtblobheadings)
-            
-                imageid = 0
-                blobid = 0
-                bl = None
-                tr = None
-                tracks = []
-                filelist = []
-                for filename in os.listdir(folder):
-                    if filename.lower().endswith("jpg"):
-                        filelist.append(filename)
-                if interval is not None and len(filelist) > 0:
-                    filtered = []
-                    block = -1
-                    previouscapture = None
-                    for capture in filelist:
-                        if capture.lower().endswith("jpg"):
-                            b = getintervalblock(capture, interval)
-                            if b >= 0:
-                                if (block == -1):
-                                    block = b
-                                if b != block and previouscapture is not None:
-                                    filtered.append(previouscapture)
-                                else:
-                                    previouscapture = capture
+            filelist = []
+            for filename in sorted(os.listdir(folder)):
+                if filename.lower().endswith("jpg"):
+                    filelist.append(filename)
+            if len(filelist) > 0:
+                filtered = []
+                block = -1
+                previouscapture = None
+                for capture in filelist:
+                    if capture.lower().endswith("jpg"):
+                        b = getintervalblock(capture, interval)
+                        if b >= 0:
+                            if (block == -1):
                                 block = b
-                    if len(filtered) == 0:
-                        filtered.append(filelist[math.floor(len(filelist) / 2)])
-                    elif previouscapture != filtered[-1]:
-                        filtered.append(previouscapture)
-                    filelist = filtered
-                    print(f"Subset: {len(filelist)} files ({filelist})")
-
-                for filename in filelist:
-                    filepath = os.path.join(folder, filename)
-
-                    if bl is None:
-                        bl = AMTBlobDetector(conf)
-                    if tr is None:
-                        tr = AMTTracker(conf)
-
-                    image = cv2.imread(filepath)
-                    if image is not None:
-                        height, width, channels = image.shape
-                        imageid += 1
-                        imagerec = {}
-                        imagerec["id"] = imageid
-                        imagerec["datetime"] = getdatetime(filename)
-                        imagerec["filename"] = filename
-                        imagerec["temperature"] = gettemperature(filename)
-                        imagerec["humidity"] = gethumidity(filename)
-                        writerecord(amtimgwriter, imagerec, amtimgheadings)
-                        print(filename + ": " + str(height) + " x " + str(width) + " x " + str(channels) + " " + imagerec["datetime"] + " " + imagerec["temperature"] + " " + imagerec["humidity"])
-
-                        startid = 0
-                        count, blobs, binary = bl.findblobs(image, imageid)
-
-                        b = 0
-                        while b < len(blobs):
-                            if isinteresting(image, blobs[b], width, height, threshold):
-                                blobid += 1
-                                blobs[b]["id"] = blobid
-                                b += 1
+                            if b != block and previouscapture is not None:
+                                filtered.append(previouscapture)
                             else:
-                                blobs.pop(b)
-
-                        tracks, deadtracks = tr.managetracks(tracks, blobs)
-
-                        if savingmarked or savingmovie:
-                            imagenew = image.copy()
-
-                        for blob in tracks:
-                            if savingmarked:
-                                cv2.rectangle(imagenew, (blob["xcrop"], blob["ycrop"]), (blob["xcrop"] + blob["wcrop"], blob["ycrop"] + blob["hcrop"]), agecolors[blob["age"]], 2)
-                                cost = str(blob["cost"])
-                                if len(cost) > 5:
-                                    cost = cost[0:5]
-                                if identifications is not None:
-                                    if blob["trackid"] in identifications:
-                                        identification = identifications[blob["trackid"]]
-                                    else:
-                                        identification = "Unknown"
-                                    if blob["ycrop"] < 30:
-                                        cv2.putText(imagenew, identification, (blob["xcrop"], blob["ycrop"] + blob["hcrop"] + 25), cv2.FONT_HERSHEY_SIMPLEX, 0.6, agecolors[blob["age"]], 2, cv2.LINE_AA)
-                                    else:
-                                        cv2.putText(imagenew, identification, (blob["xcrop"], blob["ycrop"] - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.6, agecolors[blob["age"]], 2, cv2.LINE_AA)
+                                previouscapture = capture
+                            block = b
+                if len(filtered) == 0:
+                    filtered.append(filelist[math.floor(len(filelist) / 2)])
+                elif previouscapture != filtered[-1]:
+                    filtered.append(previouscapture)
+                filelist = filtered
+                print(f"Subset: {len(filelist)} files ({filelist})")
+            batches = [ filelist ]
+
+        for filename, image in readframes(conf, folder, batches, timer):
+            if bl is None:
+                bl = AMTBlobDetector(conf)
+                bl.timer = timer
+            if tr is None:
+                tr = AMTTracker(conf)
+
+            profiler = None
+            if image is not None and imageid + 1 == profileframe:
+                profiler = cProfile.Profile()
+                profiler.enable()
+
+            if image is not None:
+                height, width, channels = image.shape
+                imageid += 1
+                imagerec = {}
+                imagerec["id"] = imageid
+                imagerec["datetime"] = getdatetime(filename)
+                imagerec["filename"] = filename
+                imagerec["temperature"] = gettemperature(filename)
+                imagerec["humidity"] = gethumidity(filename)
+                writerecord(amtimgwriter, imagerec, amtimgheadings)
+                if verbose:
+                    print(filename + ": " + str(height) + " x " + str(width) + " x " + str(channels) + " " + imagerec["datetime"] + " " + imagerec["temperature"] + " " + imagerec["humidity"])
+
+                startid = 0
+                count, blobs, gray = bl.findblobs(image, imageid)
+
+                with timed(timer, "contrast"):
+                    interesting = getinteresting(gray, blobs, threshold)
+                    blobs = [blobs[b] for b in range(len(blobs)) if interesting[b]]
+                    for blob in blobs:
+                        blobid += 1
+                        blob.id = blobid
+
+                with timed(timer, "tracking"):
+                    tracks, deadtracks = tr.managetracks(tracks, blobs)
+                    trails.evict([blob.trackid for blob in deadtracks if blob is not None])
+
+                with timed(timer, "write"):
+                    if savingmarked or savingmovie:
+                        imagenew = image.copy()
+                    paths = []
+
+                    for blob in tracks:
+                        if savingmarked:
+                            cv2.rectangle(imagenew, (blob.xcrop, blob.ycrop), (blob.xcrop + blob.wcrop, blob.ycrop + blob.hcrop), agecolors[blob.age], 2)
+                            cost = str(blob.cost)
+                            if len(cost) > 5:
+                                cost = cost[0:5]
+                            if identifications is not None:
+                                if blob.trackid in identifications:
+                                    identification = identifications[blob.trackid]
                                 else:
-                                    labeltext = str(blob["trackid"]) + ": " + str(blob["id"]) + " (" + cost + ") / " + blob["colors"] 
-                                    if blob["ycrop"] < 60:
-                                        cv2.putText(imagenew, labeltext, (blob["xcrop"], blob["ycrop"] + blob["hcrop"] + 25), cv2.FONT_HERSHEY_SIMPLEX, 0.6, agecolors[blob["age"]], 2, cv2.LINE_AA)
-                                        cv2.putText(imagenew, "{" + blob["weights"] + "}", (blob["xcrop"], blob["ycrop"] + blob["hcrop"] + 55), cv2.FONT_HERSHEY_SIMPLEX, 0.6, agecolors[blob["age"]], 2, cv2.LINE_AA)
-                                    else:
-                                        cv2.putText(imagenew, labeltext, (blob["xcrop"], blob["ycrop"] - 35), cv2.FONT_HERSHEY_SIMPLEX, 0.6, agecolors[blob["age"]], 2, cv2.LINE_AA)
-                                        cv2.putText(imagenew, "{" + blob["weights"] + "}", (blob["xcrop"], blob["ycrop"] - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.6, agecolors[blob["age"]], 2, cv2.LINE_AA)
-
-                                if blob["trackid"] in trails:
-                                    trail = trails[blob["trackid"]]
-                                    x1, y1 = blob["xcenter"], blob["ycenter"]
-                                    age = 0
-                                    while age < len(trail) and age < 5:
-                                        x2, y2 = trail[age]
-                                        cv2.line(imagenew, (x1, y1), (x2, y2), agecolors[age + 1], 2, cv2.LINE_AA)
-                                        x1, y1 = x2, y2
-                                        age += 1
+                                    identification = "Unknown"
+                                if blob.ycrop < 30:
+                                    cv2.putText(imagenew, identification, (blob.xcrop, blob.ycrop + blob.hcrop + 25), cv2.FONT_HERSHEY_SIMPLEX, 0.6, agecolors[blob.age], 2, cv2.LINE_AA)
                                 else:
-                                    trail = []
-                                    trails[blob["trackid"]] = trail
-                                trail.insert(0, (blob["xcenter"], blob["ycenter"]))
-                                if len(trail) > 5:
-                                    trail = trail[0:5]
-
-                            if blob["age"] == 0:
-
-                                if blob["changed"]:
-                                    blob["filename"] = str(blob["trackid"]) + "_" + imagerec["datetime"] + "_" + str(blobid) + ".jpg"
-                                    cv2.imwrite(os.path.join(blobfolder, blob["filename"]), blob["blobimage"])
+                                    cv2.putText(imagenew, identification, (blob.xcrop, blob.ycrop - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.6, agecolors[blob.age], 2, cv2.LINE_AA)
+                            else:
+                                labeltext = str(blob.trackid) + ": " + str(blob.id) + " (" + cost + ") / " + colorstring(blob.colors)
+                                if blob.ycrop < 60:
+                                    cv2.putText(imagenew, labeltext, (blob.xcrop, blob.ycrop + blob.hcrop + 25), cv2.FONT_HERSHEY_SIMPLEX, 0.6, agecolors[blob.age], 2, cv2.LINE_AA)
+                                    cv2.putText(imagenew, "{" + blob.weights + "}", (blob.xcrop, blob.ycrop + blob.hcrop + 55), cv2.FONT_HERSHEY_SIMPLEX, 0.6, agecolors[blob.age], 2, cv2.LINE_AA)
+                                else:
+                                    cv2.putText(imagenew, labeltext, (blob.xcrop, blob.ycrop - 35), cv2.FONT_HERSHEY_SIMPLEX, 0.6, agecolors[blob.age], 2, cv2.LINE_AA)
+                                    cv2.putText(imagenew, "{" + blob.weights + "}", (blob.xcrop, blob.ycrop - 5), cv2.FONT_HERSHEY_SIMPLEX, 0.6, agecolors[blob.age], 2, cv2.LINE_AA)
 
-                                writerecord(amtblobwriter, blob, amtblobheadings)
+                            paths.append(trails.add(blob.trackid, (blob.xcenter, blob.ycenter)))
 
-                                if markchanged:
-                                    if blob["changed"]:
-                                        cv2.rectangle(blob["blobimage"], (2, 2), (w - 2, h - 2), (0, 255, 0), 2)
-                                    else:
-                                        cv2.rectangle(blob["blobimage"], (2, 2), (w - 2, h - 2), (255, 0, 0), 2)
+                        if blob.age == 0:
 
-                        if savingmarked:
-                            cv2.imwrite(os.path.join(markedfolder, "new" + filename), imagenew)
+                            if blob.changed:
+                                blob.filename = str(blob.trackid) + "_" + imagerec["datetime"] + "_" + str(blobid) + ".jpg"
+                                # The crop is a view of the frame, so the writer gets a copy
+                                # if markchanged is about to draw on it
+                                crop = blob.getcrop(image).copy() if markchanged else blob.getcrop(image)
+                                if packwriter is not None:
+                                    output.writeencoded(packwriter, blob.filename, crop)
+                                else:
+                                    output.writeimage(os.path.join(blobfolder, blob.filename), crop)
 
-                        if savingmovie:
-                            moviewriter.write(imagenew)
+                            amtblobwriter.writerow(blob.getrow(amtblobheadings))
 
-                if savingmovie:
-                    moviewriter.release()
+                            if markchanged:
+                                if blob.changed:
+                                    cv2.rectangle(blob.getcrop(image), (2, 2), (blob.wcrop - 2, blob.hcrop - 2), (0, 255, 0), 2)
+                                else:
+                                    cv2.rectangle(blob.getcrop(image), (2, 2), (blob.wcrop - 2, blob.hcrop - 2), (255, 0, 0), 2)
+
+                    if savingmarked:
+                        drawtrails(imagenew, paths)
+                        output.writeimage(os.path.join(markedfolder, "new" + filename), imagenew)
+
+                    if savingmovie:
+                        output.writeframe(moviewriter, imagenew)
+
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(os.path.join(datafolder, "amt_profile.prof"))
+
+            if timer is not None:
+                timer.endframe(filename)
+
+            processed.append(filename)
+            if checkpoint.isdue(len(processed)):
+                savecheckpoint()
+
+        # An incremental run keeps its checkpoint so that later images can
+        # be added - otherwise the folder is complete
+        with timed(timer, "write"):
+            if resumable and watcher.enabled:
+                savecheckpoint()
+            output.close()
+            if packwriter is not None:
+                packwriter.close()
+        if timer is not None:
+            timer.endframe("<CLOSE>")
+        if not (resumable and watcher.enabled):
+            checkpoint.remove()
+
+        if savingmovie:
+            moviewriter.release()
+
+    # A completed folder gets its columnar tables once the CSV files are closed
+    if "tables" in conf and not (resumable and watcher.enabled):
+        tableformat = conf["tables"]["format"] if "format" in conf["tables"] else "csv"
+        keepcsv = conf["tables"]["keepcsv"] if "keepcsv" in conf["tables"] else True
+        converttables(datafolder, [ "image", "blob" ], tableformat, keepcsv)
+
+    if timer is not None:
+        timer.writecsv(os.path.join(datafolder, "amt_timing.csv"))
+        timer.printsummary(f)
+
+    return f, imageid, blobid, time.time() - starttime
+
+def reportprogress(result, done, total, starttime, totals):
+    f, images, blobs, seconds = result
+    totals[0] += images
+    totals[1] += blobs
+    elapsed = time.time() - starttime
+    rate = totals[0] / elapsed if elapsed > 0 else 0
+    print(f"[{done}/{total}] {f} - {images} images, {blobs} blobs in {seconds:.1f}s - total {totals[0]} images, {totals[1]} blobs in {elapsed:.1f}s ({rate:.2f} images/s)")
+
+if __name__ == "__main__":
+    if len(sys.argv) >= 2:
+        config_filename = sys.argv[1]
+    else:
+        config_filename = "../config/AMT_config.json"
 
+    if len(sys.argv) >= 3:
+        selectedfolder = sys.argv[2]
+    else:
+        selectedfolder = None
+
+    conf = readconfig(config_filename)
+    interval = getinterval(conf)
+    folders = selectfolders(conf, selectedfolder)
+    workers = getworkers(conf)
+    if workers > len(folders):
+        workers = len(folders)
+
+    # The season index is only written from this process
+    index = AMTSeasonIndex(conf['datapath']) if 'seasonindex' in conf and conf['seasonindex'] else None
+
+    starttime = time.time()
+    totals = [0, 0]
+    if workers > 1:
+        print(f"Processing {len(folders)} folders with {workers} workers")
+        with ProcessPoolExecutor(max_workers=workers, initializer=initworker) as executor:
+            futures = [executor.submit(processfolder, conf, f, interval, False) for f in folders]
+            done = 0
+            for future in as_completed(futures):
+                done += 1
+                result = future.result()
+                reportprogress(result, done, len(folders), starttime, totals)
+                if index is not None:
+                    index.updaterun(result[0])
+    else:
+        done = 0
+        for f in folders:
+            done += 1
+            reportprogress(processfolder(conf, f, interval), done, len(folders), starttime, totals)
+            if index is not None:
+                index.updaterun(f)
+
+    if index is not None:
+        index.close()
@@ -19,10 +19,10 @@ import csv
 import math
 import shutil
 import json
-from skimage.exposure import is_low_contrast
 
 from amt_blobdetector import AMTBlobDetector
 from amt_tracker import AMTTracker
+from amt_index import AMTSeasonIndex
 
 def readconfig(path):
     with open(path) as file:
@@ -37,25 +37,9 @@ else:
 conf = readconfig(config_filename)
 basefolder = conf['datapath']
 
-for f in os.listdir(basefolder):
-    lat, lon, unc, lun, ris, set = None, None, None, None, None, None
-    metadatafile = os.path.join(basefolder, f, 'amt_metadata.yaml')
-    if os.path.isfile(metadatafile):
-        with open(metadatafile, newline='') as metadata:
-            for line in metadata:
-                terms = line.strip().split(':')
-                if len(terms) > 1:
-                    key = terms[0].strip()
-                    if key == 'decimalLatitude': 
-                        lat = float(terms[1].strip())
-                    elif key == 'decimalLongitude': 
-                        lon = float(terms[1].strip())
-                    elif key == 'coordinateUncertaintyInMeters': 
-                        unc = float(terms[1].strip())
-                    elif key == 'lunarPhase': 
-                        lun = terms[1].strip()
-                    elif key == 'sunsetTime': 
-                        set = ':'.join(terms[1:]).strip().strip("'")
-                    elif key == 'sunriseTime': 
-                        ris = ':'.join(terms[1:]).strip().strip("'")
-    print(f + ": " + str(lon) + ", " + str(lat) + ", " + str(unc) + ", " + str(lun) + ", " + str(set) + ", " + str(ris))
+index = AMTSeasonIndex(basefolder)
+index.refresh()
+for run in index.getruns().itertuples():
+    lat, lon, unc, lun, ris, set = [ None if value is None or value != value else value for value in [ run.latitude, run.longitude, run.uncertainty, run.lunarphase, run.sunrise, run.sunset ] ]
+    print(run.folder + ": " + str(lon) + ", " + str(lat) + ", " + str(unc) + ", " + str(lun) + ", " + str(set) + ", " + str(ris))
+index.close()
@@ -10,14 +10,23 @@ import os
 import sys
 import shutil
 import time
+import threading
 import yaml
 import json 
 import re
+import numpy as np
+import pandas
 import requests 
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import pyinaturalist
 import webbrowser
 from multiprocessing import current_process
+from amt_blobstore import AMTBlobStore
+from amt_thumbnails import AMTThumbnailStore, AMTThumbnailCache
+from amt_tables import tableexists, gettableformats, tablepath, readtable, writetable, writerows
+from amt_index import AMTSeasonIndex
+from amt_journal import AMTEditJournal
 
 metadata = None
 
@@ -33,8 +42,17 @@ except ImportError:
     pass
 
 foldername = None
-blobfolder = None
-images = {}
+blobstore = None
+datafolder = None
+thumbnails = {}
+thumbnailbudget = 256 * 1024 * 1024
+thumbnailpoll = 30
+placeholders = {}
+journal = None
+compaction = None
+compactinterval = 300000
+taxonlookups = ThreadPoolExecutor(max_workers=2)
+pendingtaxa = {}
 
 canvas = None
 container = None
@@ -53,19 +71,25 @@ def track_completeness(foldername):
     if os.path.exists(foldername) and os.path.isdir(foldername):
         datafolder = os.path.join(foldername, "data")
         if os.path.exists(datafolder) and os.path.isdir(datafolder):
-            trackfile = os.path.join(datafolder, "amt_track.csv")
-            if os.path.exists(trackfile) and os.path.isfile(trackfile):
-                with open(trackfile, newline='') as tracklist:
-                    trackreader = csv.reader(tracklist, delimiter=',')
-                    for track in trackreader:
-                        if len(track) > 0 and len(track[1]) == 0:
-                            return track_incomplete
-                    return track_processed
+            if tableexists(datafolder, "track"):
+                if (readtable(datafolder, "track", ["identification"])["identification"] == "").any():
+                    return track_incomplete
+                return track_processed
             else:
                 return track_missing
     return track_na
 
 def find_folder_by_keyword(parent_folder, kw):
+    # A season index answers without opening every run once it has picked
+    # up any runs added or changed since it was last brought up to date
+    if AMTSeasonIndex.exists(parent_folder):
+        index = AMTSeasonIndex(parent_folder)
+        index.refresh()
+        folder = index.findrun(kw)
+        index.close()
+        if folder is not None:
+            return os.path.join(parent_folder, folder)
+
     p = re.compile("^20[-0-9]*$")
     foldername = ""
     candidate = None
@@ -116,6 +140,27 @@ def get_taxon(taxonName):
                     taxon[taxonheadings.index(rank)] = node["name"]
     return taxon
 
+def getthumbnails(blobsize):
+    # One cache, and one store in the data folder, for each thumbnail size
+    global thumbnails, blobstore, datafolder
+    if blobsize not in thumbnails:
+        thumbnails[blobsize] = AMTThumbnailCache(blobstore, AMTThumbnailStore(datafolder, blobsize), blobsize, thumbnailbudget)
+    return thumbnails[blobsize]
+
+def getplaceholder(blobsize):
+    global placeholders
+    if blobsize not in placeholders:
+        placeholders[blobsize] = PhotoImage(width=blobsize, height=blobsize)
+    return placeholders[blobsize]
+
+def pollthumbnails():
+    # Hands thumbnails decoded by the worker pools to the frames that asked
+    # for them, on the Tk thread
+    for cache in thumbnails.values():
+        for callback, name, image in cache.collect():
+            callback(name, image)
+    root.after(thumbnailpoll, pollthumbnails)
+
 def measure_progress():
     global tracks, progress
     if tracks is not None and len(tracks) > 0:
@@ -129,17 +174,56 @@ def measure_progress():
 
 
 
+class BlobTable:
+    # The blob table as read from the data folder. Tracks are created from a
+    # per-track summary and only build their lists of blob rows when they are
+    # first displayed or edited, so that large nights open quickly.
+    def __init__(self, datafolder):
+        self.frame = readtable(datafolder, "blob")
+        self.headings = list(self.frame.columns)
+        self.positions = self.frame.groupby("trackid", sort=False).indices
+
+    def gettracksummary(self):
+        # Returns (trackid, averagesize) in order of first appearance
+        sizes = self.frame.groupby("trackid", sort=False)["size"].mean()
+        return zip(sizes.index.tolist(), np.floor(np.sqrt(sizes.values)).astype(int).tolist())
+
+    def getrows(self, trackid):
+        rows = self.frame.iloc[self.positions[trackid]].astype(object)
+        return rows.where(rows.notna(), "").values.tolist()
+
+    def getframe(self, trackids, newtrackids):
+        # Returns the rows of the given tracks with their new track ids in
+        # one selection from the table
+        if len(trackids) == 0:
+            return self.frame.iloc[0:0]
+        positions = [self.positions[trackid] for trackid in trackids]
+        newids = [np.full(len(p), newtrackid) for p, newtrackid in zip(positions, newtrackids)]
+        return self.frame.iloc[np.concatenate(positions)].assign(trackid=np.concatenate(newids))
+
 class Track:
-    def __init__(self, id, blobs, identification, inatid, inatrg, inattaxon, deleted = False):
+    def __init__(self, id, blobs, identification, inatid, inatrg, inattaxon, deleted = False, averagesize = 1):
         self.id = id
-        self.blobs = blobs
+        # None until the blob rows are first needed
+        self.loadedblobs = blobs
         self.identification = identification
-        self.averagesize = 1
+        self.averagesize = averagesize
         self.inaturalist_id = inatid
         self.inaturalist_rg = inatrg
         self.inaturalist_taxon = inattaxon
         self.deleted = deleted
 
+    @property
+    def blobs(self):
+        if self.loadedblobs is None:
+            self.loadedblobs = blobtable.getrows(self.id)
+        return self.loadedblobs
+
+    def identify(self, identification):
+        if identification != self.identification:
+            self.identification = identification
+            journal.append("identify", track=self.id, identification=identification)
+
     def setaveragesize(self):
         total = 0
         for blob in self.blobs:
@@ -149,7 +233,7 @@ class Track:
 class TrackCanvas(Canvas):
     def __init__(self, container, tracks, headings, taxonnames, blobsize, rows, **kwargs):
         super().__init__(container, **kwargs)
-        self.newtrackid = -1
+        self.newtrackid = max(track.id for track in tracks) + 1
         self.tracktolink = -1
         self.sort = "start time"
         self.filter = None
@@ -179,6 +263,17 @@ class TrackCanvas(Canvas):
             self.tframes.append(tframe)
 
         self.focusontframe(self.tframes[0])
+        self.prefetchnextpage()
+
+    def prefetchnextpage(self):
+        # Loads the thumbnails for the page that nextpage would show
+        names = []
+        start = self.startindex + self.rows - 1
+        for i in self.displaytracks[start:start + self.rows]:
+            for blob in self.tracks[i].blobs:
+                if len(blob[self.iimagename]) > 0:
+                    names.append(blob[self.iimagename])
+        getthumbnails(self.blobsize).prefetch(names)
 
     def filtertracks(self, var, clear):
         if clear:
@@ -252,6 +347,7 @@ class TrackCanvas(Canvas):
         targettrack = self.tracks[self.displaytracks[self.startindex + targetindex]]
         target = targettrack.blobs
         trackid = targettrack.id
+        journal.append("join", target=trackid, source=sourcetrack.id)
         for blob in source:
             blob[itrackid] = trackid
             target.append(blob)
@@ -289,6 +385,7 @@ class TrackCanvas(Canvas):
                 if blobs[b][self.iblobid] == blobid:
                     blobindex = b 
                     break
+            journal.append("split", track=track.id, blob=int(blobid), new=self.newtrackid)
             while blobindex < len(blobs):
                 blob = blobs.pop(blobindex)
                 blob[itrackid] = self.newtrackid
@@ -296,7 +393,7 @@ class TrackCanvas(Canvas):
             track.setaveragesize()
             newtrack = Track(self.newtrackid, newblobs, track.identification, track.inaturalist_id, track.inaturalist_rg, track.inaturalist_taxon, track.deleted)
             newtrack.setaveragesize()
-            self.newtrackid -= 1
+            self.newtrackid += 1
             indexbeforeinsertion = self.displaytracks[self.startindex + trackindex]
             for i in range(len(self.displaytracks)):
                 if self.displaytracks[i] > indexbeforeinsertion:
@@ -358,6 +455,7 @@ class TrackCanvas(Canvas):
         self.resize(self.width)
         resizecontainer(None)
         self.focusontframe(self.tframes[0])
+        self.prefetchnextpage()
 
     def linktracks(self, trackid):
         trackindex = self.trackindexfromid(trackid)
@@ -463,11 +561,12 @@ class TrackFrame(ttk.Frame):
         self.parent.joinwithprevious(self.track.id)
 
     def splitat(self, blobid):
-        self.track.identification = self.taxonname.get()
+        self.track.identify(self.taxonname.get())
         self.parent.splitat(self.track.id, blobid)
 
     def deletetrack(self):
         self.track.deleted = not self.track.deleted
+        journal.append("delete", track=self.track.id, deleted=self.track.deleted)
         self.setstyle()  
 
     def sendtoinaturalist(self):
@@ -499,7 +598,7 @@ class TrackFrame(ttk.Frame):
 
     def settrack(self, track):
         if self.track is not None:
-            self.track.identification = self.taxonname.get()
+            self.track.identify(self.taxonname.get())
         self.track = track
         if track is None:
             self.label.configure(text = "")
@@ -524,18 +623,18 @@ class TrackFrame(ttk.Frame):
 
     def setidentification(self, identification):
         self.taxonname.set(identification)
-        self.track.identification = identification
+        self.track.identify(identification)
         return True
 
     def identificationchanged(self, input):
         if self.track is not None:
-            self.track.identification = input.strip()
-            if len(self.track.identification) > 0 and self.track.identification not in self.taxonnames:
-                taxonnames[self.track.identification] = get_taxon(self.track.identification)
+            self.track.identify(input.strip())
+            lookuptaxon(self.track.identification)
         return True
 
     def setinaturalistid(self, id):
         self.track.inaturalist_id = id
+        journal.append("inaturalist", track=self.track.id, id=id, rg=self.track.inaturalist_rg, taxon=self.track.inaturalist_taxon)
 
 class BlobFrame(ttk.Frame):
     def __init__(self, container, blobs, blobsize, iimagename, iblobid, odd, mode="SplitJoin", **kwargs):
@@ -553,6 +652,7 @@ class BlobFrame(ttk.Frame):
         self.mode = mode
         self.selected = []
         self.buttonlookup = {}
+        self.pending = None
         padding = str(self.pady) + " " + str(self.pady) + " " + str(self.padx) + " " + str(self.padx)
         if kwargs is None:
             kwargs = {}
@@ -561,35 +661,30 @@ class BlobFrame(ttk.Frame):
         self.loadblobs()
 
     def loadblobs(self):
-        global images, blobfolder
         first = True
         self.buttons = []
+        # The buttons only show images that are still referenced, and the
+        # cache may evict them
+        self.photos = []
+        # Thumbnails not in memory are shown as placeholders until the
+        # worker pool has decoded them - any still pending for the previous
+        # blobs are no longer wanted
+        if self.pending is not None:
+            self.pending.set()
+        self.pending = threading.Event()
+        self.buttonsbyname = {}
+        cache = getthumbnails(self.blobsize)
+        missing = []
         for widget in self.winfo_children():
             widget.destroy()
         for blob in self.blobs:
             if len(blob[self.iimagename]) > 0:
-                imagefile = os.path.join(blobfolder, blob[self.iimagename])
-                if imagefile in images:
-                    img = images[imagefile]
+                img = cache.getcached(blob[self.iimagename], ImageTk.PhotoImage)
+                if img is None:
+                    img = getplaceholder(self.blobsize)
+                    missing.append(blob[self.iimagename])
                 else:
-                    if len(images) > 5000:
-                        i = 0
-                        keys = []
-                        for k in images:
-                            keys.append(k)
-                            i += 1
-                            if i == 1000:
-                                break
-                        for k in keys:
-                            images.pop(k, None)
-
-                    img = Image.open(imagefile)
-                    size = img.size
-                    if size[0] > self.blobsize or size[1] > self.blobsize:
-                        scale = self.blobsize / (size[0] if size[0] > size[1] else size[1])
-                        img = img.resize((int(float(size[0])*scale),int(float(size[1])*scale)))
-                    img = ImageTk.PhotoImage(img)
-                    images[imagefile] = img
+                    self.photos.append(img)
                 if self.mode == "SplitJoin":
                     command = partial(self.splitjoin, -1 if first else blob[self.iblobid])
                 elif self.mode == "MultiSelect":
@@ -600,7 +695,16 @@ class BlobFrame(ttk.Frame):
                 first = False
                 self.buttons.append(button)
                 self.buttonlookup[blob[self.iblobid]] = button
+                self.buttonsbyname[blob[self.iimagename]] = button
         self.arrangeblobs()
+        cache.request(missing, self.pending, self.thumbnailready)
+
+    def thumbnailready(self, name, image):
+        button = self.buttonsbyname.get(name)
+        if button is not None and button.winfo_exists():
+            img = getthumbnails(self.blobsize).setdisplay(name, image, ImageTk.PhotoImage)
+            self.photos.append(img)
+            button.configure(image=img)
 
     def splitjoin(self, blobid):
         if blobid == -1:
@@ -669,15 +773,14 @@ class DetailsDialog:
         self.top.rowconfigure(0, weight=1)
 
     def showblob(self, index):
-        global blobfolder
+        global blobstore
         labeltext = ""
         blob = self.tframe.track.blobs[index]
         for i in range(len(self.tframe.track.blobs[index])):
             labeltext += self.tframe.headings[i] + ": " + str(blob[i]) + "\n"
         self.label.config(text=labeltext)
         if len(blob[self.tframe.iimagename]) > 0:
-            imagefile = os.path.join(blobfolder, blob[self.tframe.iimagename])
-            image = Image.open(imagefile)
+            image = Image.open(blobstore.open(blob[self.tframe.iimagename]))
             size = image.size
             if size[0] > 500 or size[1] > 500:
                 scale = 500 / (size[0] if size[0] > size[1] else size[1])
@@ -760,7 +863,7 @@ class iNaturalistDialog(ttk.Frame):
             for b in self.bframe.selected:
                 for i in range(len(self.blobs)):
                     if self.blobs[i][self.iblobid] == b:
-                        photoset.append(os.path.join(blobfolder, self.blobs[i][self.iimagename]))
+                        photoset.append(blobstore.open(self.blobs[i][self.iimagename]))
             if len(photoset) > 0:
                 response = pyinaturalist.create_observation(
                     species_guess=self.identification,
@@ -856,44 +959,178 @@ def on_mousewheel(event):
     global canvas
     canvas.yview_scroll(-int(event.delta/24), UNITS)
 
-def savetracks(datafolder, tracks, trackheadings, blobheadings, taxondictionary, taxonnames, taxonmaster):
-    with open(os.path.join(datafolder, "amt_track.csv"), 'w', newline='', encoding="utf8") as amttrackfile, open(os.path.join(datafolder, "amt_blob.csv"), 'w', newline='', encoding="utf8") as amtblobfile:
-        amttrackwriter = csv.writer(amttrackfile, delimiter=',')
-        amtblobwriter = csv.writer(amtblobfile, delimiter=',')
-        amttrackwriter.writerow(trackheadings)
-        amtblobwriter.writerow(blobheadings)
-        trackid = 1
-        for track in tracks:
-            if not track.deleted:
-                amttrackwriter.writerow([str(trackid), track.identification, track.inaturalist_id, track.inaturalist_rg, track.inaturalist_taxon])
-                for blob in track.blobs:
-                    blob[itrackid] = trackid
-                    amtblobwriter.writerow(blob)
-                trackid += 1
-    if taxondictionary is not None and len(taxonnames) >= len(taxonmaster):
-        save = True
-        for track in tracks:
-            if track.identification not in taxonmaster:
-                if track.identification not in taxonnames:
-                    taxonmaster[track.identification] = get_taxon(track.identification)
-                else:
-                    taxonmaster[track.identification] = taxonnames[track.identification]
-                save = True
-        if save:
-            taxon_keys = list(taxonmaster.keys())
-            taxon_keys.sort()
+def backuptables(datafolder):
+    # Copies the tables as they were before this session's first save
+    timestamp = datetime.now().strftime("%Y%m%d%H%M%S")
+    for name in ["blob", "track"]:
+        for format in gettableformats(datafolder, name):
+            shutil.copyfile(tablepath(datafolder, name, format), os.path.join(datafolder, "amt_" + name + "_backup_" + timestamp + "." + format))
+
+def replayjournal(tracks, operations):
+    # Applies edits saved in the journal but not yet in the tables. Each
+    # operation is skipped if its tracks are not as it expects, as when the
+    # tables already reflect it.
+    tracksbyid = {track.id: track for track in tracks}
+    for operation in operations:
+        op = operation["op"]
+        track = tracksbyid.get(operation["target"] if op == "join" else operation["track"])
+        if track is None:
+            continue
+        if op == "identify":
+            track.identification = operation["identification"]
+        elif op == "delete":
+            track.deleted = operation["deleted"]
+        elif op == "inaturalist":
+            track.inaturalist_id = operation["id"]
+            track.inaturalist_rg = operation["rg"]
+            track.inaturalist_taxon = operation["taxon"]
+        elif op == "split" and operation["new"] not in tracksbyid:
+            blobids = [blob[iblobid] for blob in track.blobs]
+            if operation["blob"] in blobids:
+                b = blobids.index(operation["blob"])
+                newblobs = track.blobs[b:]
+                del track.blobs[b:]
+                for blob in newblobs:
+                    blob[itrackid] = operation["new"]
+                track.setaveragesize()
+                newtrack = Track(operation["new"], newblobs, track.identification, track.inaturalist_id, track.inaturalist_rg, track.inaturalist_taxon, track.deleted)
+                newtrack.setaveragesize()
+                tracks.insert(tracks.index(track) + 1, newtrack)
+                tracksbyid[newtrack.id] = newtrack
+        elif op == "join" and operation["source"] in tracksbyid:
+            source = tracksbyid.pop(operation["source"])
+            for blob in source.blobs:
+                blob[itrackid] = track.id
+                track.blobs.append(blob)
+            track.setaveragesize()
+            if len(track.inaturalist_id) == 0:
+                track.inaturalist_id = source.inaturalist_id
+                track.inaturalist_rg = source.inaturalist_rg
+                track.inaturalist_taxon = source.inaturalist_taxon
+            tracks.remove(source)
+
+def gettables(tracks, trackheadings, blobheadings):
+    # Returns the track rows and blob frame for the tables as they stand.
+    # Tracks that were never displayed are copied from the blob table
+    # without building their rows.
+    trackrows = []
+    unloaded = []
+    blobrows = []
+    positions = {}
+    for track in tracks:
+        if not track.deleted:
+            positions[track.id] = len(trackrows)
+            trackrows.append([track.id, track.identification, track.inaturalist_id, track.inaturalist_rg, track.inaturalist_taxon])
+            if track.loadedblobs is None:
+                unloaded.append(track.id)
+            else:
+                blobrows.extend(track.loadedblobs)
+    # A stable sort on the position of each track keeps the order of the
+    # tracks and of the blobs within them
+    blobframe = pandas.concat([blobtable.getframe(unloaded, unloaded), pandas.DataFrame(blobrows, columns=blobheadings)], ignore_index=True)
+    blobframe = blobframe.iloc[np.argsort(blobframe["trackid"].map(positions).values, kind="stable")].reset_index(drop=True)
+    return trackrows, blobframe
+
+def writetables(datafolder, trackheadings, trackrows, blobframe, count):
+    # Writes the tables in whichever formats the folder holds, with the
+    # track table following the blob table, then trims the first count
+    # operations from the journal
+    global backedup
+    if not backedup:
+        backuptables(datafolder)
+        backedup = True
+    formats = gettableformats(datafolder, "blob")
+    writetable(datafolder, "blob", blobframe, formats)
+    writerows(datafolder, "track", trackheadings, trackrows, formats)
+    journal.trim(count)
+    runfolder = os.path.dirname(os.path.normpath(datafolder))
+    if AMTSeasonIndex.exists(os.path.dirname(runfolder)):
+        index = AMTSeasonIndex(os.path.dirname(runfolder))
+        index.updaterun(os.path.basename(runfolder))
+        index.close()
+
+def compact(datafolder, tracks, trackheadings, blobheadings, wait = False):
+    # Brings the tables up to date with the journal. The tables are taken
+    # from the tracks here and written by a background thread unless wait
+    # is set; edits made meanwhile stay in the journal for next time.
+    global compaction
+    if compaction is not None:
+        if not wait and compaction.is_alive():
+            return
+        compaction.join()
+    count = len(journal)
+    if count == 0:
+        return
+    trackrows, blobframe = gettables(tracks, trackheadings, blobheadings)
+    compaction = threading.Thread(target=writetables, args=(datafolder, trackheadings, trackrows, blobframe, count))
+    compaction.start()
+    if wait:
+        compaction.join()
+
+def autocompact():
+    compact(datafolder, tracks, trackheadings, headings)
+    root.after(compactinterval, autocompact)
+
+def lookuptaxon(name):
+    # Looks the name up in the Catalogue of Life in the background
+    if len(name) > 0 and name not in taxonnames and name not in pendingtaxa:
+        pendingtaxa[name] = taxonlookups.submit(get_taxon, name)
+
+def collecttaxa(wait = False):
+    for name, lookup in list(pendingtaxa.items()):
+        if wait or lookup.done():
+            del pendingtaxa[name]
+            try:
+                taxonnames[name] = lookup.result()
+            except (requests.RequestException, ValueError, KeyError, IndexError, TypeError) as e:
+                # Left out of the dictionary and looked up again next time -
+                # KeyError and the like come from results that lack the
+                # expected classification
+                print("Failed to look up " + name + ": " + str(e))
+
+def savetaxa(taxondictionary, taxonnames, taxonmaster, wait = False):
+    # Adds the identifications used in this folder to the taxon dictionary,
+    # rewriting it only if names have been added. Names still being looked
+    # up are added by a later save unless wait is set.
+    global taxonbackedup
+    if taxondictionary is None:
+        return
+    collecttaxa()
+    for track in tracks:
+        lookuptaxon(track.identification)
+    collecttaxa(wait)
+    added = False
+    for track in tracks:
+        if track.identification not in taxonmaster and track.identification in taxonnames:
+            taxonmaster[track.identification] = taxonnames[track.identification]
+            added = True
+    if added:
+        if not taxonbackedup and os.path.isfile(taxondictionary):
             shutil.copyfile(taxondictionary, taxondictionary + "." + datetime.now().strftime("%Y%m%d%H%M%S") + ".save")
-            with open(taxondictionary, 'w', newline='', encoding="utf8") as taxonlist:
-                taxonwriter = csv.writer(taxonlist, delimiter=',')
-                taxonwriter.writerow(taxonheadings)
-                for name in taxon_keys:
-                    taxonwriter.writerow(taxonmaster[name])
+            taxonbackedup = True
+        taxon_keys = list(taxonmaster.keys())
+        taxon_keys.sort()
+        temppath = taxondictionary + ".tmp"
+        with open(temppath, 'w', newline='', encoding="utf8") as taxonlist:
+            taxonwriter = csv.writer(taxonlist, delimiter=',')
+            taxonwriter.writerow(taxonheadings)
+            for name in taxon_keys:
+                taxonwriter.writerow(taxonmaster[name])
+        os.replace(temppath, taxondictionary)
 
+def savetracks(datafolder, tracks, trackheadings, blobheadings, taxondictionary, taxonnames, taxonmaster):
+    # Edits are already in the journal, so saving only makes sure they are
+    # on disk and starts bringing the tables up to date in the background
+    journal.sync()
+    compact(datafolder, tracks, trackheadings, blobheadings)
+    savetaxa(taxondictionary, taxonnames, taxonmaster)
     global progress
     progress.config(text = measure_progress())
 
 
-blobsbyid = {}
+blobtable = None
+backedup = False
+taxonbackedup = False
 tracks = []
 identifications = {}
 inaturalistrecords = {}
@@ -926,70 +1163,48 @@ if "@" in foldername:
 
 datafolder = os.path.join(foldername, "data")
 if os.path.isdir(datafolder):
-    blobfile = os.path.join(datafolder, "amt_blob.csv")
-    if os.path.isfile(blobfile):
-        shutil.copyfile(blobfile, os.path.join(datafolder, "amt_blob_backup_" + datetime.now().strftime("%Y%m%d%H%M%S") + ".csv"))
-
-        trackfile = os.path.join(datafolder, "amt_track.csv")
-        if os.path.isfile(trackfile):
-            shutil.copyfile(trackfile, os.path.join(datafolder, "amt_track_backup_" + datetime.now().strftime("%Y%m%d%H%M%S") + ".csv"))
-            with open(trackfile, newline='') as tracklist:
-                trackreader = csv.reader(tracklist, delimiter=',')
-                headings = next(trackreader)
-                iid = headings.index("id")
-                iidentification = headings.index("identification")
-                if "inaturalistID" in headings:
-                    iinatid = headings.index("inaturalistID")
-                    iinatrg = headings.index("inaturalistRG")
-                    iinattaxon = headings.index("inaturalistTaxon")
-                else:
-                    iinatid = -1
-                    iinatrg = -1
-                    iinattaxon = -1
-                for track in trackreader:
-                    identifications[track[iid]] = track[iidentification]
-                    if iinatid >= 0 and len(track[iinatid]) > 0:
-                        inaturalistrecords[track[iid]] = [track[iinatid], track[iinatrg] if iinatrg >= 0 else False, track[iinattaxon] if iinattaxon >=0 else ""]
-
-        with open(blobfile, newline='') as bloblist:
-            blobreader = csv.reader(bloblist, delimiter=',')
-            headings = next(blobreader)
-            itrackid = headings.index("trackid")
-            iblobsize = headings.index("size")
-
-            for blob in blobreader:
-                trackid = blob[itrackid]
-                if trackid in blobsbyid:
-                    blobs = blobsbyid[trackid]
-                else:
-                    blobs = []
-                    blobsbyid[trackid] = blobs
-                    inat = ["", False, ""]
-                    if trackid in identifications:
-                        identification = identifications[trackid]
-                        if trackid in inaturalistrecords:
-                            inat = inaturalistrecords[trackid]
-                    else:
-                        identification = ""
-                    tracks.append(Track(trackid, blobs, identification, inat[0], inat[1], inat[2]))
-                blobs.append(blob)
-
-            blobfolder = os.path.join(datafolder, "blob")
-
-            if len(tracks) == 0:
-                print("No tracks to edit")
-                exit()
-
-            for track in tracks:
-                track.setaveragesize()
+    if tableexists(datafolder, "blob"):
+        if tableexists(datafolder, "track"):
+            tracktable = readtable(datafolder, "track")
+            for track in tracktable.itertuples(index=False):
+                identifications[track.id] = track.identification
+                if "inaturalistID" in tracktable.columns and len(track.inaturalistID) > 0:
+                    inaturalistrecords[track.id] = [track.inaturalistID, track.inaturalistRG if "inaturalistRG" in tracktable.columns else False, track.inaturalistTaxon if "inaturalistTaxon" in tracktable.columns else ""]
+
+        blobtable = BlobTable(datafolder)
+        headings = blobtable.headings
+        itrackid = headings.index("trackid")
+        iblobid = headings.index("id")
+        iblobsize = headings.index("size")
+
+        for trackid, averagesize in blobtable.gettracksummary():
+            inat = ["", False, ""]
+            if trackid in identifications:
+                identification = identifications[trackid]
+                if trackid in inaturalistrecords:
+                    inat = inaturalistrecords[trackid]
+            else:
+                identification = ""
+            tracks.append(Track(trackid, None, identification, inat[0], inat[1], inat[2], averagesize = averagesize))
+
+        journal = AMTEditJournal(datafolder)
+        replayjournal(tracks, journal.operations)
+
+        blobstore = AMTBlobStore(datafolder)
+
+        if len(tracks) == 0:
+            print("No tracks to edit")
+            exit()
     else:
-        print("Missing blob list: " + blobfile)
+        print("Missing blob list: " + tablepath(datafolder, "blob"))
         exit()
 else:
     print("Data folder not found: " + datafolder)
     exit()
 
 root = Tk()
+root.after(thumbnailpoll, pollthumbnails)
+root.after(compactinterval, autocompact)
 root.title("TrackEditor: " + foldername)
 
 s = ttk.Style()
@@ -1048,4 +1263,11 @@ container.columnconfigure(0, weight=1)
 container.rowconfigure(1, weight=1)
 container.rowconfigure(1, weight=1)
 
-root.mainloop()
\ No newline at end of file
+root.mainloop()
+
+for cache in thumbnails.values():
+    cache.close()
+compact(datafolder, tracks, trackheadings, headings, wait = True)
+savetaxa(taxondictionary, taxonnames, taxonmaster, wait = True)
+taxonlookups.shutdown()
+journal.close()
\ No newline at end of file
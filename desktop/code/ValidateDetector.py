@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+ValidateDetector.py - Compare blob detection using the configured region of interest and pyramid level against the full-resolution path
+
+Runs two AMTBlobDetector instances over the images in a folder - one using the blobdetector settings from the configuration file and one with "pyramid", "roi" and "roithreshold" removed - and reports how closely the detected rectangles agree. Rectangles are paired greedily by intersection over union (IoU) and a pair only counts as a match if its IoU is at least the tolerance (default 0.5).
+
+Usage: python ValidateDetector.py configfile directorypath [tolerance]
+"""
+__author__ = "Donald Hobern"
+__copyright__ = "Copyright 2021, Donald Hobern"
+__credits__ = ["Donald Hobern"]
+__license__ = "CC-BY-4.0"
+__version__ = "1.0.0"
+__maintainer__ = "Donald Hobern"
+__email__ = "dhobern@gmail.com"
+__status__ = "Production"
+
+import os
+import sys
+import cv2
+import copy
+import json
+import time
+
+from amt_blobdetector import AMTBlobDetector
+
+def getiou(r1, r2):
+    x1, y1, w1, h1 = r1
+    x2, y2, w2, h2 = r2
+    w = min(x1 + w1, x2 + w2) - max(x1, x2)
+    h = min(y1 + h1, y2 + h2) - max(y1, y2)
+    if w <= 0 or h <= 0:
+        return 0
+    intersection = w * h
+    return intersection / (w1 * h1 + w2 * h2 - intersection)
+
+def matchrects(reference, candidate, tolerance):
+    pairs = []
+    for i in range(len(reference)):
+        for j in range(len(candidate)):
+            iou = getiou(reference[i], candidate[j])
+            if iou >= tolerance:
+                pairs.append((iou, i, j))
+    pairs.sort(reverse=True)
+    usedreference = set()
+    usedcandidate = set()
+    matches = []
+    for iou, i, j in pairs:
+        if i not in usedreference and j not in usedcandidate:
+            usedreference.add(i)
+            usedcandidate.add(j)
+            matches.append((iou, reference[i], candidate[j]))
+    return matches
+
+def getrects(blobs):
+    return [(b.x, b.y, b.w, b.h) for b in blobs]
+
+if len(sys.argv) < 3:
+    print("Usage: python ValidateDetector.py configfile directorypath [tolerance]")
+    sys.exit()
+
+with open(sys.argv[1]) as file:
+    conf = json.load(file)
+foldername = sys.argv[2]
+tolerance = float(sys.argv[3]) if len(sys.argv) > 3 else 0.5
+
+referenceconf = copy.deepcopy(conf)
+for key in ["pyramid", "roi", "roithreshold"]:
+    referenceconf["blobdetector"].pop(key, None)
+
+reference = AMTBlobDetector(referenceconf)
+candidate = AMTBlobDetector(conf)
+
+frames = 0
+referencecount = 0
+candidatecount = 0
+matchcount = 0
+totaliou = 0
+maxoffset = 0
+referencetime = 0
+candidatetime = 0
+
+for filename in sorted(os.listdir(foldername)):
+    if filename.lower().endswith("jpg"):
+        image = cv2.imread(os.path.join(foldername, filename))
+        if image is None:
+            continue
+        frames += 1
+
+        start = time.perf_counter()
+        _, referenceblobs, _ = reference.findblobs(image, frames)
+        referencetime += time.perf_counter() - start
+        start = time.perf_counter()
+        _, candidateblobs, _ = candidate.findblobs(image, frames)
+        candidatetime += time.perf_counter() - start
+
+        referencerects = getrects(referenceblobs)
+        candidaterects = getrects(candidateblobs)
+        matches = matchrects(referencerects, candidaterects, tolerance)
+        referencecount += len(referencerects)
+        candidatecount += len(candidaterects)
+        matchcount += len(matches)
+        for iou, r1, r2 in matches:
+            totaliou += iou
+            offset = max(abs(r1[0] + r1[2] / 2 - r2[0] - r2[2] / 2), abs(r1[1] + r1[3] / 2 - r2[1] - r2[3] / 2))
+            if offset > maxoffset:
+                maxoffset = offset
+        print(f"{filename}: {len(referencerects)} full resolution, {len(candidaterects)} configured, {len(matches)} matched")
+
+if frames > 0:
+    print(f"Frames: {frames}")
+    print(f"Full resolution blobs: {referencecount} ({frames / referencetime:.2f} frames/s)")
+    print(f"Configured blobs: {candidatecount} ({frames / candidatetime:.2f} frames/s)")
+    print(f"Matched at IoU >= {tolerance}: {matchcount}")
+    print(f"Missed: {referencecount - matchcount} ({(referencecount - matchcount) / referencecount * 100 if referencecount > 0 else 0:.1f}%)")
+    print(f"Extra: {candidatecount - matchcount} ({(candidatecount - matchcount) / candidatecount * 100 if candidatecount > 0 else 0:.1f}%)")
+    if matchcount > 0:
+        print(f"Mean IoU of matches: {totaliou / matchcount:.3f}")
+        print(f"Maximum centre offset of matches: {maxoffset:.1f} pixels")
+else:
+    print("No images found in " + foldername)
@@ -0,0 +1,146 @@
+import cv2
+import numpy as np
+from abc import ABC, abstractmethod
+
+# Background models for AMTBlobDetector. Each model is given the detector's
+# initial background image and then one grayscale image per frame, and
+# returns a foreground mask (255 for foreground, 0 for background) that the
+# detector thresholds as it did the original MOG2 output. A learning rate of 0
+# leaves the model unchanged and -1 lets the model use its own rate.
+#
+# Approximate model sizes for a 3840 x 2160 frame (8.3 megapixels):
+#  - AMTMOG2Model - five Gaussians of three floats per pixel, about 61 bytes
+#    per pixel or roughly 500 MB per model
+#  - AMTAverageModel - a float32 average plus a uint8 copy, 5 bytes per pixel
+#    or about 41 MB
+#  - AMTMedianModel - a uint8 median plus two uint8 comparison masks, 3 bytes
+#    per pixel or about 25 MB
+# The benchmark (python -m amt_benchmark) reports the size and the time per
+# frame of the models in use.
+
+
+class AMTBackgroundModel(ABC):
+    def __init__(self, conf):
+        self.conf = conf
+        self.shape = None
+
+    @abstractmethod
+    def initialise(self, background):
+        pass
+
+    @abstractmethod
+    def apply(self, image, mask, rate):
+        pass
+
+    def replay(self, image, index):
+        # Brings the model up to date with an image processed before a
+        # checkpoint, where index is its position in the original run
+        self.apply(image, None, -1)
+
+    @abstractmethod
+    def getmemory(self):
+        pass
+
+    def getpixels(self):
+        return self.shape[0] * self.shape[1] if self.shape is not None else 0
+
+
+class AMTMOG2Model(AMTBackgroundModel):
+    def __init__(self, conf):
+        super().__init__(conf)
+        history = conf["history"] if "history" in conf else 500
+        varthreshold = conf["varthreshold"] if "varthreshold" in conf else 16
+        shadows = conf["shadows"] if "shadows" in conf else True
+        self.subtractor = cv2.createBackgroundSubtractorMOG2(history, varthreshold, shadows)
+
+    def initialise(self, background):
+        self.shape = background.shape
+        self.subtractor.apply(background)
+
+    def apply(self, image, mask, rate):
+        if mask is None:
+            return self.subtractor.apply(image, learningRate = rate)
+        return self.subtractor.apply(image, mask, rate)
+
+    def replay(self, image, index):
+        # Uses the rate MOG2 chose for the image in the original run
+        rate = 1.0 / min(2 * (index + 1), self.subtractor.getHistory())
+        self.subtractor.apply(image, learningRate = rate)
+
+    def getmemory(self):
+        return self.getpixels() * (self.subtractor.getNMixtures() * 3 * 4 + 1)
+
+
+class AMTAverageModel(AMTBackgroundModel):
+    # Exponential running average - "alpha" is the weight given to each new
+    # image and "difference" the change in gray level counted as foreground
+    def __init__(self, conf):
+        super().__init__(conf)
+        self.alpha = conf["alpha"] if "alpha" in conf else 0.02
+        self.difference = conf["difference"] if "difference" in conf else 16
+        self.average = None
+        self.current = None
+
+    def initialise(self, background):
+        self.shape = background.shape
+        self.average = background.astype(np.float32)
+        self.current = background.copy()
+
+    def apply(self, image, mask, rate):
+        mask = cv2.absdiff(image, self.current, dst = mask)
+        cv2.threshold(mask, self.difference, 255, cv2.THRESH_BINARY, dst = mask)
+        alpha = self.alpha if rate < 0 else rate
+        if alpha > 0:
+            cv2.accumulateWeighted(image, self.average, alpha)
+            cv2.convertScaleAbs(self.average, dst = self.current)
+        return mask
+
+    def getmemory(self):
+        return self.getpixels() * 5
+
+
+class AMTMedianModel(AMTBackgroundModel):
+    # Approximate running median - each pixel moves "step" gray levels
+    # towards every new image, so it settles on the median of recent values
+    # and ignores brief changes. "difference" is as for AMTAverageModel.
+    def __init__(self, conf):
+        super().__init__(conf)
+        self.step = conf["step"] if "step" in conf else 1
+        self.difference = conf["difference"] if "difference" in conf else 16
+        self.median = None
+        self.higher = None
+        self.lower = None
+
+    def initialise(self, background):
+        self.shape = background.shape
+        self.median = background.copy()
+        self.higher = np.empty(background.shape, np.uint8)
+        self.lower = np.empty(background.shape, np.uint8)
+
+    def apply(self, image, mask, rate):
+        mask = cv2.absdiff(image, self.median, dst = mask)
+        cv2.threshold(mask, self.difference, 255, cv2.THRESH_BINARY, dst = mask)
+        if rate != 0:
+            cv2.compare(image, self.median, cv2.CMP_GT, dst = self.higher)
+            cv2.compare(image, self.median, cv2.CMP_LT, dst = self.lower)
+            cv2.add(self.median, self.step, dst = self.median, mask = self.higher)
+            cv2.subtract(self.median, self.step, dst = self.median, mask = self.lower)
+        return mask
+
+    def getmemory(self):
+        return self.getpixels() * 3
+
+
+class AMTBackgroundModelFactory:
+    def create(self, conf):
+        classname = conf["class"] if "class" in conf else "AMTMOG2Model"
+        if classname == "AMTMOG2Model":
+            model = AMTMOG2Model(conf)
+        elif classname == "AMTAverageModel":
+            model = AMTAverageModel(conf)
+        elif classname == "AMTMedianModel":
+            model = AMTMedianModel(conf)
+        else:
+            print("No background model class " + classname + " defined")
+            return None
+        return model
@@ -0,0 +1,4 @@
+# Benchmarks for the segmentation pipeline. synthetic renders nights of
+# images with known moth positions, stages times each step of SegmentImages
+# on such a night and scoring compares the resulting tracks with the ground
+# truth. Run "python -m amt_benchmark" from the code folder - see __main__.
@@ -0,0 +1,93 @@
+"""
+amt_benchmark - Time each stage of segmentation on a synthetic night and score the resulting tracks
+
+Renders a synthetic night (see amt_benchmark/synthetic.py) and runs the per-frame steps of SegmentImages over it - decode, background (background subtraction), contours, reportcolors, contrast (contrast and border checks), tracking and write (crop encoding and CSV formatting) - recording wall and CPU time for each. The tracks are then compared with the known moth positions. The results are printed and saved as JSON so that runs from different commits can be compared.
+
+Usage: python -m amt_benchmark configfile [reportfile [baselinefile]]
+
+The blobdetector, tracker and threshold settings are taken from the configuration file, as is an optional "benchmark" section for the synthetic night: "width" and "height" (default 3840 x 2160), "frames" (60), "density" (average number of moths on the sheet, 20), "stationary" (share of moths that never move, 0.5), "drift" (fractional change in sheet brightness over the night, 0.1), "interval" (seconds between images, 10) and "seed" (1). The report is written to amt_benchmark.json unless another file is given. If a baseline report is given, per-stage times are compared with it.
+
+To compare the background models (see amt_background.py) on the same night, use python -m amt_benchmark.models configfile [reportfile]
+
+To time reduced-resolution decoding (see amt_decode.py) against a full decode and resize on the same night, use python -m amt_benchmark.decode configfile [reportfile]
+
+To save a synthetic night as a run folder for SegmentImages, with the ground truth in amt_truth.csv, use python -m amt_benchmark.synthetic configfile folder
+"""
+
+import os
+import sys
+import cv2
+import json
+import platform
+import subprocess
+import numpy as np
+from datetime import datetime
+
+from amt_timing import AMTStageTimer
+from amt_benchmark.synthetic import AMTSyntheticNight
+from amt_benchmark.stages import runstages
+from amt_benchmark.scoring import scoretracks
+
+def getcommit():
+    try:
+        folder = os.path.dirname(os.path.abspath(__file__))
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=folder, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return ""
+
+def printreport(report, baseline):
+    print(f"{report['width']}x{report['height']}, {report['frames']} frames, {report['fps']:.2f} frames/s")
+    print(f"Background models {' and '.join(report['models'])}, {report['modelmemory'] / 1048576:.1f} MB")
+    print(f"{'Stage':<14}{'Wall s':>10}{'CPU s':>10}{'Mean ms':>10}{'Max ms':>10}{'Baseline':>10}{'Ratio':>8}")
+    for name, stage in report["stages"].items():
+        line = f"{name:<14}{stage['wall']:>10.2f}{stage['cpu']:>10.2f}{stage['mean']:>10.1f}{stage['max']:>10.1f}"
+        if baseline is not None and name in baseline["stages"]:
+            previous = baseline["stages"][name]["mean"]
+            ratio = stage["mean"] / previous if previous > 0 else 0
+            line += f"{previous:>10.1f}{ratio:>8.2f}"
+        print(line)
+    accuracy = report["accuracy"]
+    print(f"Recall {accuracy['recall']:.3f} (moving {accuracy['recallmoving']:.3f}, stationary {accuracy['recallstationary']:.3f}), precision {accuracy['precision']:.3f}")
+    print(f"MOTA {accuracy['mota']:.3f}, {accuracy['switches']} identity switches, purity {accuracy['purity']:.3f}, fragmentation {accuracy['fragmentation']:.2f}, mean IoU {accuracy['meaniou']:.3f}")
+    if baseline is not None:
+        print(f"Baseline {baseline['commit']}: {baseline['fps']:.2f} frames/s, MOTA {baseline['accuracy']['mota']:.3f}")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m amt_benchmark configfile [reportfile [baselinefile]]")
+        sys.exit(1)
+
+    with open(sys.argv[1]) as f:
+        config = json.load(f)
+    reportfile = sys.argv[2] if len(sys.argv) > 2 else "amt_benchmark.json"
+    baseline = None
+    if len(sys.argv) > 3:
+        with open(sys.argv[3]) as f:
+            baseline = json.load(f)
+
+    night = AMTSyntheticNight(config["benchmark"] if "benchmark" in config else None)
+    timer = AMTStageTimer()
+    detections, truths, detector = runstages(config, night, timer)
+
+    stages = timer.summary()
+    wall = sum(stage["wall"] for stage in stages.values())
+    report = {
+        "commit": getcommit(),
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": np.__version__,
+        "width": night.width,
+        "height": night.height,
+        "frames": night.frames,
+        "night": vars(night) | { "start": night.start.isoformat() },
+        "models": [type(detector.model_bgnd).__name__, type(detector.model_prev).__name__],
+        "modelmemory": detector.getmemory(),
+        "fps": night.frames / wall if wall > 0 else 0,
+        "stages": stages,
+        "accuracy": scoretracks(detections, truths)
+    }
+    with open(reportfile, "w") as f:
+        json.dump(report, f, indent=3)
+
+    printreport(report, baseline)
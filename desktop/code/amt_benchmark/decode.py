@@ -0,0 +1,75 @@
+"""
+amt_benchmark.decode - Compare reduced-resolution JPEG decoding with a full decode and resize
+
+Saves the frames of the benchmark night as JPEG files and, for each output scale, times reading them with amt_decode.readimage (which decodes at 1/2, 1/4 or 1/8 size where it can) against cv2.imread at full size followed by cv2.resize. The mean absolute difference between the two results is reported as a check on quality.
+
+Usage: python -m amt_benchmark.decode configfile [reportfile]
+
+The synthetic night is set by the "benchmark" section of the configuration file (see python -m amt_benchmark) and the report is written to amt_decode.json unless another file is given.
+"""
+
+import os
+import sys
+import cv2
+import json
+import time
+import tempfile
+import numpy as np
+
+from amt_decode import readimage
+from amt_benchmark.synthetic import AMTSyntheticNight
+
+scales = [ 1.0, 0.5, 0.3, 0.25, 0.125 ]
+
+def runscale(filepaths, sourcesize, scale):
+    size = (int(sourcesize[0] * scale), int(sourcesize[1] * scale))
+    full = 0
+    reduced = 0
+    difference = 0
+    for filepath in filepaths:
+        start = time.perf_counter()
+        expected = cv2.imread(filepath)
+        if scale != 1.0:
+            expected = cv2.resize(expected, size, interpolation=cv2.INTER_AREA)
+        full += time.perf_counter() - start
+        start = time.perf_counter()
+        image = readimage(filepath, sourcesize, size)
+        reduced += time.perf_counter() - start
+        difference += np.mean(cv2.absdiff(expected, image))
+    count = len(filepaths)
+    return {
+        "scale": scale,
+        "width": size[0],
+        "height": size[1],
+        "full": 1000 * full / count,
+        "reduced": 1000 * reduced / count,
+        "speedup": full / reduced if reduced > 0 else 0,
+        "difference": difference / count
+    }
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m amt_benchmark.decode configfile [reportfile]")
+        sys.exit(1)
+
+    with open(sys.argv[1]) as f:
+        config = json.load(f)
+    reportfile = sys.argv[2] if len(sys.argv) > 2 else "amt_decode.json"
+
+    night = AMTSyntheticNight(config["benchmark"] if "benchmark" in config else None)
+    with tempfile.TemporaryDirectory() as folder:
+        filepaths = []
+        for filename, image, truth in night:
+            filepath = os.path.join(folder, filename)
+            cv2.imwrite(filepath, image)
+            filepaths.append(filepath)
+        results = [runscale(filepaths, (night.width, night.height), scale) for scale in scales]
+
+    with open(reportfile, "w") as f:
+        json.dump(results, f, indent=3)
+
+    print(f"{night.width}x{night.height}, {night.frames} frames")
+    print(f"{'Scale':>8}{'Output':>12}{'Full ms':>10}{'Reduced ms':>12}{'Speedup':>9}{'Mean diff':>11}")
+    for result in results:
+        output = str(result["width"]) + "x" + str(result["height"])
+        print(f"{result['scale']:>8.3f}{output:>12}{result['full']:>10.1f}{result['reduced']:>12.1f}{result['speedup']:>9.2f}{result['difference']:>11.2f}")
@@ -0,0 +1,58 @@
+"""
+amt_benchmark.models - Compare the background models available to AMTBlobDetector
+
+Runs the benchmark night once for each background model class, using that class for both the reference and the recent model with any other settings from the configuration file, and reports the memory held by the models, the background stage time per frame, the overall frame rate and tracking accuracy for each.
+
+Usage: python -m amt_benchmark.models configfile [reportfile]
+
+The report is written to amt_models.json unless another file is given.
+"""
+
+import sys
+import copy
+import json
+
+from amt_timing import AMTStageTimer
+from amt_benchmark.synthetic import AMTSyntheticNight
+from amt_benchmark.stages import runstages
+from amt_benchmark.scoring import scoretracks
+
+modelclasses = [ "AMTMOG2Model", "AMTAverageModel", "AMTMedianModel" ]
+
+def runmodel(config, classname):
+    config = copy.deepcopy(config)
+    detector = config["blobdetector"]
+    for key in [ "recentmodel", "referencemodel" ]:
+        model = detector[key] if key in detector else {}
+        model["class"] = classname
+        detector[key] = model
+    night = AMTSyntheticNight(config["benchmark"] if "benchmark" in config else None)
+    timer = AMTStageTimer()
+    detections, truths, detector = runstages(config, night, timer)
+    stages = timer.summary()
+    wall = sum(stage["wall"] for stage in stages.values())
+    return {
+        "model": classname,
+        "memory": detector.getmemory(),
+        "background": stages["background"]["mean"],
+        "fps": night.frames / wall if wall > 0 else 0,
+        "accuracy": scoretracks(detections, truths)
+    }
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python -m amt_benchmark.models configfile [reportfile]")
+        sys.exit(1)
+
+    with open(sys.argv[1]) as f:
+        config = json.load(f)
+    reportfile = sys.argv[2] if len(sys.argv) > 2 else "amt_models.json"
+
+    results = [runmodel(config, classname) for classname in modelclasses]
+    with open(reportfile, "w") as f:
+        json.dump(results, f, indent=3)
+
+    print(f"{'Model':<18}{'Memory MB':>10}{'Stage ms':>10}{'Frames/s':>10}{'Recall':>8}{'Precision':>10}{'MOTA':>8}")
+    for result in results:
+        accuracy = result["accuracy"]
+        print(f"{result['model']:<18}{result['memory'] / 1048576:>10.1f}{result['background']:>10.1f}{result['fps']:>10.2f}{accuracy['recall']:>8.3f}{accuracy['precision']:>10.3f}{accuracy['mota']:>8.3f}")
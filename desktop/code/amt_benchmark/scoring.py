@@ -0,0 +1,86 @@
+# Tracking accuracy against the ground truth of a synthetic night. Blobs are
+# paired with moths frame by frame, greedily by intersection over union, and
+# the pairs are then followed through the night to count identity switches -
+# a moth whose blobs move from one track to another. MOTA is the CLEAR MOT
+# accuracy, 1 - (missed + extra + switches) / moths.
+
+
+def getiou(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    w = min(ax + aw, bx + bw) - max(ax, bx)
+    h = min(ay + ah, by + bh) - max(ay, by)
+    if w <= 0 or h <= 0:
+        return 0
+    overlap = w * h
+    return overlap / (aw * ah + bw * bh - overlap)
+
+def matchframe(detections, truth, tolerance):
+    pairs = []
+    for i in range(len(detections)):
+        for j in range(len(truth)):
+            iou = getiou(detections[i][1:5], truth[j][1:5])
+            if iou >= tolerance:
+                pairs.append((iou, i, j))
+    pairs.sort(reverse=True)
+    useddetections = set()
+    usedtruth = set()
+    matches = []
+    for iou, i, j in pairs:
+        if i not in useddetections and j not in usedtruth:
+            useddetections.add(i)
+            usedtruth.add(j)
+            matches.append((iou, detections[i], truth[j]))
+    return matches
+
+def scoretracks(detections, truths, tolerance = 0.5):
+    moths = 0
+    found = 0
+    movingmoths = 0
+    movingfound = 0
+    extra = 0
+    switches = 0
+    ioutotal = 0
+    lasttrack = {}
+    trackmoths = {}
+    mothtracks = {}
+
+    for frame in range(len(truths)):
+        truth = truths[frame]
+        matches = matchframe(detections[frame], truth, tolerance)
+        moths += len(truth)
+        found += len(matches)
+        movingmoths += sum(1 for t in truth if t[5])
+        extra += len(detections[frame]) - len(matches)
+        for iou, detection, moth in matches:
+            ioutotal += iou
+            trackid, mothid = detection[0], moth[0]
+            if moth[5]:
+                movingfound += 1
+            if mothid in lasttrack and lasttrack[mothid] != trackid:
+                switches += 1
+            lasttrack[mothid] = trackid
+            trackmoths.setdefault(trackid, {})
+            trackmoths[trackid][mothid] = trackmoths[trackid].get(mothid, 0) + 1
+            mothtracks.setdefault(mothid, set()).add(trackid)
+
+    detected = found + extra
+    # Share of each track's blobs that belong to its most frequent moth
+    purity = sum(max(counts.values()) for counts in trackmoths.values())
+    return {
+        "moths": moths,
+        "matched": found,
+        "missed": moths - found,
+        "extra": extra,
+        "switches": switches,
+        "recall": found / moths if moths > 0 else 0,
+        "recallmoving": movingfound / movingmoths if movingmoths > 0 else 0,
+        "recallstationary": (found - movingfound) / (moths - movingmoths) if moths > movingmoths else 0,
+        "precision": found / detected if detected > 0 else 0,
+        "mota": 1 - (moths - found + extra + switches) / moths if moths > 0 else 0,
+        "meaniou": ioutotal / found if found > 0 else 0,
+        "purity": purity / found if found > 0 else 0,
+        "tracks": len(trackmoths),
+        # Average number of tracks each detected moth was split across
+        "fragmentation": sum(len(t) for t in mothtracks.values()) / len(mothtracks) if len(mothtracks) > 0 else 0
+    }
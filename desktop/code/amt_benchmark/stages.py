@@ -0,0 +1,62 @@
+import io
+import csv
+import cv2
+
+from amt_blobdetector import AMTBlobDetector
+from amt_tracker import AMTTracker
+from SegmentImages import getinteresting, amtblobheadings
+
+# The per-frame steps of SegmentImages.processfolder, timed under the same
+# stage names as data/amt_timing.csv.
+# Frames are encoded to JPEG in memory before the timed decode so that no disk
+# access is involved, and output is encoded and formatted but not saved.
+
+
+def runstages(config, night, timer):
+    # Returns the current blobs of each frame as lists of (trackid, x, y, w, h),
+    # the ground truth of each frame from the synthetic night and the
+    # detector used
+    threshold = config['threshold']
+    detector = AMTBlobDetector(config)
+    detector.timer = timer
+    tracker = AMTTracker(config)
+    tracks = []
+    blobid = 0
+    imageid = 0
+    detections = []
+    truths = []
+    rows = csv.writer(io.StringIO(), delimiter=',')
+
+    for filename, image, truth in night:
+        _, encoded = cv2.imencode(".jpg", image)
+        imageid += 1
+
+        with timer.stage("decode"):
+            image = cv2.imdecode(encoded, cv2.IMREAD_COLOR)
+            height, width, _ = image.shape
+
+        # Times the background, contours and reportcolors stages
+        count, blobs, gray = detector.findblobs(image, imageid)
+
+        with timer.stage("contrast"):
+            keep = getinteresting(gray, blobs, threshold)
+            interesting = [blobs[b] for b in range(len(blobs)) if keep[b]]
+            for blob in interesting:
+                blobid += 1
+                blob.id = blobid
+
+        with timer.stage("tracking"):
+            tracks, deadtracks = tracker.managetracks(tracks, interesting)
+
+        with timer.stage("write"):
+            for blob in tracks:
+                if blob.age == 0:
+                    if blob.changed:
+                        cv2.imencode(".jpg", blob.getcrop(image))
+                    rows.writerow(blob.getrow(amtblobheadings))
+
+        timer.endframe(filename)
+        detections.append([(blob.trackid, blob.x, blob.y, blob.w, blob.h) for blob in tracks if blob.age == 0])
+        truths.append(truth)
+
+    return detections, truths, detector
@@ -0,0 +1,135 @@
+import os
+import csv
+import cv2
+import math
+import numpy as np
+from datetime import datetime, timedelta
+
+# Renders a night of trap images with known ground truth. The background is a
+# pale sheet with soft folds and sensor noise, framed by the dark edge of the
+# trap, and its brightness drifts slowly through the night. Moths arrive at
+# random times and stay for a random number of frames - roughly half of them
+# settle and never move, the rest wander across the sheet with a slowly
+# changing heading.
+
+truthheadings = [ "frame", "filename", "mothid", "x", "y", "w", "h", "moving" ]
+
+class AMTSyntheticMoth:
+    def __init__(self, id, random, width, height, frames, visit, moving):
+        self.id = id
+        self.moving = moving
+        self.length = int(random.uniform(width / 60, width / 30))
+        self.breadth = int(self.length * random.uniform(0.45, 0.7))
+        self.x = random.uniform(self.length, width - self.length)
+        self.y = random.uniform(self.length, height - self.length)
+        self.angle = random.uniform(0, 360)
+        self.speed = random.uniform(0.1, 0.5) * self.length if moving else 0
+        self.first = int(random.integers(0, max(1, frames - visit)))
+        self.last = min(frames - 1, self.first + visit)
+        shade = random.uniform(0.3, 0.8)
+        tint = random.uniform(-30, 30, 3)
+        self.color = tuple(int(min(max(c * shade + t, 0), 255)) for c, t in zip((70, 100, 130), tint))
+        self.marking = tuple(int(c * 0.6) for c in self.color)
+
+    def step(self, random, width, height):
+        if self.speed > 0:
+            self.angle += random.normal(0, 20)
+            radians = math.radians(self.angle)
+            self.x = min(max(self.x + self.speed * math.cos(radians), self.length), width - self.length)
+            self.y = min(max(self.y + self.speed * math.sin(radians), self.length), height - self.length)
+
+    def draw(self, image):
+        center = (int(self.x), int(self.y))
+        outline = cv2.ellipse2Poly(center, (self.length // 2, self.breadth // 2), int(self.angle), 0, 360, 5)
+        cv2.fillPoly(image, [outline], self.color, cv2.LINE_AA)
+        cv2.ellipse(image, center, (self.length // 5, self.breadth // 4), int(self.angle), 0, 360, self.marking, -1, cv2.LINE_AA)
+        return cv2.boundingRect(outline)
+
+
+class AMTSyntheticNight:
+    def __init__(self, config = None):
+        config = config if config is not None else {}
+        self.width = config["width"] if "width" in config else 3840
+        self.height = config["height"] if "height" in config else 2160
+        self.frames = config["frames"] if "frames" in config else 60
+        # Average number of moths on the sheet at any time
+        self.density = config["density"] if "density" in config else 20
+        self.stationary = config["stationary"] if "stationary" in config else 0.5
+        # Fractional change in sheet brightness over the night
+        self.drift = config["drift"] if "drift" in config else 0.1
+        self.interval = config["interval"] if "interval" in config else 10
+        self.seed = config["seed"] if "seed" in config else 1
+        self.start = datetime(2021, 10, 1, 20, 0, 0)
+
+    def getbackground(self, random):
+        h, w = self.height, self.width
+        y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+        folds = np.zeros((h, w), np.float32)
+        for i in range(4):
+            angle = random.uniform(0, math.pi)
+            period = random.uniform(0.2, 0.6) * w
+            phase = random.uniform(0, 2 * math.pi)
+            folds += np.sin((x * math.cos(angle) + y * math.sin(angle)) * 2 * math.pi / period + phase)
+        sheet = 200 + 6 * folds
+        sheet += random.normal(0, 3, (h, w)).astype(np.float32)
+        border = max(4, w // 40)
+        sheet[:, :border] = 30
+        sheet[:, w - border:] = 30
+        sheet = np.clip(sheet, 0, 255).astype(np.uint8)
+        return cv2.merge([sheet, sheet, np.clip(sheet.astype(np.int16) + 8, 0, 255).astype(np.uint8)])
+
+    def getmoths(self, random):
+        moths = []
+        visit = max(2, self.frames // 3)
+        count = max(1, round(self.density * self.frames / visit))
+        for i in range(count):
+            moving = random.uniform() >= self.stationary
+            moths.append(AMTSyntheticMoth(i + 1, random, self.width, self.height, self.frames, visit, moving))
+        return moths
+
+    def getfilename(self, frame):
+        timestamp = self.start + timedelta(seconds = frame * self.interval)
+        return timestamp.strftime("%Y%m%d%H%M%S") + ".jpg"
+
+    def __iter__(self):
+        # Yields (filename, image, truth) where truth is a list of
+        # (mothid, x, y, w, h, moving) for the moths visible in the frame
+        random = np.random.default_rng(self.seed)
+        background = self.getbackground(random)
+        moths = self.getmoths(random)
+        for frame in range(self.frames):
+            gain = 1 - self.drift * frame / max(1, self.frames - 1)
+            image = cv2.convertScaleAbs(background, alpha = gain)
+            truth = []
+            for moth in moths:
+                if moth.first <= frame <= moth.last:
+                    if frame > moth.first:
+                        moth.step(random, self.width, self.height)
+                    x, y, w, h = moth.draw(image)
+                    truth.append((moth.id, x, y, w, h, moth.moving))
+            yield self.getfilename(frame), image, truth
+
+    def write(self, folder):
+        # Saves the night as a run folder that SegmentImages can process, with
+        # the ground truth alongside in amt_truth.csv
+        os.makedirs(folder, exist_ok = True)
+        with open(os.path.join(folder, "amt_truth.csv"), 'w', newline='', encoding="utf8") as truthfile:
+            truthwriter = csv.writer(truthfile, delimiter=',')
+            truthwriter.writerow(truthheadings)
+            frame = 0
+            for filename, image, truth in self:
+                frame += 1
+                cv2.imwrite(os.path.join(folder, filename), image)
+                for t in truth:
+                    truthwriter.writerow([frame, filename] + list(t))
+
+
+if __name__ == "__main__":
+    import sys
+    import json
+    if len(sys.argv) < 3:
+        print("Usage: python -m amt_benchmark.synthetic configfile folder")
+        sys.exit(1)
+    with open(sys.argv[1]) as f:
+        config = json.load(f)
+    AMTSyntheticNight(config["benchmark"] if "benchmark" in config else None).write(sys.argv[2])
@@ -0,0 +1,46 @@
+from colors import colorstring
+
+
+class AMTBlob:
+    # Compact record for one detected blob, shared by the detector, the
+    # tracker and the CSV writers. The crop pixels are not kept - the crop
+    # rectangle is an offset into the source frame and getcrop returns a view
+    # on whichever frame is still held by the caller.
+    __slots__ = [
+        "id", "imageid", "filename",
+        "x", "y", "w", "h",
+        "xcrop", "ycrop", "wcrop", "hcrop",
+        "xcenter", "ycenter",
+        "size", "illumination", "changed", "colors",
+        "trackid", "cost", "weights", "direction", "delay", "age",
+    ]
+
+    def __init__(self, imageid, x, y, w, h):
+        self.id = 0
+        self.imageid = imageid
+        self.filename = ""
+        self.x, self.y, self.w, self.h = x, y, w, h
+        self.xcenter = int(x + w / 2)
+        self.ycenter = int(y + h / 2)
+        self.xcrop, self.ycrop, self.wcrop, self.hcrop = x, y, w, h
+        self.size = 0
+        self.illumination = 0
+        self.changed = False
+        # Bitmask of colorcodes from colors.reportcolors
+        self.colors = 0
+        self.trackid = ""
+        self.cost = ""
+        self.weights = ""
+        self.direction = ""
+        self.delay = 0
+        self.age = 0
+
+    def setcrop(self, xcrop, ycrop, wcrop, hcrop):
+        self.xcrop, self.ycrop, self.wcrop, self.hcrop = xcrop, ycrop, wcrop, hcrop
+
+    def getcrop(self, image):
+        return image[self.ycrop:self.ycrop + self.hcrop, self.xcrop:self.xcrop + self.wcrop]
+
+    def getrow(self, headings):
+        # The CSV files keep the colour codes as a string such as "RK"
+        return [colorstring(self.colors) if h == "colors" else getattr(self, h) for h in headings]
@@ -3,7 +3,9 @@ import os
 import math
 import numpy as np
 from colors import reportcolors
-from skimage import io
+from amt_blob import AMTBlob
+from amt_timing import timed
+from amt_background import AMTBackgroundModelFactory
 
 #Reference simple - https://docs.opencv.org/3.4/d7/d4d/tutorial_py_thresholding.html
 # https://opencv-python-tutroals.readthedocs.io/en/latest/py_tutorials/py_video/py_bg_subtraction/py_bg_subtraction.html
@@ -24,8 +26,34 @@ class AMTBlobDetector:
         self.minarea = self.config["minarea"]
         self.maxarea = self.config["maxarea"]
         self.frame_id = 1
-        self.bsmog2_bgnd = cv2.createBackgroundSubtractorMOG2()
-        self.bsmog2_prev = cv2.createBackgroundSubtractorMOG2()
+        # Optional detection on a reduced pyramid level - candidate rectangles
+        # are then refined at full resolution
+        self.pyramid = self.config["pyramid"] if "pyramid" in self.config else 0
+        self.factor = 2 ** self.pyramid
+        self.kernel = np.ones((self.kernel_fast, self.kernel_fast), np.uint8)
+        self.kernel_refine = np.ones((2 * self.factor + 1, 2 * self.factor + 1), np.uint8)
+        self.kernel_scaled = np.ones((max(1, round(self.kernel_fast / self.factor)),) * 2, np.uint8)
+        # Optional static region of interest as [x, y, w, h] and/or a minimum
+        # background illumination, to skip the dark border around the sheet
+        self.roi = self.config["roi"] if "roi" in self.config else None
+        self.roithreshold = self.config["roithreshold"] if "roithreshold" in self.config else None
+        self.roirect = None
+        self.roiexclude = None
+        # The fused path thresholds each subtractor output with a single call
+        # and reuses preallocated buffers from frame to frame - set "fused" to
+        # false to use the original separate steps (e.g. for benchmarking)
+        self.fused = self.config["fused"] if "fused" in self.config else True
+        self.buffers = {}
+        # Optional AMTStageTimer for the background, contours and reportcolors steps
+        self.timer = None
+        # The reference model is fixed once initialised with the background
+        # and the recent model keeps learning - both default to MOG2 and the
+        # reference model to the same settings as the recent one
+        factory = AMTBackgroundModelFactory()
+        recent = self.config["recentmodel"] if "recentmodel" in self.config else {}
+        reference = self.config["referencemodel"] if "referencemodel" in self.config else recent
+        self.model_bgnd = factory.create(reference)
+        self.model_prev = factory.create(recent)
 
     def initialisebackground(self, image):
         background = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
@@ -41,29 +69,148 @@ class AMTBlobDetector:
         background = cv2.filter2D(background,-1,kernel)
         return background
 
+    def initialiseroi(self, background):
+        height, width = background.shape
+        mask = np.full((height, width), 255, np.uint8)
+        if self.roi is not None:
+            x, y, w, h = self.roi
+            mask[:, :] = 0
+            mask[y:y+h, x:x+w] = 255
+        if self.roithreshold is not None:
+            mask[background < self.roithreshold] = 0
+        x, y, w, h = cv2.boundingRect(mask)
+        if w == 0 or h == 0:
+            print("WARNING: Region of interest is empty - using whole image")
+            x, y, w, h = 0, 0, width, height
+            mask[:, :] = 255
+        self.roirect = (x, y, w, h)
+        mask = self.getregion(mask)
+        _, mask = cv2.threshold(mask, 254, 255, cv2.THRESH_BINARY)
+        if np.any(mask == 0):
+            # Pixels inside the bounding rectangle but outside the mask are
+            # forced to background after thresholding
+            self.roiexclude = 255 - mask
+
+    def getregion(self, image):
+        # Crop to the region of interest and reduce to the working pyramid level
+        x, y, w, h = self.roirect
+        height, width = image.shape[0:2]
+        if x > 0 or y > 0 or w < width or h < height:
+            image = image[y:y+h, x:x+w]
+        for i in range(self.pyramid):
+            image = cv2.pyrDown(image)
+        return image
+
+    def isfullframe(self, shape):
+        return self.factor == 1 and self.roirect == (0, 0, shape[1], shape[0])
+
+    def upscale(self, shape, binary):
+        x, y, w, h = self.roirect
+        if self.factor > 1:
+            binary = cv2.resize(binary, None, fx = self.factor, fy = self.factor, interpolation = cv2.INTER_NEAREST)
+        full = np.full(shape, 255, np.uint8)
+        full[y:y+h, x:x+w] = binary[0:h, 0:w]
+        return full
+
+    def toframe(self, gray, binary, changed, rects):
+        # Map the binary image and rectangles from the working region back
+        # to full-resolution frame coordinates
+        if self.isfullframe(gray.shape):
+            return binary, rects
+        x, y, w, h = self.roirect
+        full = self.upscale(gray.shape, binary)
+        if self.factor > 1:
+            changed = self.upscale(gray.shape, changed)
+        framerects = []
+        for r in rects:
+            rx = x + r[0] * self.factor
+            ry = y + r[1] * self.factor
+            rw = min(r[2] * self.factor, x + w - rx)
+            rh = min(r[3] * self.factor, y + h - ry)
+            rect = (rx, ry, rw, rh)
+            if self.factor > 1:
+                rect = self.refine(gray, full, changed, rect)
+                # Apply the area limits again to the refined rectangle
+                rectsize = rect[2] * rect[3]
+                if rectsize <= self.minarea or rectsize >= self.maxarea:
+                    continue
+            framerects.append(rect)
+        return full, framerects
+
+    def refine(self, gray, binary, changed, rect):
+        # Threshold the full-resolution difference from the background inside
+        # the (slightly padded) candidate rectangle and update the binary image
+        # there. Return the bounding rectangle of the foreground that the
+        # reduced-resolution model also marked as changed.
+        height, width = gray.shape
+        x, y, w, h = rect
+        x0, y0 = max(0, x - self.factor), max(0, y - self.factor)
+        x1, y1 = min(width, x + w + self.factor), min(height, y + h + self.factor)
+        difference = cv2.absdiff(gray[y0:y1, x0:x1], self.background[y0:y1, x0:x1])
+        _, mask = cv2.threshold(difference, self.thresh, 255, cv2.THRESH_BINARY_INV)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_CLOSE, self.kernel)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel)
+        binary[y0:y1, x0:x1] = mask
+        changed = cv2.erode(changed[y0:y1, x0:x1], self.kernel_refine)
+        points = cv2.findNonZero(cv2.bitwise_not(cv2.bitwise_or(mask, changed)))
+        if points is None:
+            return rect
+        rx, ry, rw, rh = cv2.boundingRect(points)
+        return (x0 + rx, y0 + ry, rw, rh)
+
     def getillumination(self, x, y):
         if self.background is None:
             return 0
         return int(self.background[y, x])
 
-    def getrects(self, image, bsmog2, rate):
-        image = bsmog2.apply(image, learningRate = rate)
+    def getbuffer(self, name, shape):
+        if name not in self.buffers or self.buffers[name].shape != shape:
+            self.buffers[name] = np.empty(shape, np.uint8)
+        return self.buffers[name]
+
+    def getmask(self, image, model, rate, name):
+        # Foreground pixels are 0 and background 255 as in getrects - the
+        # subtractor output and scratch buffers are shared by both
+        # subtractors but each keeps its own result buffer
+        mask = self.getbuffer("mask", image.shape)
+        scratch = self.getbuffer("scratch", image.shape)
+        binary = self.getbuffer(name, image.shape)
+        model.apply(image, mask, rate)
+        cv2.threshold(mask, self.thresh, 255, cv2.THRESH_BINARY_INV, dst = mask)
+        cv2.morphologyEx(mask, cv2.MORPH_CLOSE, self.kernel_scaled, dst = scratch)
+        cv2.morphologyEx(scratch, cv2.MORPH_OPEN, self.kernel_scaled, dst = binary)
+        if self.roiexclude is not None:
+            cv2.bitwise_or(binary, self.roiexclude, dst = binary)
+        return binary
+
+    def getmaskrects(self, binary):
+        inverted = cv2.bitwise_not(binary, dst = self.getbuffer("inverted", binary.shape))
+        contours, _ = cv2.findContours(inverted, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        return self.filterrects(contours)
+
+    def filterrects(self, contours):
+        rects = []
+        for cnt in contours:
+            rect = cv2.boundingRect(cnt)
+            rectsize = rect[2] * rect[3] * self.factor * self.factor
+            if rectsize > self.minarea and rectsize < self.maxarea:
+                rects.append(rect)
+        return rects
+
+    def getrects(self, image, model, rate):
+        image = model.apply(image, None, rate)
         image[image > self.thresh] = 254
         image[image <= self.thresh] = 1
         image[image == 254] = 0
         image[image == 1] = 255
-        kernel = np.ones((self.kernel_fast, self.kernel_fast), np.uint8)
+        kernel = self.kernel_scaled
         image = cv2.morphologyEx(image, cv2.MORPH_CLOSE, kernel)
         image = cv2.morphologyEx(image, cv2.MORPH_OPEN, kernel)
+        if self.roiexclude is not None:
+            image = cv2.bitwise_or(image, self.roiexclude)
         binary = image.copy()
         contours, _= cv2.findContours(255 - binary.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        rects = []
-        for cnt in contours:
-            rect = cv2.boundingRect(cnt)
-            rectsize = rect[2] * rect[3]
-            if rectsize > self.minarea and rectsize < self.maxarea:
-                rects.append(rect)
-        return binary, rects
+        return binary, self.filterrects(contours)
 
     def comparerects(self, rect1, rect2):
         x1, y1, w1, h1 = rect1
@@ -118,17 +265,49 @@ class AMTBlobDetector:
         return False
         
 
+    def setbackground(self, background):
+        self.background = background
+        self.initialiseroi(background)
+        region = self.getregion(background)
+        self.model_bgnd.initialise(region)
+        self.model_prev.initialise(region)
+
+    def replay(self, img, index):
+        # Brings the adaptive model up to date with an image processed before
+        # a checkpoint - the fixed model never learns after the background.
+        # index is the image's position in the original run
+        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+        self.model_prev.replay(self.getregion(gray), index)
+
+    def getmemory(self):
+        # Approximate bytes held by the two background models
+        return self.model_bgnd.getmemory() + self.model_prev.getmemory()
+
     def findblobs(self, img, imageid):
         if self.background is None:
-            self.background = self.initialisebackground(img)
-            self.bsmog2_bgnd.apply(self.background)
-            self.bsmog2_prev.apply(self.background)
-        original = img.copy()
-        gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-        binary, rects_bgnd = self.getrects(gray, self.bsmog2_bgnd, 0)
-        _, rects_prev = self.getrects(gray, self.bsmog2_prev, -1)
+            with timed(self.timer, "background"):
+                self.setbackground(self.initialisebackground(img))
+        if self.fused:
+            with timed(self.timer, "background"):
+                gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY, dst = self.getbuffer("gray", img.shape[0:2]))
+                region = self.getregion(gray)
+                # Only the rectangles from the adaptive model are used
+                binary = self.getmask(region, self.model_bgnd, 0, "bgnd")
+                changed = self.getmask(region, self.model_prev, -1, "prev")
+            with timed(self.timer, "contours"):
+                rects_prev = self.getmaskrects(changed)
+        else:
+            with timed(self.timer, "background"):
+                original = img.copy()
+                gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+                region = self.getregion(gray)
+                binary, rects_bgnd = self.getrects(region, self.model_bgnd, 0)
+                changed, rects_prev = self.getrects(region, self.model_prev, -1)
+        with timed(self.timer, "contours"):
+            binary, rects_prev = self.toframe(gray, binary, changed, rects_prev)
 
         blobs = []
+        masks = []
 
         # Init counters for counting number of images
         count = 0
@@ -137,12 +316,7 @@ class AMTBlobDetector:
 
         for r in rects_prev:
             x, y, w, h = r
-            blob = {}
-            blob["imageid"] = imageid
-
-            blob["x"], blob["y"], blob["w"], blob["h"] = x, y, w, h
-            blob["xcenter"] = int(x + w / 2)
-            blob["ycenter"] = int(y + h / 2)
+            blob = AMTBlob(imageid, x, y, w, h)
 
             xcrop = math.floor(x - w * 0.5)
             wcrop = w + math.ceil(2 * w * 0.5)
@@ -157,33 +331,23 @@ class AMTBlobDetector:
             if ycrop + hcrop > iheight:
                 hcrop = iheight - ycrop
 
-            blob["xcrop"] = xcrop
-            blob["ycrop"] = ycrop
-            blob["wcrop"] = wcrop
-            blob["hcrop"] = hcrop
+            blob.setcrop(xcrop, ycrop, wcrop, hcrop)
 
-            blob["blobimage"] = img[ycrop:ycrop+hcrop, xcrop:xcrop+wcrop]
-            blob["changed"] = self.checkintersection(x, y, w, h, rects_prev)
+            blob.changed = self.checkintersection(x, y, w, h, rects_prev)
 
             mask = binary[ycrop:ycrop+hcrop, xcrop:xcrop+wcrop]
-            blob["size"] = np.sum(mask < 255)
-            kernel = np.ones((self.kernel_fast, self.kernel_fast), np.uint8)
-            mask = cv2.morphologyEx(mask, cv2.MORPH_DILATE, kernel)
-            blob["colors"] = reportcolors(blob["blobimage"], mask)
-            blob["illumination"] = self.background[blob["ycenter"], blob["xcenter"]]
-
-            blob["id"] = 0
-            blob["filename"] = ""
-
-            blob["age"] = 0
-            blob["delay"] = 0
-            blob["direction"] = ""
-            blob["cost"] = ""
-            blob["weights"] = ""
+            blob.size = np.sum(mask < 255)
+            masks.append(cv2.morphologyEx(mask, cv2.MORPH_DILATE, self.kernel))
+            blob.illumination = self.background[blob.ycenter, blob.xcenter]
 
             blobs.append(blob)
 
             count = count + 1
 
+        with timed(self.timer, "reportcolors"):
+            colors = reportcolors(img, masks, [(b.xcrop, b.ycrop, b.wcrop, b.hcrop) for b in blobs])
+            for blob, c in zip(blobs, colors):
+                blob.colors = int(c)
+
         self.frame_id += 1
         return count, blobs, gray
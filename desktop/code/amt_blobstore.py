@@ -0,0 +1,112 @@
+import io
+import os
+import csv
+import threading
+
+# Storage for blob crops. By default each crop is a JPEG file in data/blob.
+# With "blobpack" set in the configuration, SegmentImages instead appends the
+# encoded crops to a single data/amt_blob.pack file and records each crop's
+# name, offset and length in data/amt_blob_index.csv. Both files are only
+# ever appended to, so a checkpoint can record their lengths and a resumed
+# run can truncate them as it does the other CSV files. The filename column
+# in amt_blob.csv is the crop's name in either form of storage.
+
+packname = "amt_blob.pack"
+indexname = "amt_blob_index.csv"
+indexheadings = [ "filename", "offset", "length" ]
+
+
+def readindex(indexpath, packsize):
+    # Returns the index as a dictionary of name to (offset, length). Entries
+    # cut short by a crash, or beyond the end of the pack, are ignored.
+    index = {}
+    with open(indexpath, newline='', encoding="utf8") as indexfile:
+        indexreader = csv.reader(indexfile, delimiter=',')
+        next(indexreader, None)
+        for row in indexreader:
+            try:
+                name, offset, length = row[0], int(row[1]), int(row[2])
+            except (IndexError, ValueError):
+                continue
+            if offset + length <= packsize:
+                index[name] = (offset, length)
+    return index
+
+
+class AMTBlobPackWriter:
+    # prefix allows other stores, such as TrackEditor's thumbnails, to use
+    # the same layout under different names
+    def __init__(self, datafolder, resuming = False, prefix = "amt_blob"):
+        mode = 'a' if resuming else 'w'
+        self.pack = open(os.path.join(datafolder, prefix + ".pack"), mode + 'b')
+        self.indexfile = open(os.path.join(datafolder, prefix + "_index.csv"), mode, newline='', encoding="utf8")
+        self.indexwriter = csv.writer(self.indexfile, delimiter=',')
+        if not resuming:
+            self.indexwriter.writerow(indexheadings)
+        self.lock = threading.Lock()
+
+    def write(self, name, data):
+        with self.lock:
+            offset = self.pack.tell()
+            self.pack.write(data)
+            self.indexwriter.writerow([name, offset, len(data)])
+
+    def flush(self):
+        with self.lock:
+            self.pack.flush()
+            self.indexfile.flush()
+
+    def getoffsets(self):
+        with self.lock:
+            return self.pack.tell(), self.indexfile.tell()
+
+    def close(self):
+        self.pack.close()
+        self.indexfile.close()
+
+    @staticmethod
+    def truncate(datafolder, packoffset, indexoffset):
+        os.truncate(os.path.join(datafolder, packname), packoffset)
+        os.truncate(os.path.join(datafolder, indexname), indexoffset)
+
+
+class AMTBlobStore:
+    # Reads crops by name from whichever storage a run folder uses. open
+    # returns a binary file object, suitable for PIL.Image.open or for
+    # uploading, and is safe to call from several threads.
+    def __init__(self, datafolder):
+        self.folder = os.path.join(datafolder, "blob")
+        self.packpath = os.path.join(datafolder, packname)
+        self.index = None
+        self.pack = None
+        self.lock = threading.Lock()
+        indexpath = os.path.join(datafolder, indexname)
+        if os.path.isfile(indexpath) and os.path.isfile(self.packpath):
+            self.index = readindex(indexpath, os.path.getsize(self.packpath))
+
+    def exists(self, name):
+        if self.index is not None and name in self.index:
+            return True
+        return os.path.isfile(os.path.join(self.folder, name))
+
+    def read(self, name):
+        if self.index is not None and name in self.index:
+            offset, length = self.index[name]
+            with self.lock:
+                if self.pack is None:
+                    self.pack = open(self.packpath, 'rb')
+                self.pack.seek(offset)
+                return self.pack.read(length)
+        with open(os.path.join(self.folder, name), 'rb') as f:
+            return f.read()
+
+    def open(self, name):
+        f = io.BytesIO(self.read(name))
+        f.name = name
+        return f
+
+    def close(self):
+        with self.lock:
+            if self.pack is not None:
+                self.pack.close()
+                self.pack = None
@@ -0,0 +1,122 @@
+import os
+import re
+import time
+import pickle
+
+from amt_blobstore import AMTBlobPackWriter
+
+# Saved state for resuming segmentation of a run folder. The checkpoint holds
+# everything processfolder carries from one image to the next - the names of
+# the images already processed, the image and blob counters, the live tracks
+# and trails, the detector background and the lengths of the two CSV files at
+# the moment the checkpoint was taken. It is written to a temporary file and
+# renamed, so a crash while saving leaves the previous checkpoint intact.
+#
+# OpenCV cannot save the MOG2 models themselves. The fixed background model
+# is rebuilt exactly from the saved background, but the adaptive model is
+# rebuilt by replaying the last few processed images, so blobs found just
+# after a resume can differ slightly from those in an uninterrupted run.
+
+checkpointversion = 3
+blobfile_pattern = re.compile("_([0-9]+)\\.jpg$")
+
+
+class AMTCheckpoint:
+    def __init__(self, config, datafolder):
+        self.config = config["checkpoint"] if "checkpoint" in config else {}
+        # Images between checkpoints (0 disables checkpoints)
+        self.interval = self.config["interval"] if "interval" in self.config else 500
+        self.replay = self.config["replay"] if "replay" in self.config else 500
+        self.path = os.path.join(datafolder, "amt_checkpoint.pkl")
+        self.saved = 0
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def isdue(self, processed):
+        return self.interval > 0 and processed - self.saved >= self.interval
+
+    def load(self):
+        with open(self.path, "rb") as f:
+            state = pickle.load(f)
+        if state["version"] != checkpointversion:
+            print(f"WARNING: Ignoring checkpoint version {state['version']} in {self.path}")
+            return None
+        self.saved = len(state["processed"])
+        return state
+
+    def save(self, state):
+        state["version"] = checkpointversion
+        temppath = self.path + ".tmp"
+        with open(temppath, "wb") as f:
+            pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temppath, self.path)
+        self.saved = len(state["processed"])
+
+    def remove(self):
+        if os.path.isfile(self.path):
+            os.remove(self.path)
+
+    def getreplay(self, state):
+        # Returns (index, filename) for the images to replay, where index is
+        # the position of the image in the original run counting from 1
+        processed = state["processed"]
+        first = max(0, len(processed) - self.replay)
+        return [(i + 1, processed[i]) for i in range(first, len(processed))]
+
+    def truncate(self, state, imagepath, blobpath, blobfolder):
+        # Discards CSV rows and blob images written after the checkpoint
+        os.truncate(imagepath, state["imageoffset"])
+        os.truncate(blobpath, state["bloboffset"])
+        if "packoffset" in state:
+            AMTBlobPackWriter.truncate(os.path.dirname(blobpath), state["packoffset"], state["indexoffset"])
+        for filename in os.listdir(blobfolder):
+            result = blobfile_pattern.search(filename)
+            if result is not None and int(result.group(1)) > state["blobid"]:
+                os.remove(os.path.join(blobfolder, filename))
+
+
+class AMTFolderWatcher:
+    # Supplies batches of images not yet processed, in name (and so capture
+    # time) order. In incremental mode it then keeps polling the folder for
+    # new images until none have arrived for "idle" seconds. Images modified
+    # within the last "settle" seconds are left for the next poll in case
+    # they are still being copied.
+    def __init__(self, config, folder, processed):
+        self.config = config["incremental"] if "incremental" in config else {}
+        self.enabled = self.config["enabled"] if "enabled" in self.config else False
+        self.poll = self.config["poll"] if "poll" in self.config else 10
+        self.idle = self.config["idle"] if "idle" in self.config else 600
+        self.settle = self.config["settle"] if "settle" in self.config else 5
+        self.folder = folder
+        self.seen = set(processed)
+
+    def getnew(self):
+        filelist = []
+        now = time.time()
+        for filename in sorted(os.listdir(self.folder)):
+            if filename.lower().endswith("jpg") and filename not in self.seen:
+                if self.enabled and now - os.path.getmtime(os.path.join(self.folder, filename)) < self.settle:
+                    continue
+                filelist.append(filename)
+        self.seen.update(filelist)
+        return filelist
+
+    def batches(self, onidle = None):
+        filelist = self.getnew()
+        if len(filelist) > 0:
+            yield filelist
+        if not self.enabled:
+            return
+        lastarrival = time.time()
+        while time.time() - lastarrival < self.idle:
+            if onidle is not None:
+                onidle()
+            time.sleep(self.poll)
+            filelist = self.getnew()
+            if len(filelist) > 0:
+                print(f"{self.folder} - {len(filelist)} new images")
+                lastarrival = time.time()
+                yield filelist
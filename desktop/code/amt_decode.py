@@ -0,0 +1,48 @@
+import cv2
+from PIL import Image
+
+# Decoding at reduced resolution for output that does not need the full
+# image, such as movies and thumbnails. libjpeg can scale JPEG images by 1/2,
+# 1/4 or 1/8 while decoding, in the DCT domain, which is several times faster
+# than a full decode followed by a resize. readimage uses the largest such
+# reduction that still gives at least the size wanted and resizes the rest of
+# the way. Other formats are decoded at full size and resized. Detection in
+# SegmentImages always needs the full image. See python -m amt_benchmark.decode
+# for timings.
+
+reducedflags = { 2: cv2.IMREAD_REDUCED_COLOR_2, 4: cv2.IMREAD_REDUCED_COLOR_4, 8: cv2.IMREAD_REDUCED_COLOR_8 }
+
+
+def readsize(filepath):
+    # Returns (width, height) from the image header without decoding
+    with Image.open(filepath) as image:
+        return image.size
+
+
+def getreduction(sourcesize, size):
+    for factor in [ 8, 4, 2 ]:
+        if sourcesize[0] // factor >= size[0] and sourcesize[1] // factor >= size[1]:
+            return factor
+    return 1
+
+
+def readimage(filepath, sourcesize = None, size = None):
+    # Returns the image as read by cv2.imread, resized to size (width,
+    # height) if given. sourcesize is the full size of the image, if known.
+    if size is None:
+        return cv2.imread(filepath)
+    if sourcesize is None:
+        sourcesize = readsize(filepath)
+    factor = getreduction(sourcesize, size)
+    image = cv2.imread(filepath, reducedflags[factor] if factor > 1 else cv2.IMREAD_COLOR)
+    if image is not None and (image.shape[1], image.shape[0]) != tuple(size):
+        image = cv2.resize(image, tuple(size), interpolation=cv2.INTER_AREA)
+    return image
+
+
+def openimage(file, size):
+    # Opens an image with PIL, asking libjpeg to decode a JPEG at the
+    # smallest reduction no smaller than size
+    image = Image.open(file)
+    image.draft("RGB", size)
+    return image
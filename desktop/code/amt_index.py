@@ -0,0 +1,245 @@
+import os
+import re
+import sys
+import sqlite3
+import pandas
+
+from amt_tables import findtable, readtable
+
+# Season-wide index of the run folders under a datapath, kept in
+# <datapath>/amt_index.sqlite. Each run's metadata and its image, blob and
+# track tables are copied into SQLite so that questions spanning many runs
+# (e.g. all tracks of a taxon across units in a month, or the latest night
+# with unidentified tracks) are answered by queries rather than by opening
+# every folder. The index records the modification time of each source
+# file, so updaterun only re-reads what has changed. SegmentImages updates a
+# run when it has been segmented and TrackEditor when tracks are saved -
+# running this module as a script refreshes the whole index.
+
+indexname = "amt_index.sqlite"
+runfolder_pattern = re.compile("^20[-0-9]*$")
+
+# Keys read from amt_metadata.yaml wherever they occur in the file
+metadatakeys = {
+    "unitname": "unit", "decimalLatitude": "latitude", "decimalLongitude": "longitude",
+    "coordinateUncertaintyInMeters": "uncertainty", "lunarPhase": "lunarphase",
+    "sunsetTime": "sunset", "sunriseTime": "sunrise"
+}
+
+schema = """
+CREATE TABLE IF NOT EXISTS runs (
+    folder TEXT PRIMARY KEY, unit TEXT, latitude REAL, longitude REAL, uncertainty REAL,
+    lunarphase TEXT, sunset TEXT, sunrise TEXT, starttime TEXT, endtime TEXT,
+    images INTEGER DEFAULT 0, blobs INTEGER DEFAULT 0, tracks INTEGER DEFAULT 0,
+    unidentified INTEGER DEFAULT 0, segmented INTEGER DEFAULT 0, tracked INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS sources (
+    folder TEXT, name TEXT, mtime REAL, PRIMARY KEY (folder, name)
+);
+CREATE TABLE IF NOT EXISTS images (
+    folder TEXT, id INTEGER, datetime TEXT, filename TEXT, temperature REAL, humidity REAL,
+    PRIMARY KEY (folder, id)
+);
+CREATE TABLE IF NOT EXISTS blobs (
+    folder TEXT, id INTEGER, imageid INTEGER, trackid INTEGER, filename TEXT,
+    x INTEGER, y INTEGER, w INTEGER, h INTEGER, size INTEGER, changed INTEGER, colors TEXT,
+    PRIMARY KEY (folder, id)
+);
+CREATE TABLE IF NOT EXISTS tracks (
+    folder TEXT, id INTEGER, identification TEXT, inaturalistID TEXT, inaturalistRG TEXT, inaturalistTaxon TEXT,
+    starttime TEXT, endtime TEXT, blobs INTEGER, averagesize REAL,
+    PRIMARY KEY (folder, id)
+);
+CREATE INDEX IF NOT EXISTS blobs_track ON blobs (folder, trackid);
+CREATE INDEX IF NOT EXISTS tracks_identification ON tracks (identification, starttime);
+CREATE INDEX IF NOT EXISTS tracks_start ON tracks (starttime);
+CREATE INDEX IF NOT EXISTS runs_unit ON runs (unit, folder);
+CREATE VIEW IF NOT EXISTS identifications AS
+    SELECT tracks.folder, runs.unit, tracks.id AS trackid, identification, inaturalistID, inaturalistRG, inaturalistTaxon, tracks.starttime, tracks.endtime
+    FROM tracks JOIN runs ON runs.folder = tracks.folder WHERE identification <> '';
+"""
+
+imagecolumns = [ "id", "datetime", "filename", "temperature", "humidity" ]
+blobcolumns = [ "id", "imageid", "trackid", "filename", "x", "y", "w", "h", "size", "changed", "colors" ]
+trackcolumns = [ "id", "identification", "inaturalistID", "inaturalistRG", "inaturalistTaxon" ]
+
+
+def readmetadata(folder):
+    # Reads the values in metadatakeys line by line as Summarise always has,
+    # so that the index does not depend on the layout of the YAML file
+    metadata = {}
+    metadatafile = os.path.join(folder, "amt_metadata.yaml")
+    if os.path.isfile(metadatafile):
+        with open(metadatafile, newline='', encoding="utf8") as metadatalist:
+            for line in metadatalist:
+                terms = line.strip().split(':')
+                if len(terms) > 1 and terms[0].strip() in metadatakeys:
+                    column = metadatakeys[terms[0].strip()]
+                    value = ':'.join(terms[1:]).strip().strip("'").strip('"')
+                    if column in [ "latitude", "longitude", "uncertainty" ]:
+                        try:
+                            value = float(value)
+                        except ValueError:
+                            value = None
+                    metadata[column] = value
+    return metadata
+
+
+def getrows(frame, columns):
+    frame = frame[[ c for c in columns if c in frame.columns ]].astype(object)
+    return frame.where(frame.notna(), None).values.tolist()
+
+
+class AMTSeasonIndex:
+    def __init__(self, datapath):
+        self.datapath = datapath
+        self.path = os.path.join(datapath, indexname)
+        self.connection = sqlite3.connect(self.path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(schema)
+
+    @staticmethod
+    def exists(datapath):
+        return os.path.isfile(os.path.join(datapath, indexname))
+
+    def close(self):
+        self.connection.close()
+
+    def getsources(self, folder):
+        # Returns the modification times of the run's source files now and
+        # as last indexed
+        datafolder = os.path.join(self.datapath, folder, "data")
+        current = {}
+        metadatafile = os.path.join(self.datapath, folder, "amt_metadata.yaml")
+        if os.path.isfile(metadatafile):
+            current["metadata"] = os.path.getmtime(metadatafile)
+        for name in [ "image", "blob", "track" ]:
+            found = findtable(datafolder, name)
+            if found is not None:
+                current[name] = os.path.getmtime(found[0])
+        indexed = dict(self.connection.execute("SELECT name, mtime FROM sources WHERE folder = ?", (folder,)).fetchall())
+        return current, indexed
+
+    def updaterun(self, folder, force = False):
+        # Re-reads whichever of the run's files have changed since they were
+        # last indexed and returns True if anything was updated
+        current, indexed = self.getsources(folder)
+        changed = [ name for name in set(current) | set(indexed) if force or current.get(name) != indexed.get(name) ]
+        if len(changed) == 0:
+            return False
+        datafolder = os.path.join(self.datapath, folder, "data")
+        # A table that cannot be read (e.g. one with a malformed value) leaves
+        # the run as it was in the index rather than stopping the caller,
+        # which is usually working through other runs
+        try:
+            with self.connection:
+                self.connection.execute("INSERT OR IGNORE INTO runs (folder) VALUES (?)", (folder,))
+                if "metadata" in changed:
+                    metadata = readmetadata(os.path.join(self.datapath, folder))
+                    values = [ metadata.get(column) for column in metadatakeys.values() ]
+                    self.connection.execute("UPDATE runs SET " + ", ".join(c + " = ?" for c in metadatakeys.values()) + " WHERE folder = ?", values + [folder])
+                if "image" in changed:
+                    self.connection.execute("DELETE FROM images WHERE folder = ?", (folder,))
+                    if "image" in current:
+                        images = readtable(datafolder, "image", imagecolumns)
+                        self.connection.executemany("INSERT INTO images VALUES (?, ?, ?, ?, ?, ?)", [ [folder] + row for row in getrows(images, imagecolumns) ])
+                if "blob" in changed:
+                    self.connection.execute("DELETE FROM blobs WHERE folder = ?", (folder,))
+                    if "blob" in current:
+                        blobs = readtable(datafolder, "blob", blobcolumns)
+                        self.connection.executemany("INSERT INTO blobs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", [ [folder] + row for row in getrows(blobs, blobcolumns) ])
+                if len(set(changed) & { "image", "blob", "track" }) > 0:
+                    self.updatetracks(folder, datafolder, "track" in current)
+                self.connection.execute("""
+                    UPDATE runs SET
+                        images = (SELECT COUNT(*) FROM images WHERE folder = ?1),
+                        starttime = (SELECT MIN(datetime) FROM images WHERE folder = ?1),
+                        endtime = (SELECT MAX(datetime) FROM images WHERE folder = ?1),
+                        blobs = (SELECT COUNT(*) FROM blobs WHERE folder = ?1),
+                        tracks = (SELECT COUNT(*) FROM tracks WHERE folder = ?1),
+                        unidentified = (SELECT COUNT(*) FROM tracks WHERE folder = ?1 AND identification = ''),
+                        segmented = ?2, tracked = ?3
+                    WHERE folder = ?1""", (folder, int("blob" in current), int("track" in current)))
+                self.connection.execute("DELETE FROM sources WHERE folder = ?", (folder,))
+                self.connection.executemany("INSERT INTO sources VALUES (?, ?, ?)", [ (folder, name, mtime) for name, mtime in current.items() ])
+        except (ValueError, KeyError, OSError) as e:
+            print("Failed to index " + folder + ": " + str(e))
+            return False
+        return True
+
+    def updatetracks(self, folder, datafolder, tracked):
+        # Tracks take their times and sizes from the blobs already indexed.
+        # Before TrackEditor has written amt_track there is one unidentified
+        # track for each trackid in the blob table.
+        self.connection.execute("DELETE FROM tracks WHERE folder = ?", (folder,))
+        self.connection.execute("""
+            INSERT INTO tracks (folder, id, identification, inaturalistID, inaturalistRG, inaturalistTaxon, starttime, endtime, blobs, averagesize)
+            SELECT blobs.folder, blobs.trackid, '', '', '', '', MIN(images.datetime), MAX(images.datetime), COUNT(*), AVG(blobs.size)
+            FROM blobs LEFT JOIN images ON images.folder = blobs.folder AND images.id = blobs.imageid
+            WHERE blobs.folder = ? GROUP BY blobs.trackid""", (folder,))
+        if tracked:
+            tracks = readtable(datafolder, "track")
+            for column in trackcolumns:
+                if column not in tracks.columns:
+                    tracks[column] = ""
+            rows = getrows(tracks, trackcolumns)
+            self.connection.executemany("INSERT OR IGNORE INTO tracks (folder, id) VALUES (?, ?)", [ (folder, row[0]) for row in rows ])
+            self.connection.executemany("""
+                UPDATE tracks SET identification = ?, inaturalistID = ?, inaturalistRG = ?, inaturalistTaxon = ?
+                WHERE folder = ? AND id = ?""", [ row[1:] + [folder, row[0]] for row in rows ])
+
+    def refresh(self):
+        # Brings the whole index up to date, checking only file times for
+        # runs that have not changed
+        folders = [ f for f in sorted(os.listdir(self.datapath)) if runfolder_pattern.match(f) and os.path.isdir(os.path.join(self.datapath, f)) ]
+        updated = [ f for f in folders if self.updaterun(f) ]
+        indexed = [ row[0] for row in self.connection.execute("SELECT folder FROM runs") ]
+        with self.connection:
+            for folder in set(indexed) - set(folders):
+                for table in [ "runs", "sources", "images", "blobs", "tracks" ]:
+                    self.connection.execute("DELETE FROM " + table + " WHERE folder = ?", (folder,))
+        return updated
+
+    def getruns(self, unit = None):
+        query = "SELECT * FROM runs" + (" WHERE unit = ?" if unit is not None else "") + " ORDER BY folder"
+        return pandas.read_sql_query(query, self.connection, params=[unit] if unit is not None else None)
+
+    def findrun(self, keyword):
+        # Supports the keywords of TrackEditor's folder@keyword argument -
+        # INCOMPLETE is the earliest run with no or unidentified tracks,
+        # LATEST_INCOMPLETE the latest such run and anything else the latest
+        # run
+        if keyword in [ "INCOMPLETE", "LATEST_INCOMPLETE" ]:
+            order = "ASC" if keyword == "INCOMPLETE" else "DESC"
+            row = self.connection.execute("SELECT folder FROM runs WHERE segmented = 1 AND (tracked = 0 OR unidentified > 0) ORDER BY folder " + order + " LIMIT 1").fetchone()
+            if row is not None:
+                return row[0]
+        row = self.connection.execute("SELECT folder FROM runs ORDER BY folder DESC LIMIT 1").fetchone()
+        return row[0] if row is not None else None
+
+    def findtracks(self, identification = None, unit = None, start = None, end = None):
+        # Tracks across all runs, optionally limited to an identification,
+        # a unit and a range of datetimes (as YYYYmmddHHMMSS prefixes, e.g.
+        # start="202203", end="202204" for March 2022)
+        conditions = []
+        params = []
+        for column, value in [ ("tracks.identification = ?", identification), ("runs.unit = ?", unit), ("tracks.starttime >= ?", start), ("tracks.starttime < ?", end) ]:
+            if value is not None:
+                conditions.append(column)
+                params.append(value)
+        query = "SELECT tracks.*, runs.unit FROM tracks JOIN runs ON runs.folder = tracks.folder"
+        if len(conditions) > 0:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY tracks.starttime"
+        return pandas.read_sql_query(query, self.connection, params=params)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python amt_index.py datapath")
+        sys.exit()
+    index = AMTSeasonIndex(sys.argv[1])
+    updated = index.refresh()
+    runs = index.getruns()
+    print(f"{len(updated)} runs updated - {len(runs)} runs, {runs['images'].sum()} images, {runs['blobs'].sum()} blobs, {runs['tracks'].sum()} tracks")
+    index.close()
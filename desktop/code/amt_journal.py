@@ -0,0 +1,88 @@
+import os
+import json
+import threading
+
+# Edit journal for TrackEditor. Each split, join, delete or identify is
+# appended to data/amt_edits.journal as a line of JSON when it is made, so
+# edits survive a crash without rewriting the blob and track tables. The
+# tables are brought up to date from time to time (compaction) and the
+# operations they now reflect are trimmed from the journal. On opening, any
+# operations left in the journal are replayed over the tables.
+#
+# A crash during compaction can leave operations in the journal that the
+# tables already reflect, so operations must be written such that applying
+# one a second time changes nothing.
+
+journalname = "amt_edits.journal"
+
+
+def readjournal(path):
+    # Returns the operations in the journal, skipping malformed lines such as
+    # one cut short by a crash
+    operations = []
+    clean = True
+    if os.path.isfile(path):
+        with open(path, encoding="utf8") as f:
+            for line in f:
+                try:
+                    operation = json.loads(line)
+                except ValueError:
+                    clean = False
+                    continue
+                if isinstance(operation, dict) and "op" in operation and line.endswith("\n"):
+                    operations.append(operation)
+                else:
+                    clean = False
+    return operations, clean
+
+
+class AMTEditJournal:
+    def __init__(self, datafolder):
+        self.path = os.path.join(datafolder, journalname)
+        self.lock = threading.Lock()
+        self.operations, clean = readjournal(self.path)
+        self.file = None
+        if not clean:
+            self.rewrite(self.operations)
+        self.file = open(self.path, "a", encoding="utf8")
+
+    def __len__(self):
+        with self.lock:
+            return len(self.operations)
+
+    def append(self, op, **values):
+        operation = { "op": op, **values }
+        with self.lock:
+            self.file.write(json.dumps(operation) + "\n")
+            self.file.flush()
+            self.operations.append(operation)
+
+    def sync(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def trim(self, count):
+        # Drops the first count operations once the tables reflect them
+        with self.lock:
+            self.operations = self.operations[count:]
+            self.rewrite(self.operations)
+
+    def rewrite(self, operations):
+        temppath = self.path + ".tmp"
+        with open(temppath, "w", encoding="utf8") as f:
+            for operation in operations:
+                f.write(json.dumps(operation) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        if self.file is not None:
+            self.file.close()
+        os.replace(temppath, self.path)
+        if self.file is not None:
+            self.file = open(self.path, "a", encoding="utf8")
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
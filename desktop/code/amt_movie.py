@@ -0,0 +1,115 @@
+import os
+import cv2
+import shutil
+import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from amt_decode import readsize, readimage
+
+# Movie rendering shared by CreateMovie and ImagesToMovie. Frames are given
+# as a list of (filepath, overlay) and each is decoded at the output size
+# (see amt_decode.py) and annotated on a pool of worker threads, while the
+# frames go to the VideoWriter in their original order. Anything that
+# carries state from one frame to the next (such as track trails) must
+# therefore already be worked out in the overlays.
+#
+# The "movie" section of the configuration may set:
+#   fps       frames per second (default 5)
+#   codec     four character code for the VideoWriter (default DIVX)
+#   width     output width in pixels, with height, or else
+#   scale     output size as a fraction of the source images (default 1)
+#   workers   decoding and annotating threads (default 4)
+#   segments  time slices encoded in parallel, each to its own file, and
+#             then joined without re-encoding (default 1; needs ffmpeg)
+
+
+def readmovieconfig(config, defaults = {}):
+    settings = { "fps": 5, "codec": "DIVX", "workers": 4, "segments": 1 }
+    settings.update(defaults)
+    if config is not None and "movie" in config:
+        settings.update(config["movie"])
+    return settings
+
+
+class AMTMovieRenderer:
+    def __init__(self, settings):
+        self.fps = settings["fps"]
+        self.codec = settings["codec"]
+        self.scale = settings["scale"] if "scale" in settings else 1.0
+        self.size = (settings["width"], settings["height"]) if "width" in settings and "height" in settings else None
+        self.sourcesize = None
+        self.workers = max(1, settings["workers"])
+        self.segments = max(1, settings["segments"])
+        self.ffmpeg = shutil.which("ffmpeg")
+        if self.segments > 1 and self.ffmpeg is None:
+            print("ffmpeg not found - rendering the movie as a single segment")
+            self.segments = 1
+
+    def getsize(self, filepath):
+        # Output size from the configuration or from the first image, whose
+        # size is taken as that of all the frames
+        self.sourcesize = readsize(filepath)
+        if self.size is None:
+            self.size = (int(self.sourcesize[0] * self.scale), int(self.sourcesize[1] * self.scale))
+        return self.size
+
+    def renderframe(self, filepath, overlay, annotate):
+        image = readimage(filepath, self.sourcesize, self.size)
+        if image is None:
+            print("Failed to read " + filepath)
+            return None
+        if annotate is not None:
+            annotate(image, overlay, self.size[0] / self.sourcesize[0])
+        return image
+
+    def writesegment(self, executor, moviepath, frames, annotate):
+        moviewriter = cv2.VideoWriter(moviepath, cv2.VideoWriter_fourcc(*self.codec), self.fps, self.size)
+        # At most two frames per worker are held waiting to be written
+        pending = deque()
+        queued = iter(frames)
+        for filepath, overlay in queued:
+            pending.append(executor.submit(self.renderframe, filepath, overlay, annotate))
+            if len(pending) >= 2 * self.workers:
+                break
+        while len(pending) > 0:
+            image = pending.popleft().result()
+            frame = next(queued, None)
+            if frame is not None:
+                pending.append(executor.submit(self.renderframe, frame[0], frame[1], annotate))
+            if image is not None:
+                moviewriter.write(image)
+        moviewriter.release()
+
+    def render(self, moviepath, frames, annotate = None):
+        if len(frames) == 0:
+            return
+        self.getsize(frames[0][0])
+        segments = min(self.segments, len(frames))
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            if segments == 1:
+                self.writesegment(executor, moviepath, frames, annotate)
+                return
+            root, extension = os.path.splitext(moviepath)
+            paths = [ root + "_" + str(s) + extension for s in range(segments) ]
+            threads = []
+            for s in range(segments):
+                first = s * len(frames) // segments
+                last = (s + 1) * len(frames) // segments
+                thread = threading.Thread(target=self.writesegment, args=(executor, paths[s], frames[first:last], annotate))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+        self.concatenate(moviepath, paths)
+
+    def concatenate(self, moviepath, paths):
+        listpath = moviepath + ".txt"
+        with open(listpath, "w") as listfile:
+            for path in paths:
+                listfile.write("file '" + os.path.abspath(path).replace("'", "'\\''") + "'\n")
+        subprocess.run([self.ffmpeg, "-y", "-loglevel", "error", "-f", "concat", "-safe", "0", "-i", listpath, "-c", "copy", moviepath], check=True)
+        os.remove(listpath)
+        for path in paths:
+            os.remove(path)
@@ -0,0 +1,65 @@
+import cv2
+import numpy as np
+from collections import deque
+
+# Track overlays for marked images and movies, shared by SegmentImages and
+# CreateMovie. AMTTrails keeps the most recent centres of each track in a
+# fixed-length ring buffer and forgets tracks once they have died, so memory
+# stays flat however long the night. drawtrails draws the segments of every
+# trail in a frame with one cv2.polylines call per segment age rather than a
+# cv2.line call per segment.
+
+# Box colour by blob age, then trail colours from the newest segment back
+agecolors = [(0, 128, 0), (255, 0, 0), (255, 50, 50), (255, 100, 100), (255, 150, 150), (255, 200, 200), (0, 0, 255)]
+
+
+class AMTTrails:
+    def __init__(self, length = 5, maxage = None):
+        self.length = length
+        # Tracks not seen for more than maxage frames are dropped by endframe
+        # - if None, tracks are only dropped by evict
+        self.maxage = maxage
+        self.trails = {}
+        self.lastseen = {}
+        self.frame = 0
+
+    def __len__(self):
+        return len(self.trails)
+
+    def add(self, trackid, point):
+        # Returns the new point followed by up to length earlier points of
+        # the track, newest first
+        trail = self.trails.get(trackid)
+        if trail is None:
+            trail = deque(maxlen=self.length)
+            self.trails[trackid] = trail
+        points = [point]
+        points.extend(trail)
+        trail.appendleft(point)
+        self.lastseen[trackid] = self.frame
+        return points
+
+    def evict(self, trackids):
+        for trackid in trackids:
+            self.trails.pop(trackid, None)
+            self.lastseen.pop(trackid, None)
+
+    def endframe(self):
+        self.frame += 1
+        if self.maxage is not None:
+            self.evict([trackid for trackid, frame in self.lastseen.items() if self.frame - frame > self.maxage])
+
+
+def drawtrails(image, trails, thickness = 2, scale = 1.0):
+    # Draws each list of points from AMTTrails.add, colouring segments by age
+    # with the oldest drawn first
+    segments = {}
+    for points in trails:
+        if len(points) > 1:
+            path = np.asarray(points, dtype=np.float64 if scale != 1.0 else np.int32)
+            if scale != 1.0:
+                path = (path * scale).astype(np.int32)
+            for age in range(len(points) - 1):
+                segments.setdefault(age, []).append(path[age:age + 2])
+    for age in sorted(segments, reverse=True):
+        cv2.polylines(image, segments[age], False, agecolors[age + 1], thickness, cv2.LINE_AA)
@@ -0,0 +1,178 @@
+import os
+import cv2
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+# Staged processing for a single run folder. Frames are decoded ahead of use
+# by a small thread pool, detection and tracking stay on the calling thread
+# (MOG2 and the tracker carry state from frame to frame), and output is handed
+# to a writer pool. Every queue is bounded so that memory use stays capped
+# however far the stages drift apart.
+
+
+class AMTFramePrefetcher:
+    def __init__(self, config, folder, filelist, timer = None):
+        self.config = config["pipeline"] if "pipeline" in config else {}
+        self.prefetch = self.config["prefetch"] if "prefetch" in self.config else 4
+        self.folder = folder
+        self.filelist = filelist
+        # Decoding runs on the prefetch threads, so its times are measured
+        # there and added to the timer as each frame is handed over
+        self.timer = timer
+
+    def readimage(self, filename):
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        image = cv2.imread(os.path.join(self.folder, filename))
+        return filename, image, time.perf_counter() - wall, time.thread_time() - cpu
+
+    def handover(self, result):
+        filename, image, wall, cpu = result
+        if self.timer is not None:
+            self.timer.add("decode", wall, cpu)
+        return filename, image
+
+    def __iter__(self):
+        if self.prefetch < 1:
+            for filename in self.filelist:
+                yield self.handover(self.readimage(filename))
+            return
+
+        # At most prefetch decoded frames are held at any time
+        with ThreadPoolExecutor(max_workers=self.prefetch) as executor:
+            pending = deque()
+            files = iter(self.filelist)
+            for filename in files:
+                pending.append(executor.submit(self.readimage, filename))
+                if len(pending) >= self.prefetch:
+                    break
+            while len(pending) > 0:
+                result = pending.popleft().result()
+                filename = next(files, None)
+                if filename is not None:
+                    pending.append(executor.submit(self.readimage, filename))
+                yield self.handover(result)
+
+
+class AMTRowWriter:
+    def __init__(self, output, writer):
+        self.output = output
+        self.writer = writer
+
+    def writerow(self, row):
+        self.output.enqueue(self.writer.writerow, row)
+
+
+def readframes(config, folder, batches, timer = None):
+    # Prefetched frames from a sequence of file lists, for folders that are
+    # still being filled
+    for filelist in batches:
+        yield from AMTFramePrefetcher(config, folder, filelist, timer)
+
+
+class AMTAsyncWriter:
+    def __init__(self, config):
+        self.config = config["pipeline"] if "pipeline" in config else {}
+        self.writers = self.config["writers"] if "writers" in self.config else 4
+        self.queuesize = self.config["queuesize"] if "queuesize" in self.config else 32
+        self.error = None
+        self.executor = None
+        self.ordered = None
+        if self.writers > 0:
+            # Image files can be written in any order
+            self.executor = ThreadPoolExecutor(max_workers=self.writers)
+            self.slots = threading.BoundedSemaphore(self.queuesize)
+            # CSV rows and movie frames must keep their order so go through
+            # a single thread
+            self.ordered = queue.Queue(maxsize=self.queuesize)
+            self.thread = threading.Thread(target=self.drain, daemon=True)
+            self.thread.start()
+
+    def drain(self):
+        while True:
+            item = self.ordered.get()
+            if item is None:
+                self.ordered.task_done()
+                break
+            function, arg = item
+            try:
+                function(arg)
+            except Exception as e:
+                self.error = e
+            self.ordered.task_done()
+
+    def enqueue(self, function, arg):
+        if self.ordered is None:
+            function(arg)
+        else:
+            self.checkerror()
+            self.ordered.put((function, arg))
+
+    def rowwriter(self, writer):
+        return AMTRowWriter(self, writer)
+
+    def writeframe(self, moviewriter, image):
+        self.enqueue(moviewriter.write, image)
+
+    def writeimage(self, filepath, image):
+        if self.executor is None:
+            self.imwrite(filepath, image)
+        else:
+            self.checkerror()
+            self.slots.acquire()
+            future = self.executor.submit(self.imwrite, filepath, image)
+            future.add_done_callback(self.imagewritten)
+
+    def imwrite(self, filepath, image):
+        # cv2.imwrite reports failure (e.g. a full disk) by returning False
+        if not cv2.imwrite(filepath, image):
+            raise OSError("Could not write " + filepath)
+
+    def writeencoded(self, store, name, image):
+        # Encodes the image as a JPEG on a writer thread and hands it to a
+        # store such as AMTBlobPackWriter
+        if self.executor is None:
+            self.encode(store, name, image)
+        else:
+            self.checkerror()
+            self.slots.acquire()
+            future = self.executor.submit(self.encode, store, name, image)
+            future.add_done_callback(self.imagewritten)
+
+    def encode(self, store, name, image):
+        ok, data = cv2.imencode(".jpg", image)
+        if not ok:
+            raise IOError("Could not encode " + name)
+        store.write(name, data.tobytes())
+
+    def imagewritten(self, future):
+        self.slots.release()
+        if future.exception() is not None:
+            self.error = future.exception()
+
+    def checkerror(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        # Waits until everything queued so far has been written
+        if self.executor is not None:
+            self.ordered.join()
+            for i in range(self.queuesize):
+                self.slots.acquire()
+            for i in range(self.queuesize):
+                self.slots.release()
+        self.checkerror()
+
+    def close(self):
+        if self.executor is not None:
+            self.ordered.put(None)
+            self.thread.join()
+            self.executor.shutdown(wait=True)
+            self.executor = None
+            self.ordered = None
+        self.checkerror()
@@ -0,0 +1,202 @@
+import os
+import pandas
+
+# Shared access to the amt_image, amt_blob and amt_track tables in a run's
+# data folder. Each table may be stored as CSV (amt_<name>.csv) and/or in a
+# typed columnar form (amt_<name>.parquet or amt_<name>.feather, both of which
+# need pyarrow). readtable returns a DataFrame with the column types below
+# whichever form is present, so consumers no longer parse strings. Columns
+# not listed here are read as strings. Missing strings are read as "" as
+# the CSV readers always did, and missing numbers as NaN - SegmentImages
+# writes <UNKNOWN> for a temperature or humidity it could not read.
+
+tableformats = [ "parquet", "feather", "csv" ]
+missingvalues = [ "", "<UNKNOWN>" ]
+
+tablecolumns = {
+    "image": {
+        "id": "int64", "datetime": "str", "filename": "str",
+        "temperature": "float64", "humidity": "float64"
+    },
+    "blob": {
+        "id": "int64", "imageid": "int64", "filename": "str",
+        "x": "int64", "y": "int64", "w": "int64", "h": "int64",
+        "xcrop": "int64", "ycrop": "int64", "wcrop": "int64", "hcrop": "int64",
+        "xcenter": "int64", "ycenter": "int64",
+        "size": "int64", "illumination": "int64", "changed": "bool", "colors": "str",
+        "trackid": "int64", "cost": "float64", "weights": "str", "direction": "float64", "delay": "int64"
+    },
+    "track": {
+        "id": "int64", "identification": "str",
+        "inaturalistID": "str", "inaturalistRG": "str", "inaturalistTaxon": "str"
+    }
+}
+
+
+def tablepath(datafolder, name, format = "csv"):
+    return os.path.join(datafolder, "amt_" + name + "." + format)
+
+
+def findtable(datafolder, name):
+    # Returns the path and format to read - a columnar file is preferred
+    # unless the CSV has been written since, e.g. by an older tool
+    found = None
+    for format in tableformats:
+        path = tablepath(datafolder, name, format)
+        if os.path.isfile(path):
+            if found is None or os.path.getmtime(path) > os.path.getmtime(found[0]):
+                found = (path, format)
+    return found
+
+
+def tableexists(datafolder, name):
+    return findtable(datafolder, name) is not None
+
+
+def gettableformats(datafolder, name):
+    return [ format for format in tableformats if os.path.isfile(tablepath(datafolder, name, format)) ]
+
+
+def settypes(frame, name):
+    # Converts columns that are not already of the expected type
+    columns = tablecolumns[name] if name in tablecolumns else {}
+    for column in frame.columns:
+        dtype = columns[column] if column in columns else "str"
+        values = frame[column]
+        if dtype == "str":
+            if not pandas.api.types.is_string_dtype(values) or values.isna().any():
+                frame[column] = values.fillna("").astype(str)
+        elif values.dtype == dtype:
+            continue
+        elif dtype == "bool":
+            frame[column] = values.astype(str).str.lower() == "true"
+        elif values.dtype.kind in "iufb":
+            frame[column] = values.astype(dtype)
+        else:
+            # astype parses with full precision where to_numeric may not
+            frame[column] = values.where(~values.isin(missingvalues)).astype(dtype)
+    return frame
+
+
+def readcsv(path, name, columns):
+    # Numbers are parsed by read_csv itself, everything else is read as a
+    # string so that empty values stay "" rather than becoming NaN
+    types = tablecolumns[name] if name in tablecolumns else {}
+    dtypes = {}
+    missing = {}
+    for column, dtype in types.items():
+        if dtype in [ "int64", "float64" ]:
+            dtypes[column] = dtype
+            if dtype == "float64":
+                missing[column] = missingvalues
+    headings = pandas.read_csv(path, nrows=0, encoding="utf8").columns
+    for column in headings:
+        if column not in dtypes:
+            dtypes[column] = str
+    return pandas.read_csv(path, usecols=columns, dtype=dtypes, keep_default_na=False, na_values=missing, float_precision="round_trip", encoding="utf8")
+
+
+def readtable(datafolder, name, columns = None):
+    found = findtable(datafolder, name)
+    if found is None:
+        raise FileNotFoundError(tablepath(datafolder, name))
+    path, format = found
+    if format == "parquet":
+        frame = pandas.read_parquet(path, columns=columns)
+    elif format == "feather":
+        frame = pandas.read_feather(path, columns=columns)
+    else:
+        frame = readcsv(path, name, columns)
+    if columns is not None:
+        frame = frame[columns].copy()
+    return settypes(frame, name)
+
+
+def readtables(datafolders, name, columns = None):
+    # Concatenates a table across several runs, e.g. a season of nights,
+    # adding a "folder" column with the path of the run each row came from -
+    # runs are named by date, so units recording the same night share a name
+    frames = []
+    for datafolder in datafolders:
+        if tableexists(datafolder, name):
+            frame = readtable(datafolder, name, columns)
+            frame.insert(0, "folder", os.path.dirname(os.path.normpath(datafolder)))
+            frames.append(frame)
+    if len(frames) == 0:
+        return None
+    return pandas.concat(frames, ignore_index=True)
+
+
+def readrows(datafolder, name):
+    # Row-oriented access for editors that modify the rows in place -
+    # values are typed but missing numbers are "" as in the CSV files
+    frame = readtable(datafolder, name).astype(object)
+    frame = frame.where(frame.notna(), "")
+    return list(frame.columns), frame.values.tolist()
+
+
+def writetable(datafolder, name, frame, formats = None):
+    # Writes the table in each of the given formats, by default whichever
+    # forms the folder already holds (or CSV if none)
+    if formats is None:
+        formats = gettableformats(datafolder, name)
+        if len(formats) == 0:
+            formats = [ "csv" ]
+    frame = settypes(frame, name)
+    for format in formats:
+        writeframe(tablepath(datafolder, name, format), frame, format)
+
+
+def writeframe(path, frame, format):
+    # Writes to a temporary file and renames it so that readers never see a
+    # partly written file
+    temppath = path + ".tmp"
+    if format == "parquet":
+        frame.to_parquet(temppath, index=False)
+    elif format == "feather":
+        frame.reset_index(drop=True).to_feather(temppath)
+    else:
+        frame.to_csv(temppath, index=False, encoding="utf8", lineterminator="\r\n")
+    os.replace(temppath, path)
+
+
+def writerows(datafolder, name, headings, rows, formats = None):
+    writetable(datafolder, name, pandas.DataFrame(rows, columns=headings), formats)
+
+
+def converttables(datafolder, names, format, keepcsv = True):
+    # Adds a columnar copy of CSV tables written by SegmentImages
+    if format == "csv":
+        return
+    for name in names:
+        csvpath = tablepath(datafolder, name)
+        if os.path.isfile(csvpath):
+            writetable(datafolder, name, readtable(datafolder, name), [ format ])
+            if not keepcsv:
+                os.remove(csvpath)
+
+
+if __name__ == "__main__":
+    # Checks that the tables in a data folder read back unchanged from each
+    # columnar format, using copies in a temporary folder
+    import sys
+    import shutil
+    import tempfile
+    if len(sys.argv) < 2:
+        print("Usage: python amt_tables.py datafolder")
+        sys.exit()
+    failed = 0
+    for name in tablecolumns:
+        if not tableexists(sys.argv[1], name):
+            continue
+        path, source = findtable(sys.argv[1], name)
+        expected = readtable(sys.argv[1], name)
+        for format in tableformats[:-1]:
+            with tempfile.TemporaryDirectory() as folder:
+                shutil.copyfile(path, tablepath(folder, name, source))
+                converttables(folder, [ name ], format, False)
+                result = readtable(folder, name)
+            ok = result.equals(expected)
+            failed += 0 if ok else 1
+            print(f"{name} {format}: {len(result)} rows {'OK' if ok else 'DIFFERENT'}")
+    sys.exit(1 if failed > 0 else 0)
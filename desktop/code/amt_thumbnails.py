@@ -0,0 +1,236 @@
+import io
+import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+from amt_blobstore import AMTBlobPackWriter, readindex
+from amt_decode import openimage
+
+# Thumbnails of blob crops for TrackEditor. AMTThumbnailStore keeps the
+# resized thumbnails for a night in data/amt_thumb_<blobsize>.pack (the same
+# append-only layout as amt_blob.pack), so a night that has been opened
+# before needs no crops decoded. AMTThumbnailCache holds recently used
+# thumbnails in memory up to a budget in bytes, evicting the least recently
+# used, and can fill itself in the background for the next page of tracks.
+# Thumbnails that are not in memory are decoded by a pool of worker threads
+# and handed back through collect, which the GUI polls, so that the GUI
+# thread never waits for a crop to be decoded.
+
+
+def makethumbnail(image, blobsize):
+    size = image.size
+    if size[0] > blobsize or size[1] > blobsize:
+        scale = blobsize / (size[0] if size[0] > size[1] else size[1])
+        image = image.resize((int(float(size[0])*scale),int(float(size[1])*scale)))
+    return image
+
+
+class AMTThumbnailStore:
+    def __init__(self, datafolder, blobsize):
+        prefix = "amt_thumb_" + str(blobsize)
+        self.packpath = os.path.join(datafolder, prefix + ".pack")
+        indexpath = os.path.join(datafolder, prefix + "_index.csv")
+        self.index = {}
+        exists = os.path.isfile(self.packpath) and os.path.isfile(indexpath)
+        if exists:
+            self.index = readindex(indexpath, os.path.getsize(self.packpath))
+        self.writer = None
+        try:
+            self.writer = AMTBlobPackWriter(datafolder, exists, prefix)
+        except OSError:
+            # A read-only data folder still gets the in-memory cache
+            pass
+        self.pack = open(self.packpath, 'rb') if os.path.isfile(self.packpath) else None
+        self.lock = threading.Lock()
+
+    def read(self, name):
+        with self.lock:
+            if name not in self.index:
+                return None
+            offset, length = self.index[name]
+            self.pack.seek(offset)
+            data = self.pack.read(length)
+        return Image.open(io.BytesIO(data))
+
+    def write(self, name, image):
+        if self.writer is None or name in self.index:
+            return
+        data = io.BytesIO()
+        image.save(data, format="PNG", compress_level=1)
+        data = data.getvalue()
+        with self.lock:
+            # Another worker may have written the same crop meanwhile
+            if self.writer is None or name in self.index:
+                return
+            offset = self.writer.getoffsets()[0]
+            self.writer.write(name, data)
+            self.writer.flush()
+            if self.pack is None:
+                self.pack = open(self.packpath, 'rb')
+            self.index[name] = (offset, len(data))
+
+    def close(self):
+        with self.lock:
+            if self.writer is not None:
+                self.writer.close()
+                self.writer = None
+            if self.pack is not None:
+                self.pack.close()
+                self.pack = None
+
+
+class AMTThumbnailCache:
+    # get, request and prefetch may be called from any thread. The display
+    # image made from a thumbnail (e.g. an ImageTk.PhotoImage) is created by
+    # getdisplay, getcached or setdisplay on the calling thread and kept with
+    # it in the cache. Display images dropped from the cache are only released
+    # by collect, so that a Tk image is never deleted from a worker thread.
+    def __init__(self, blobstore, store, blobsize, budget = 256 * 1024 * 1024, workers = 4):
+        self.blobstore = blobstore
+        self.store = store
+        self.blobsize = blobsize
+        self.budget = budget
+        self.used = 0
+        self.entries = OrderedDict()
+        self.released = []
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.ready = queue.SimpleQueue()
+        self.prefetching = None
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def getcost(image, display):
+        # Decoded RGB pixels plus the display copy once made
+        return image.size[0] * image.size[1] * (3 if display is None else 7)
+
+    def lookup(self, name):
+        with self.lock:
+            if name in self.entries:
+                self.entries.move_to_end(name)
+                self.hits += 1
+                return self.entries[name]
+        return None
+
+    def insert(self, name, image, display = None):
+        with self.lock:
+            if name in self.entries:
+                self.used -= self.getcost(*self.entries[name])
+                self.release(self.entries[name], display)
+            entry = (image, display)
+            self.entries[name] = entry
+            self.entries.move_to_end(name)
+            self.used += self.getcost(image, display)
+            while self.used > self.budget and len(self.entries) > 1:
+                _, evicted = self.entries.popitem(last=False)
+                self.used -= self.getcost(*evicted)
+                self.release(evicted)
+        return entry
+
+    def release(self, entry, display = None):
+        # Called with the lock held - keeps the entry's display image for
+        # collect to drop unless it is staying in the cache
+        if entry[1] is not None and entry[1] is not display:
+            self.released.append(entry[1])
+
+    def get(self, name):
+        entry = self.lookup(name)
+        if entry is not None:
+            return entry[0]
+        with self.lock:
+            self.misses += 1
+        image = self.store.read(name) if self.store is not None else None
+        if image is None:
+            image = makethumbnail(openimage(self.blobstore.open(name), (self.blobsize, self.blobsize)), self.blobsize)
+            image.load()
+            if self.store is not None:
+                self.store.write(name, image)
+        else:
+            image.load()
+        return self.insert(name, image)[0]
+
+    def getdisplay(self, name, makedisplay):
+        entry = self.lookup(name)
+        if entry is not None and entry[1] is not None:
+            return entry[1]
+        image = self.get(name)
+        display = makedisplay(image)
+        self.insert(name, image, display)
+        return display
+
+    def getcached(self, name, makedisplay):
+        # Returns the display image if the thumbnail is in memory, else None
+        entry = self.lookup(name)
+        if entry is None:
+            return None
+        if entry[1] is not None:
+            return entry[1]
+        return self.setdisplay(name, entry[0], makedisplay)
+
+    def setdisplay(self, name, image, makedisplay):
+        display = makedisplay(image)
+        self.insert(name, image, display)
+        return display
+
+    def request(self, names, cancelled, callback):
+        # Decodes the thumbnails in the worker pool. Once cancelled is set,
+        # names not yet started are skipped and results are dropped.
+        for name in names:
+            self.executor.submit(self.load, name, cancelled, callback)
+
+    def load(self, name, cancelled, callback):
+        if cancelled.is_set():
+            return
+        try:
+            image = self.get(name)
+        except OSError:
+            return
+        self.ready.put((cancelled, callback, name, image))
+
+    def collect(self):
+        # Returns (callback, name, image) for each requested thumbnail
+        # decoded since the last call and not cancelled, and releases the
+        # display images dropped from the cache - call on the display thread
+        with self.lock:
+            released, self.released = self.released, []
+        del released
+        results = []
+        while True:
+            try:
+                cancelled, callback, name, image = self.ready.get_nowait()
+            except queue.Empty:
+                return results
+            if not cancelled.is_set():
+                results.append((callback, name, image))
+
+    def prefetch(self, names):
+        # Loads thumbnails for names in the background, abandoning any
+        # earlier prefetch that has not finished
+        if self.prefetching is not None:
+            self.prefetching.set()
+        cancelled = threading.Event()
+        self.prefetching = cancelled
+        self.executor.submit(self.fill, list(names), cancelled)
+
+    def fill(self, names, cancelled):
+        for name in names:
+            if cancelled.is_set():
+                return
+            with self.lock:
+                cached = name in self.entries
+            if not cached:
+                try:
+                    self.get(name)
+                except OSError:
+                    pass
+
+    def close(self):
+        if self.prefetching is not None:
+            self.prefetching.set()
+        self.executor.shutdown(wait=True)
+        if self.store is not None:
+            self.store.close()
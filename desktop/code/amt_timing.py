@@ -0,0 +1,86 @@
+import csv
+import time
+from contextlib import contextmanager, nullcontext
+
+# Wall and CPU time for the named stages of a per-frame loop. Stages are
+# reported in the order they are first used, and a frame's times are only
+# recorded once endframe is called. By default CPU time is for the whole
+# process, so it includes any OpenCV worker threads (and other pipeline
+# threads) that run while the stage is timed - pass time.thread_time as
+# cpuclock to count only the thread doing the work.
+
+
+def timed(timer, name):
+    # Stage context for code that may run with or without a timer
+    return timer.stage(name) if timer is not None else nullcontext()
+
+
+class AMTStageTimer:
+    def __init__(self, cpuclock = time.process_time):
+        self.cpuclock = cpuclock
+        self.stages = []
+        self.current = {}
+        self.frames = []
+
+    @contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = self.cpuclock()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, self.cpuclock() - cpu)
+
+    def add(self, name, wall, cpu):
+        if name not in self.stages:
+            self.stages.append(name)
+        if name in self.current:
+            self.current[name][0] += wall
+            self.current[name][1] += cpu
+        else:
+            self.current[name] = [wall, cpu]
+
+    def endframe(self, label = None):
+        self.frames.append((label, self.current))
+        self.current = {}
+
+    def summary(self):
+        # Totals in seconds and per-frame mean and maximum wall time in
+        # milliseconds for each stage
+        summary = {}
+        for name in self.stages:
+            walls = [times[name][0] for _, times in self.frames if name in times]
+            cpus = [times[name][1] for _, times in self.frames if name in times]
+            summary[name] = {
+                "wall": sum(walls),
+                "cpu": sum(cpus),
+                "mean": 1000 * sum(walls) / len(self.frames) if len(self.frames) > 0 else 0,
+                "max": 1000 * max(walls) if len(walls) > 0 else 0
+            }
+        return summary
+
+    def writecsv(self, path):
+        # One row per frame with wall and CPU milliseconds for each stage
+        with open(path, 'w', newline='', encoding="utf8") as timingfile:
+            timingwriter = csv.writer(timingfile, delimiter=',')
+            headings = [ "frame", "filename" ]
+            for name in self.stages:
+                headings += [ name + "_wall_ms", name + "_cpu_ms" ]
+            timingwriter.writerow(headings)
+            frame = 0
+            for label, times in self.frames:
+                frame += 1
+                row = [ frame, label ]
+                for name in self.stages:
+                    wall, cpu = times[name] if name in times else (0, 0)
+                    row += [ f"{1000 * wall:.3f}", f"{1000 * cpu:.3f}" ]
+                timingwriter.writerow(row)
+
+    def printsummary(self, title):
+        summary = self.summary()
+        total = sum(stage["wall"] for stage in summary.values())
+        print(f"{title} - {len(self.frames)} frames, {total:.1f}s in timed stages")
+        print(f"   {'Stage':<14}{'Wall s':>9}{'CPU s':>9}{'Mean ms':>9}{'Max ms':>9}{'Share':>8}")
+        for name, stage in summary.items():
+            share = 100 * stage["wall"] / total if total > 0 else 0
+            print(f"   {name:<14}{stage['wall']:>9.2f}{stage['cpu']:>9.2f}{stage['mean']:>9.1f}{stage['max']:>9.1f}{share:>7.1f}%")
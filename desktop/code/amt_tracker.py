@@ -1,13 +1,17 @@
 import math as math
 import numpy as np
 from scipy.optimize import linear_sum_assignment
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
 import time
 from abc import ABC, abstractmethod
+from colors import colorcodes, popcounts
 
 
 def getdirection(a, b):
-    ax, ay = a["xcenter"], a["ycenter"]
-    bx, by = b["xcenter"], b["ycenter"]
+    ax, ay = a.xcenter, a.ycenter
+    bx, by = b.xcenter, b.ycenter
     x = bx - ax
     y = by - ay
     if (x**2) + (y**2) > 100:
@@ -16,6 +20,34 @@ def getdirection(a, b):
         return ""
 
 
+def getdirections(a, b):
+    # Vectorised getdirection for every pair in two column sets - NaN where
+    # the movement is too small to have a direction
+    x = b["xcenter"][np.newaxis, :] - a["xcenter"][:, np.newaxis]
+    y = b["ycenter"][np.newaxis, :] - a["ycenter"][:, np.newaxis]
+    direction = np.arctan2(y, x) / math.pi * 180
+    direction[(x**2) + (y**2) <= 100] = np.nan
+    return direction
+
+
+def getcolumns(records):
+    # Gather the fields used by the scales into one NumPy array per field so
+    # that whole cost blocks can be computed at once
+    columns = {}
+    for key in ["x", "y", "w", "h", "xcenter", "ycenter", "size", "age"]:
+        columns[key] = np.array([getattr(r, key) for r in records], dtype=np.float64)
+    columns["direction"] = np.array(
+        [np.nan if r.direction == "" else r.direction for r in records],
+        dtype=np.float64,
+    )
+    columns["colors"] = np.array([r.colors for r in records], dtype=np.uint8)
+    return columns
+
+
+def selectcolumns(columns, indices):
+    return {key: value[indices] for key, value in columns.items()}
+
+
 class Scale(ABC):
     def __init__(self):
         self.weight = 1
@@ -24,6 +56,12 @@ class Scale(ABC):
     def measurecost(self, a, b):
         pass
 
+    @abstractmethod
+    def measurecosts(self, a, b):
+        # a and b are column sets from getcolumns - return an array with a
+        # row for each record in a and a column for each record in b
+        pass
+
     @abstractmethod
     def getcode(self):
         pass
@@ -38,8 +76,8 @@ class Scale(ABC):
 
 class AMTSizeScale(Scale):
     def measurecost(self, a, b):
-        asize = a["size"]
-        bsize = b["size"]
+        asize = a.size
+        bsize = b.size
         if asize > bsize:
             asize, bsize = bsize, asize
         if asize == 0:
@@ -49,23 +87,32 @@ class AMTSizeScale(Scale):
             return self.weight
         return self.weight * (ratio - 1) / 3
 
+    def measurecosts(self, a, b):
+        asize = np.minimum(a["size"][:, np.newaxis], b["size"][np.newaxis, :])
+        bsize = np.maximum(a["size"][:, np.newaxis], b["size"][np.newaxis, :])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = bsize / asize
+            costs = self.weight * (ratio - 1) / 3
+        costs[(asize == 0) | (ratio > 4)] = self.weight
+        return costs
+
     def getcode(self):
         return "S"
 
 
 class AMTDistanceScale(Scale):
     def measurecost(self, a, b):
-        ax, ay = a["xcenter"], a["ycenter"]
-        bx, by = b["xcenter"], b["ycenter"]
+        ax, ay = a.xcenter, a.ycenter
+        bx, by = b.xcenter, b.ycenter
         distance = math.sqrt((bx - ax) ** 2 + (by - ay) ** 2)
 
         if distance < 25:
             penaltydistance = 0
         elif (
-            bx > a["x"]
-            and bx < a["x"] + a["w"]
-            and by > a["y"]
-            and by < a["y"] + a["h"]
+            bx > a.x
+            and bx < a.x + a.w
+            and by > a.y
+            and by < a.y + a.h
         ):
             penaltydistance = 0.01
         elif distance < 100:
@@ -78,22 +125,33 @@ class AMTDistanceScale(Scale):
 
         return self.weight * penaltydistance
 
+    def measurecosts(self, a, b):
+        bx, by = b["xcenter"][np.newaxis, :], b["ycenter"][np.newaxis, :]
+        ax, ay = a["x"][:, np.newaxis], a["y"][:, np.newaxis]
+        aw, ah = a["w"][:, np.newaxis], a["h"][:, np.newaxis]
+        distance = np.sqrt(
+            (bx - a["xcenter"][:, np.newaxis]) ** 2
+            + (by - a["ycenter"][:, np.newaxis]) ** 2
+        )
+        inside = (bx > ax) & (bx < ax + aw) & (by > ay) & (by < ay + ah)
+        penaltydistance = np.select(
+            [distance < 25, inside, distance < 100, distance < 250],
+            [0, 0.01, 0.01, 0.02],
+            distance / 4405,
+        )
+        return self.weight * penaltydistance
+
     def getcode(self):
         return "D"
 
 
 class AMTColorScale(Scale):
-    def __init__(self):
-        self.colors = ["R", "G", "B", "C", "M", "Y", "W", "K"]
-
     def measurecost(self, a, b):
-        distance = 0
-        acolors = a["colors"]
-        bcolors = b["colors"]
-        for c in self.colors:
-            if (c in acolors) != (c in bcolors):
-                distance += 1
-        return self.weight * distance / len(self.colors)
+        return self.weight * popcounts[a.colors ^ b.colors] / len(colorcodes)
+
+    def measurecosts(self, a, b):
+        different = a["colors"][:, np.newaxis] ^ b["colors"][np.newaxis, :]
+        return self.weight * popcounts[different] / len(colorcodes)
 
     def getcode(self):
         return "C"
@@ -101,10 +159,15 @@ class AMTColorScale(Scale):
 
 class AMTAgeScale(Scale):
     def measurecost(self, a, b):
-        if a["age"] > 5:
+        if a.age > 5:
             return self.weight
         else:
-            return self.weight * a["age"] / 5
+            return self.weight * a.age / 5
+
+    def measurecosts(self, a, b):
+        age = a["age"][:, np.newaxis]
+        costs = np.where(age > 5, self.weight, self.weight * age / 5)
+        return np.repeat(costs, len(b["age"]), axis=1)
 
     def getcode(self):
         return "A"
@@ -112,7 +175,7 @@ class AMTAgeScale(Scale):
 
 class AMTDirectionScale(Scale):
     def measurecost(self, a, b):
-        if a["direction"] == "":
+        if a.direction == "":
             return 0
 
         direction = getdirection(a, b)
@@ -120,7 +183,7 @@ class AMTDirectionScale(Scale):
         if direction == "":
             return 0
 
-        difference = a["direction"] - direction
+        difference = a.direction - direction
         if difference < -180:
             difference += 360
         elif difference > 180:
@@ -128,6 +191,15 @@ class AMTDirectionScale(Scale):
 
         return self.weight * abs(difference) / 180
 
+    def measurecosts(self, a, b):
+        difference = a["direction"][:, np.newaxis] - getdirections(a, b)
+        difference[difference < -180] += 360
+        difference[difference > 180] -= 360
+        costs = self.weight * np.abs(difference) / 180
+        # No cost where either the track or the movement has no direction
+        costs[np.isnan(costs)] = 0
+        return costs
+
     def getcode(self):
         return "B"
 
@@ -166,25 +238,28 @@ class AMTTracker:
                 self.totalweight += scale.getweight()
         self.maxage = self.conf["maxage"]
         self.cost_threshold = self.conf["cost_threshold"]
+        # Tracks are only scored against blobs whose centres lie within
+        # gateradius pixels - if not set, every pair is scored
+        self.gateradius = self.conf["gateradius"] if "gateradius" in self.conf else None
 
     def blobsmatch(self, blob1, blob2):
         # For this purpose, a match is considered good if the centroids of the
         # blobs are in the innnermost 10% of the other blob and if the sizes are
         # within 20%.
 
-        x1 = blob1["x"]
-        y1 = blob1["y"]
-        w1 = blob1["w"]
-        h1 = blob1["h"]
-        x2 = blob2["x"]
-        y2 = blob2["y"]
-        w2 = blob2["w"]
-        h2 = blob2["h"]
+        x1 = blob1.x
+        y1 = blob1.y
+        w1 = blob1.w
+        h1 = blob1.h
+        x2 = blob2.x
+        y2 = blob2.y
+        w2 = blob2.w
+        h2 = blob2.h
 
-        cx1 = blob1["xcenter"]
-        cy1 = blob1["ycenter"]
-        cx2 = blob2["xcenter"]
-        cy2 = blob2["ycenter"]
+        cx1 = blob1.xcenter
+        cy1 = blob1.ycenter
+        cx2 = blob2.xcenter
+        cy2 = blob2.ycenter
 
         size1 = w1 * h1
         size2 = w2 * h2
@@ -227,71 +302,128 @@ class AMTTracker:
                 cstring = sstring
         return math.sqrt(comparison / self.totalweight), cstring
 
+    def comparecolumns(self, a, b):
+        # Batch equivalent of compare for all pairs, without the weight strings
+        comparison = np.zeros((len(a["age"]), len(b["age"])))
+        for s in self.scales:
+            comparison += s.measurecosts(a, b) ** 2
+        return np.sqrt(comparison / self.totalweight)
+
+    def findcandidates(self, tracks, blobs):
+        # For each track, the sorted indices of the blobs whose centres are
+        # close enough for blobsmatch to succeed - blobsmatch needs each
+        # centre within a tenth of the other blob's width and height of its
+        # middle
+        tpoints = np.array([(t.xcenter, t.ycenter) for t in tracks], dtype=np.float64)
+        bpoints = np.array([(b.xcenter, b.ycenter) for b in blobs], dtype=np.float64)
+        radii = np.array([(t.w + t.h) * 0.1 + 1 for t in tracks])
+        return [sorted(c) for c in cKDTree(bpoints).query_ball_point(tpoints, radii)]
+
+    def gategroups(self, a, b):
+        # Return a list of (track indices, blob indices, gate) groups that can
+        # be assigned independently. Within a group, gate is a boolean array
+        # marking the pairs close enough to be scored (None if all are).
+        tcount = len(a["age"])
+        bcount = len(b["age"])
+        if self.gateradius is None or self.gateradius <= 0:
+            return [(np.arange(tcount), np.arange(bcount), None)]
+
+        tpoints = np.column_stack((a["xcenter"], a["ycenter"]))
+        bpoints = np.column_stack((b["xcenter"], b["ycenter"]))
+        pairs = cKDTree(tpoints).sparse_distance_matrix(cKDTree(bpoints), self.gateradius, output_type="ndarray")
+        tpaired = pairs["i"]
+        bpaired = pairs["j"]
+
+        # Connected groups in the bipartite graph of gated pairs - blobs are
+        # numbered after the tracks
+        graph = coo_matrix((np.ones(len(tpaired)), (tpaired, bpaired + tcount)), shape=(tcount + bcount, tcount + bcount))
+        _, labels = connected_components(graph, directed=False)
+        tlabels = labels[:tcount]
+        blabels = labels[tcount:]
+
+        groups = []
+        for label in np.unique(labels[tpaired]):
+            tindices = np.flatnonzero(tlabels == label)
+            bindices = np.flatnonzero(blabels == label)
+            gate = np.zeros((len(tindices), len(bindices)), dtype=bool)
+            inlabel = tlabels[tpaired] == label
+            gate[np.searchsorted(tindices, tpaired[inlabel]), np.searchsorted(bindices, bpaired[inlabel])] = True
+            groups.append((tindices, bindices, gate))
+        return groups
+
     def managetracks(self, tracks, blobs):
         newtracks = []
 
-        t = 0
-        while t < len(tracks):
+        candidates = None
+        if self.gateradius is not None and self.gateradius > 0 and len(tracks) > 0 and len(blobs) > 0:
+            candidates = self.findcandidates(tracks, blobs)
+
+        matched = [False] * len(blobs)
+        unmatched = []
+        for t in range(len(tracks)):
             track = tracks[t]
-            b = 0
             found = False
-            while not found and b < len(blobs):
+            for b in range(len(blobs)) if candidates is None else candidates[t]:
                 blob = blobs[b]
-                if self.blobsmatch(track, blob):
+                if not matched[b] and self.blobsmatch(track, blob):
                     found = True
-                    blob["trackid"] = track["trackid"]
-                    blob["cost"] = 0
-                    blob["weights"] = "HighOverlap"
-                    newtracks.append(blobs[b])
-                    blobs.pop(b)
-                    tracks.pop(t)
-                else:
-                    b += 1
+                    matched[b] = True
+                    blob.trackid = track.trackid
+                    blob.cost = 0
+                    blob.weights = "HighOverlap"
+                    newtracks.append(blob)
+                    break
             if not found:
                 # Leave this track for weighted comparisons
-                t += 1
-            else:
-                # tracks is now one shorter so try the same index
-                pass
+                unmatched.append(track)
+        tracks[:] = unmatched
+        blobs[:] = [blobs[b] for b in range(len(blobs)) if not matched[b]]
 
         if len(blobs) > 0 and len(tracks) > 0:
-            max_size = len(tracks) if len(tracks) > len(blobs) else len(blobs)
-            costs = np.full((max_size, max_size), 8.1)
-
-            cstrings = []
-            for t in range(len(tracks)):
-                cstringrow = []
-                cstrings.append(cstringrow)
-                for b in range(len(blobs)):
-                    costs[t][b], cstring = self.compare(tracks[t], blobs[b])
-                    cstringrow.append(cstring)
-
-            if False:  # Show cost matrix
-                colnames = "Blobs"
-                sep = ": "
-                for b in blobs:
-                    colnames += sep + str(b["id"])
-                    sep = ", "
-                print(colnames)
-                for t in range(len(tracks)):
-                    print(str(tracks[t]["trackid"]) + ": " + str(costs[t]))
-                # print(str(len(tracks)) + " / " + str(len(blobs)) + " / " + str(costs))
-
-            track_ind, blob_ind = linear_sum_assignment(costs)
-
-            for i in range(len(track_ind)):
-                if costs[track_ind[i]][blob_ind[i]] < self.cost_threshold:
-                    track = tracks[track_ind[i]]
-                    blob = blobs[blob_ind[i]]
-                    blob["trackid"] = track["trackid"]
-                    blob["direction"] = getdirection(track, blob)
-                    blob["age"] = 0
-                    blob["delay"] = track["age"]
-                    blob["cost"] = costs[track_ind[i]][blob_ind[i]]
-                    blob["weights"] = cstrings[track_ind[i]][blob_ind[i]]
-                    newtracks.append(blob)
-                    tracks[track_ind[i]] = None
-                    blobs[blob_ind[i]] = None
+            trackcolumns = getcolumns(tracks)
+            blobcolumns = getcolumns(blobs)
+            assignments = []
+
+            for tindices, bindices, gate in self.gategroups(trackcolumns, blobcolumns):
+                max_size = len(tindices) if len(tindices) > len(bindices) else len(bindices)
+                costs = np.full((max_size, max_size), 8.1)
+                block = self.comparecolumns(selectcolumns(trackcolumns, tindices), selectcolumns(blobcolumns, bindices))
+                if gate is not None:
+                    block[~gate] = 8.1
+                costs[0:len(tindices), 0:len(bindices)] = block
+
+                if False:  # Show cost matrix
+                    colnames = "Blobs"
+                    sep = ": "
+                    for b in bindices:
+                        colnames += sep + str(blobs[b].id)
+                        sep = ", "
+                    print(colnames)
+                    for t in range(len(tindices)):
+                        print(str(tracks[tindices[t]].trackid) + ": " + str(costs[t]))
+
+                track_ind, blob_ind = linear_sum_assignment(costs)
+
+                for i in range(len(track_ind)):
+                    if costs[track_ind[i]][blob_ind[i]] < self.cost_threshold:
+                        assignments.append((tindices[track_ind[i]], bindices[blob_ind[i]]))
+
+            # Keep the order of a single assignment over all tracks
+            assignments.sort()
+
+            for t, b in assignments:
+                track = tracks[t]
+                blob = blobs[b]
+                blob.trackid = track.trackid
+                blob.direction = getdirection(track, blob)
+                blob.age = 0
+                blob.delay = track.age
+                # Only assigned pairs need the weights string - the cost
+                # is recorded from the same scalar comparison
+                blob.cost, blob.weights = self.compare(track, blob)
+                newtracks.append(blob)
+                tracks[t] = None
+                blobs[b] = None
 
         # At this point, newtracks contains all the blobs that match, tracks
         # contains other blobs from the last image, and blobs contains the
@@ -300,8 +432,8 @@ class AMTTracker:
         t = 0
         while t < len(tracks):
             track = tracks[t]
-            if track is not None and track["age"] < 5:
-                track["age"] = track["age"] + 1
+            if track is not None and track.age < 5:
+                track.age = track.age + 1
                 newtracks.append(track)
                 tracks.pop(t)
             else:
@@ -310,8 +442,8 @@ class AMTTracker:
         # All remaining blobs are new tracks
         for blob in blobs:
             if blob is not None:
-                blob["trackid"] = blob["id"]
-                blob["changed"] = True
+                blob.trackid = blob.id
+                blob.changed = True
                 newtracks.append(blob)
 
         # Remaining tracks are now dead
@@ -8,58 +8,36 @@ Created on 22 September 2021
 import numpy as np
 import cv2
 
-def getcount(hist, size, color, mindiff, maxdiff):
-    count = 0
-    for r in range(size):
-        for g in range(size):
-            for b in range(size):
-                if (color == "R" and r >= g + b + mindiff and abs(g - b) <= maxdiff) or \
-                    (color == "G" and g >= r + b + mindiff and abs(r - b) <= maxdiff) or \
-                    (color == "B" and b >= r + g + mindiff and abs(r - g) <= maxdiff) or \
-                    (color == "C" and r <= g + b - size - mindiff + 1 and abs(g - b) <= maxdiff) or \
-                    (color == "M" and g <= r + b - size - mindiff + 1 and abs(r - b) <= maxdiff) or \
-                    (color == "Y" and b <= r + g - size - mindiff + 1 and abs(r - g) <= maxdiff) or \
-                    (color == "W" and r + b + g >= 3 * (size - 1) - 2 * maxdiff and abs(r - g) <= maxdiff and abs(b - g) <= maxdiff and abs(r - b) <= maxdiff) or \
-                    (color == "K" and r + b + g <= 2 * maxdiff and abs(r - g) <= maxdiff and abs(b - g) <= maxdiff and abs(r - b) <= maxdiff):
-                        count += hist[b][g][r]
-    return count    
+colorcodes = ["R", "G", "B", "C", "M", "Y", "W", "K"]
 
-def reportcolors(image, mask = None):
-    colors = ""
-    h, w, channels = image.shape
-    pixels = h * w
-    if mask is not None:
-        image = image.copy()
-        image[mask == 255] = 0
-        alpha = np.sum(mask == 255)
-        pixels -= alpha
+# Each pixel falls in one of eight classes according to which of its channels
+# are at least 128 - (B >= 128) * 4 + (G >= 128) * 2 + (R >= 128) - and each
+# class sets one bit of the colour mask, in colorcodes order
+classbits = np.array([128, 1, 2, 32, 4, 16, 8, 64], dtype=np.uint8)
 
-    if pixels > 0:
-        threshold = 0.02
-        size = 2
-        hist = cv2.calcHist([image], [0, 1, 2], None, [size, size, size], [0, 256, 0, 256, 0, 256])
-        if hist[0][0][size - 1] / pixels > threshold:
-            colors += "R"
-        if hist[0][size - 1][0] / pixels > threshold:
-            colors += "G"
-        if hist[size - 1][0][0] / pixels > threshold:
-            colors += "B"
-        if hist[size - 1][size - 1][0] / pixels > threshold:
-            colors += "C"
-        if hist[size - 1][0][size - 1] / pixels > threshold:
-            colors += "M"
-        if hist[0][size - 1][size - 1] / pixels > threshold:
-            colors += "Y"
-        if hist[size - 1][size - 1][size - 1] / pixels > threshold:
-            colors += "W"
-        if (hist[0][0][0] - alpha) / pixels > threshold:
-            colors += "K"
-        if False:
-            for c in [ "R", "G", "B", "C", "M", "Y", "W", "K" ]:
-                count = getcount(hist, size, c, mindiff, maxdiff)
-                if c == "W":
-                    count - alpha
-                if count / pixels > threshold:
-                    colors += c
+popcounts = np.array([bin(i).count("1") for i in range(256)], dtype=np.float64)
 
+def colorstring(colors):
+    return "".join(colorcodes[c] for c in range(len(colorcodes)) if colors & (1 << c))
+
+def reportcolors(image, masks, rects, threshold = 0.02):
+    # Colour mask for each (x, y, w, h) rectangle of the frame, counting only
+    # the pixels where the matching mask is not 255. A colour is reported if
+    # more than threshold of the counted pixels fall in its class. The pixels
+    # of all rectangles are classified together and counted with a single
+    # bincount.
+    colors = np.zeros(len(rects), dtype=np.uint8)
+    if len(rects) == 0:
+        return colors
+    pixels = []
+    for (x, y, w, h), mask in zip(rects, masks):
+        pixels.append(image[y:y + h, x:x + w][mask != 255])
+    sizes = np.array([len(p) for p in pixels])
+    channels = np.concatenate(pixels) >> 7
+    classes = channels[:, 0] * 4 + channels[:, 1] * 2 + channels[:, 2]
+    labels = np.repeat(np.arange(len(rects)), sizes)
+    counts = np.bincount(labels * 8 + classes, minlength=len(rects) * 8).reshape(-1, 8)
+    present = counts > threshold * sizes[:, None]
+    for c in range(8):
+        colors[present[:, c]] |= classbits[c]
     return colors